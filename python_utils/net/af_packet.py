@@ -0,0 +1,403 @@
+import Queue
+import collections
+import ctypes
+import mmap
+import select
+import socket
+import struct
+import threading
+import time
+
+from python_utils.common import exceptions
+from python_utils.net import packet_ring
+from python_utils.net import pcap_bpf
+from python_utils.net import pcap_file
+from python_utils.net import pcap_filter_cache
+from python_utils.net import pcap_packet
+from python_utils.net import pcap_rules
+from python_utils.net.tcp_dump import TCPDump
+from python_utils.net.tcp_dump import TCPDUMP_QUEUE_BATCH_SIZE
+from python_utils.net.tcp_dump import TCPDUMP_STOP_POLL_INTERVAL
+from python_utils.shell.cli import LinuxCLI
+
+# See linux/if_packet.h
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# struct tpacket_req3: block size, block count, frame size, frame count,
+# block retire timeout (ms), private area size, feature flags
+TPACKET_REQ3 = struct.Struct('IIIIIII')
+# struct tpacket_stats_v3: packets, drops, queue freezes
+TPACKET_STATS_V3 = struct.Struct('III')
+# struct tpacket_block_desc: the block status, packet count and offset of
+# the first packet, following the version and private area offset
+BLOCK_STATUS_OFFSET = 8
+BLOCK_HEADER = struct.Struct('III')
+# struct tpacket3_hdr: offset to the next packet, seconds, nanoseconds,
+# captured length, original length, status, offset to the frame
+PACKET_HEADER = struct.Struct('IIIIIIH')
+# struct sockaddr_ll following the (aligned) tpacket3_hdr: its protocol
+# (in network order), hardware type, packet type, address length and
+# address
+PACKET_ADDRESS_OFFSET = 48
+PACKET_ADDRESS = struct.Struct('2x2s4xHBB8s')
+ARPHRD_LOOPBACK = 772
+PACKET_OUTGOING = 4
+# Linux cooked (LINKTYPE_LINUX_SLL) header put in front of the frames
+# read on 'any': packet type, hardware type, address length, address and
+# protocol, all in network order
+SLL_HEADER = struct.Struct('!HHH8s2s')
+
+AF_PACKET_BLOCK_SIZE = 1 << 20
+AF_PACKET_BLOCK_COUNT = 16
+# Only used to size the ring (frames are packed into blocks in V3)
+AF_PACKET_FRAME_SIZE = 2048
+# Longest a partly filled block is held before being handed to us
+AF_PACKET_BLOCK_TIMEOUT_MS = 10
+AF_PACKET_SNAPLEN = 262144
+
+
+class AFPacketRing(object):
+    """
+    AF_PACKET socket with a TPACKET_V3 receive ring: the kernel writes
+    frames straight into blocks of memory shared with us, and hands over
+    whole blocks at a time, so reading a block of frames takes no syscall
+    beyond the poll waiting for it.  Frames are optionally filtered in the
+    kernel by a BPF program.  On a named interface, frames are captured
+    with the interface's own link header (Ethernet frames on Ethernet and
+    loopback interfaces).  Interfaces on 'any' may have different link
+    headers or none at all (tun, ppp), so there, like libpcap, the link
+    headers are dropped and each frame gets a Linux cooked header built
+    from its socket address instead.  The filter then has to be compiled
+    for pcap_bpf.LINKTYPE_COOKED_SOCKET (see bpf_linktype).
+    """
+
+    def __init__(self, interface='any', bpf_program=None,
+                 block_size=AF_PACKET_BLOCK_SIZE,
+                 block_count=AF_PACKET_BLOCK_COUNT,
+                 block_timeout_ms=AF_PACKET_BLOCK_TIMEOUT_MS):
+        """
+        :type interface: str
+        :type bpf_program: pcap_bpf.BPFProgram
+        :param block_size: int Must be a multiple of the page size
+        :type block_count: int
+        :param block_timeout_ms: int Longest the kernel waits to fill a
+        block before handing it over anyway
+        """
+        if block_size % mmap.PAGESIZE != 0:
+            raise exceptions.ArgMismatchException(
+                'Ring block size must be a multiple of ' +
+                str(mmap.PAGESIZE))
+        self.interface = interface
+        self.block_size = block_size
+        self.block_count = block_count
+        self.cooked = interface == 'any'
+        self.linktype = self.capture_linktype(interface)
+        """ :type: int Link type of the frames read"""
+        self._next_block = 0
+        self._held_blocks = []
+        """ :type: list[int] Offsets of the blocks read without copying,
+        to hand back to the kernel on the next read"""
+        self._map = None
+        self._view = None
+        """ :type: memoryview The whole ring, for zero-copy reads"""
+        try:
+            self.sock = socket.socket(
+                socket.AF_PACKET,
+                socket.SOCK_DGRAM if self.cooked else socket.SOCK_RAW, 0)
+        except socket.error as e:
+            raise exceptions.SocketException(
+                'Could not open AF_PACKET socket: ' + str(e))
+        try:
+            # The socket receives nothing until it is bound, which is only
+            # done once the filter and ring are set up, so no unfiltered
+            # frame (or frame from another interface) is queued
+            if bpf_program is not None:
+                pcap_bpf.attach_filter(self.sock, bpf_program)
+            self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            frame_count = block_size * block_count // AF_PACKET_FRAME_SIZE
+            self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING,
+                                 TPACKET_REQ3.pack(
+                                     block_size, block_count,
+                                     AF_PACKET_FRAME_SIZE, frame_count,
+                                     block_timeout_ms, 0, 0))
+            self._map = mmap.mmap(self.sock.fileno(), block_size * block_count,
+                                  mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_WRITE)
+            pcap_bpf.bind_capture_socket(self.sock, interface)
+        except (socket.error, EnvironmentError) as e:
+            self.close()
+            raise exceptions.SocketException(
+                'Could not set up AF_PACKET ring on ' + interface + ': ' +
+                str(e))
+        self._poll = select.poll()
+        self._poll.register(self.sock.fileno(), select.POLLIN | select.POLLERR)
+
+    @staticmethod
+    def capture_linktype(interface):
+        """
+        Link type of the frames a ring on the interface reads.
+        :type interface: str
+        :return: int
+        """
+        return pcap_file.LINKTYPE_LINUX_SLL if interface == 'any' \
+            else pcap_file.LINKTYPE_ETHERNET
+
+    @staticmethod
+    def bpf_linktype(interface):
+        """
+        Link type to compile a ring's filter for, as the kernel runs it on
+        the frames before any cooked header is added.
+        :type interface: str
+        :return: int
+        """
+        return pcap_bpf.LINKTYPE_COOKED_SOCKET if interface == 'any' \
+            else pcap_file.LINKTYPE_ETHERNET
+
+    def _block_ready(self):
+        offset = self._next_block * self.block_size + BLOCK_STATUS_OFFSET
+        return BLOCK_HEADER.unpack_from(self._map, offset)[0] & \
+            TP_STATUS_USER != 0
+
+    def _release_block(self, block_start):
+        # Hand the block back to the kernel
+        struct.pack_into('I', self._map, block_start + BLOCK_STATUS_OFFSET,
+                         TP_STATUS_KERNEL)
+
+    def _ring_view(self):
+        if self._view is None:
+            view = memoryview(
+                (ctypes.c_ubyte * len(self._map)).from_buffer(self._map))
+            # ctypes exports a '<B' format, which Python 3 can't index
+            self._view = view.cast('B') if hasattr(view, 'cast') else view
+        return self._view
+
+    def read(self, timeout=0, copy=True):
+        """
+        Take the frames from every block the kernel has handed over, as a
+        list of (frame, epoch timestamp, original length) tuples, waiting
+        up to timeout seconds (forever if None) for a block if none is
+        ready.  Frames are copied out and their blocks handed straight
+        back to the kernel, unless copy is False: the frames are then
+        memoryviews into the ring itself, and their blocks are only handed
+        back on the next read, after which (or once the ring is closed)
+        the views must no longer be used.  Frames read on 'any' are always
+        copied, as they are built with their cooked header.
+        :type timeout: float
+        :type copy: bool
+        :return: list[(bytes | memoryview, float, int)]
+        """
+        for block_start in self._held_blocks:
+            self._release_block(block_start)
+        del self._held_blocks[:]
+        if not self._block_ready():
+            self._poll.poll(None if timeout is None else int(timeout * 1000))
+
+        frames = self._map if copy or self.cooked else self._ring_view()
+        ret = []
+        while self._block_ready():
+            block_start = self._next_block * self.block_size
+            _, num_pkts, packet_offset = BLOCK_HEADER.unpack_from(
+                self._map, block_start + BLOCK_STATUS_OFFSET)
+            start = block_start + packet_offset
+            for _ in range(num_pkts):
+                next_offset, sec, nsec, snaplen, orig_len, _, mac = \
+                    PACKET_HEADER.unpack_from(self._map, start)
+                protocol, hatype, pkttype, halen, address = \
+                    PACKET_ADDRESS.unpack_from(
+                        self._map, start + PACKET_ADDRESS_OFFSET)
+                # Like libpcap, skip the outgoing copy of looped back
+                # frames, as each is also received
+                if pkttype != PACKET_OUTGOING or hatype != ARPHRD_LOOPBACK:
+                    frame = frames[start + mac:start + mac + snaplen]
+                    if self.cooked:
+                        frame = SLL_HEADER.pack(pkttype, hatype, halen,
+                                                address, protocol) + frame
+                        orig_len += SLL_HEADER.size
+                    ret.append((frame, sec + nsec / 1e9, orig_len))
+                start += next_offset
+            if frames is self._map:
+                self._release_block(block_start)
+            else:
+                self._held_blocks.append(block_start)
+            self._next_block = (self._next_block + 1) % self.block_count
+        return ret
+
+    def statistics(self):
+        """
+        The kernel's counts of packets received (including looped back
+        outgoing copies) and dropped (for lack of ring space) since the
+        last call.
+        :return: (int, int)
+        """
+        packets, drops, _ = TPACKET_STATS_V3.unpack(self.sock.getsockopt(
+            SOL_PACKET, PACKET_STATISTICS, TPACKET_STATS_V3.size))
+        return packets, drops
+
+    def close(self):
+        self._view = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Frames read without copying are still referenced, the
+                # ring is unmapped once they are gone
+                pass
+            self._map = None
+        self.sock.close()
+
+
+class AFPacketCapture(TCPDump):
+    """
+    TCPDump compatible capture which reads frames from an AF_PACKET
+    TPACKET_V3 ring (see AFPacketRing) in a thread of this process,
+    rather than running tcpdump.  Filters are compiled to BPF and run in
+    the kernel, so only Rules pcap_bpf can compile are supported.  The
+    same start_capture/wait_for_packets/iter_packets/stop_capture calls
+    are used, with callbacks called from the capture thread.  Frames are
+    captured with epoch timestamps, as Ethernet frames on Ethernet and
+    loopback interfaces and as Linux cooked frames on 'any' (as tcpdump
+    does).  When frames only go to a packet ring, they are written to it
+    straight from the AF_PACKET ring, without an intermediate copy.  The
+    kernel's drop count is kept in kernel_drops once stopped.
+    """
+
+    def __init__(self, block_size=AF_PACKET_BLOCK_SIZE,
+                 block_count=AF_PACKET_BLOCK_COUNT,
+                 block_timeout_ms=AF_PACKET_BLOCK_TIMEOUT_MS):
+        """
+        :type block_size: int
+        :type block_count: int
+        :type block_timeout_ms: int
+        """
+        super(AFPacketCapture, self).__init__()
+        self.block_size = block_size
+        self.block_count = block_count
+        self.block_timeout_ms = block_timeout_ms
+        self.kernel_packets = 0
+        self.kernel_drops = 0
+
+    def start_capture(self, cli=LinuxCLI(), interface='any',
+                      count=0, packet_type='', pcap_filter=None,
+                      max_size=0, timeout=None, callback=None,
+                      callback_args=None, blocking=False,
+                      save_dump_file=False, save_dump_filename=None,
+                      save_dump_max_size=0, save_dump_max_files=0,
+                      binary_capture=False, packet_ring_size=0):
+        """
+        See TCPDump.start_capture.  The cli, packet_type and
+        binary_capture parameters have no effect here.
+        """
+        if self.process is not None:
+            raise exceptions.SubprocessFailedException(
+                'capture already started')
+
+        snaplen = max_size if max_size != 0 else AF_PACKET_SNAPLEN
+        linktype = AFPacketRing.capture_linktype(interface)
+        start_time = time.time()
+        # The filter also truncates frames to the snap length (less the
+        # cooked header added after filtering)
+        ring = AFPacketRing(
+            interface,
+            pcap_filter_cache.compile_bpf(
+                pcap_filter if pcap_filter is not None
+                else pcap_rules.Null(),
+                linktype=AFPacketRing.bpf_linktype(interface),
+                snaplen=max(snaplen - SLL_HEADER.size, 1)
+                if linktype == pcap_file.LINKTYPE_LINUX_SLL else snaplen),
+            self.block_size, self.block_count, self.block_timeout_ms)
+
+        self.data_queue = Queue.Queue()
+        self.subprocess_info_queue = Queue.Queue()
+        self.tcpdump_ready = threading.Event()
+        self.tcpdump_error = threading.Event()
+        self.tcpdump_stop = threading.Event()
+        self.tcpdump_finished = threading.Event()
+        self.packet_buffer = collections.deque()
+        self.packet_ring = packet_ring.PacketRing(packet_ring_size) \
+            if packet_ring_size > 0 else None
+        dump_writer = pcap_file.PCAPFileWriter(
+            save_dump_filename if save_dump_filename is not None
+            else 'tcp.out.' + str(time.time()) + '.pcap',
+            linktype=linktype, snaplen=snaplen,
+            max_size=save_dump_max_size,
+            max_files=save_dump_max_files) if save_dump_file else None
+
+        self.process = threading.Thread(
+            target=self.read_ring,
+            args=(ring, count, callback, callback_args, dump_writer))
+        self.process.daemon = True
+        self.process.start()
+        # The socket is live (and the kernel queuing frames) once bound
+        self.tcpdump_ready.set()
+        self.startup_latency = time.time() - start_time
+        self.startup_latencies.append(self.startup_latency)
+
+        if blocking is True:
+            self.process.join(timeout)
+            if self.process.is_alive():
+                raise exceptions.SubprocessTimeoutException(
+                    'capture failed to receive packets within timeout')
+
+    def read_ring(self, ring, count, callback, callback_args, dump_writer):
+        """
+        Capture thread: read frames from the ring until stopped (or count
+        frames are read, if set), handing them over in batches.
+        :type ring: AFPacketRing
+        :type count: int
+        :type callback: callable
+        :type callback_args: list[T]
+        :type dump_writer: pcap_file.PCAPFileWriter
+        """
+        received = 0
+        # Frames only written to the packet ring are copied into it, so
+        # they needn't be copied out of the AF_PACKET ring first
+        copy = self.packet_ring is None or callback is not None
+        try:
+            while not self.tcpdump_stop.is_set() and \
+                    (count == 0 or received < count):
+                frames = ring.read(timeout=TCPDUMP_STOP_POLL_INTERVAL,
+                                   copy=copy)
+                if count > 0:
+                    frames = frames[:count - received]
+                received += len(frames)
+                if len(frames) == 0:
+                    continue
+
+                if dump_writer is not None:
+                    for packet_data, timestamp, orig_len in frames:
+                        dump_writer.write(packet_data, timestamp, orig_len)
+                if self.packet_ring is not None:
+                    for packet_data, timestamp, _ in frames:
+                        self.packet_ring.write(packet_data, timestamp)
+                else:
+                    batch = [(packet_data, timestamp)
+                             for packet_data, timestamp, _ in frames]
+                    for i in range(0, len(batch), TCPDUMP_QUEUE_BATCH_SIZE):
+                        self.data_queue.put(
+                            batch[i:i + TCPDUMP_QUEUE_BATCH_SIZE])
+                if callback is not None:
+                    for packet_data, timestamp, _ in frames:
+                        callback(pcap_packet.PCAPPacket(packet_data,
+                                                        timestamp),
+                                 *(callback_args
+                                   if callback_args is not None else ()))
+            self.kernel_packets, self.kernel_drops = ring.statistics()
+            self.subprocess_info_queue.put(
+                {'success': '', 'packets': self.kernel_packets,
+                 'drops': self.kernel_drops})
+        except Exception as e:
+            self.subprocess_info_queue.put({'error': str(e)})
+            self.tcpdump_error.set()
+            raise
+        finally:
+            if dump_writer is not None:
+                dump_writer.close()
+            ring.close()
+            self.tcpdump_finished.set()
@@ -0,0 +1,242 @@
+import Queue
+import collections
+import threading
+import time
+
+from python_utils.common import exceptions
+from python_utils.net import pcap_file
+from python_utils.net import pcap_filter_cache
+from python_utils.net import pcap_rules
+from python_utils.net import tcp_dump
+from python_utils.shell.cli import LinuxCLI
+
+CAPTURE_SERVER_POLL_INTERVAL = 0.1
+CAPTURE_SERVER_RING_SIZE = 16 * 1024 * 1024
+
+
+class CaptureSubscription(object):
+    """
+    One subscriber's view of a CaptureServer's capture: the packets which
+    matched its predicate, in arrival order.
+    """
+
+    def __init__(self, server, predicate=None, max_queue=0):
+        """
+        :param server: CaptureServer
+        :param predicate: callable Called with each (parsed) PCAPPacket,
+        returning whether the subscriber wants it.  None takes every packet.
+        :param max_queue: int Most packets held for the subscriber (0 for
+        no limit).  Packets matched while the queue is full are dropped
+        and counted in 'dropped'.
+        """
+        self.server = server
+        self.predicate = predicate
+        self.queue = Queue.Queue(max_queue)
+        self.packet_buffer = collections.deque()
+        """ :type: collections.deque[PCAPPacket]"""
+        self.matched = 0
+        self.dropped = 0
+        self.errors = 0
+        """ :type: int Packets whose predicate (or delivery) raised"""
+        self.last_error = None
+        """ :type: Exception """
+
+    def deliver(self, packet):
+        """
+        Queue the packet if it matches the subscriber's predicate.
+        :type packet: PCAPPacket
+        """
+        if self.predicate is not None and not self.predicate(packet):
+            return
+        self.matched += 1
+        try:
+            self.queue.put_nowait(packet)
+        except Queue.Full:
+            self.dropped += 1
+
+    def wait_for_packets(self, count=1, timeout=None):
+        """
+        Return a list of <count> matched packets, blocking until they
+        arrive.  If they don't all arrive within timeout seconds (if
+        given), a SubprocessTimeoutException is raised, and the packets
+        which did arrive stay buffered for the next call.  A count of 0
+        returns whatever packets have already arrived.
+        :type count: int
+        :type timeout: float
+        :return: list[PCAPPacket]
+        """
+        if count == 0:
+            try:
+                while True:
+                    self.packet_buffer.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            count = len(self.packet_buffer)
+
+        deadline_time = time.time() + timeout if timeout is not None \
+            else None
+        while len(self.packet_buffer) < count:
+            remaining = deadline_time - time.time() \
+                if deadline_time is not None else None
+            if remaining is not None and remaining <= 0:
+                received = len(self.packet_buffer)
+                raise exceptions.SubprocessTimeoutException(
+                    (('Only ' + str(received) + '/')
+                     if received != 0 else '0/') +
+                    str(count) + ' packets received within timeout')
+            try:
+                self.packet_buffer.append(self.queue.get(timeout=remaining))
+            except Queue.Empty:
+                pass
+
+        return [self.packet_buffer.popleft() for _ in range(count)]
+
+    def iter_packets(self, timeout=None):
+        """
+        Yield matched packets as they arrive, stopping once none has
+        arrived for timeout seconds (if given).
+        :type timeout: float
+        :return: collections.Iterable[PCAPPacket]
+        """
+        while len(self.packet_buffer) > 0:
+            yield self.packet_buffer.popleft()
+        while True:
+            try:
+                yield self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                return
+
+    def close(self):
+        self.server.unsubscribe(self)
+
+
+class CaptureServer(object):
+    """
+    Runs a single long-lived capture on an interface and fans the
+    captured packets out to any number of subscribers, each with its own
+    filter predicate and queue.  Subscribers can come and go while the
+    capture runs, so tests watching several flows share one tcpdump
+    instead of starting one per filter.  Every packet is parsed (lazily)
+    once, before being offered to the subscribers.
+    """
+
+    def __init__(self, interface='any', cli=LinuxCLI(), pcap_filter=None,
+                 max_size=0, packet_ring_size=CAPTURE_SERVER_RING_SIZE):
+        """
+        :param interface: str
+        :param cli: LinuxCLI
+        :param pcap_filter: pcap_rules.Rule Filter applied by tcpdump
+        itself, before the subscribers' filters
+        :param max_size: int Snap length (0 for tcpdump's default)
+        :param packet_ring_size: int Size of the PacketRing used to hand
+        packets over from the capture process
+        """
+        self.interface = interface
+        self.cli = cli
+        self.pcap_filter = pcap_filter
+        self.max_size = max_size
+        self.packet_ring_size = packet_ring_size
+        # The 'any' pseudo-interface captures Linux cooked frames
+        self.link_layer = pcap_file.LINK_LAYER_CLASSES[
+            pcap_file.LINKTYPE_LINUX_SLL if interface == 'any'
+            else pcap_file.LINKTYPE_ETHERNET]
+
+        self.packets_dispatched = 0
+        self.tcpdump = None
+        """ :type: tcp_dump.TCPDump"""
+        # Replaced (never modified) under the lock, so the dispatch loop
+        # can iterate it without locking
+        self._subscriptions = ()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._dispatch_thread = None
+        """ :type: threading.Thread"""
+
+    def subscribe(self, predicate=None, max_queue=0):
+        """
+        Register a new subscriber, receiving every packet captured from
+        now on which matches the predicate.
+        :param predicate: callable | pcap_rules.Rule Called with each
+        (parsed) PCAPPacket, returning whether the subscriber wants it.  A
+        Rule is compiled (through the filter cache) into such a predicate.
+        None takes every packet.
+        :param max_queue: int Most packets held for the subscriber (0 for
+        no limit)
+        :return: CaptureSubscription
+        """
+        if isinstance(predicate, pcap_rules.Rule):
+            predicate = pcap_filter_cache.compile_predicate(predicate)
+        subscription = CaptureSubscription(self, predicate, max_queue)
+        with self._lock:
+            self._subscriptions += (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        :type subscription: CaptureSubscription
+        """
+        with self._lock:
+            self._subscriptions = tuple(
+                s for s in self._subscriptions if s is not subscription)
+
+    def dispatch(self, packet):
+        """
+        Parse a captured packet and offer it to every subscriber.  A packet
+        which can't be fully parsed (such as one cut short by the snap
+        length) is offered with whatever layers could be parsed, and a
+        subscriber whose predicate raises only has the error counted
+        against it, so neither stops the dispatch to the others.
+        :type packet: PCAPPacket
+        """
+        try:
+            packet.parse_layers([self.link_layer], lazy=True)
+        except exceptions.PacketParsingException:
+            # Match against whatever layers could be parsed
+            pass
+        self.packets_dispatched += 1
+        for subscription in self._subscriptions:
+            try:
+                subscription.deliver(packet)
+            except Exception as e:
+                subscription.errors += 1
+                subscription.last_error = e
+
+    def _dispatch_loop(self):
+        finished = self.tcpdump.tcpdump_finished
+        while not self._stop.is_set() and not finished.is_set():
+            for packet in self.tcpdump.iter_packets(
+                    timeout=CAPTURE_SERVER_POLL_INTERVAL):
+                self.dispatch(packet)
+                if self._stop.is_set():
+                    break
+
+    def start(self):
+        """
+        Start capturing, returning once the capture is live.
+        """
+        if self.tcpdump is not None:
+            raise exceptions.SubprocessFailedException(
+                'capture server already started')
+        self._stop.clear()
+        self.tcpdump = tcp_dump.TCPDump()
+        self.tcpdump.start_capture(
+            cli=self.cli, interface=self.interface,
+            pcap_filter=self.pcap_filter, max_size=self.max_size,
+            binary_capture=True, packet_ring_size=self.packet_ring_size)
+        self._dispatch_thread = threading.Thread(target=self._dispatch_loop)
+        self._dispatch_thread.daemon = True
+        self._dispatch_thread.start()
+
+    def stop(self):
+        """
+        Stop capturing.  Packets already captured are still dispatched.
+        """
+        if self.tcpdump is None:
+            return
+        self.tcpdump.stop_capture()
+        self._stop.set()
+        self._dispatch_thread.join()
+        for packet in self.tcpdump.wait_for_packets(count=0):
+            self.dispatch(packet)
+        self.tcpdump = None
+        self._dispatch_thread = None
@@ -0,0 +1,300 @@
+import collections
+import time
+
+from python_utils.net import pcap_packet
+
+DEFAULT_IDLE_TIMEOUT = 120.0
+DEFAULT_MAX_FLOWS = 65536
+# Most (direction, flags) entries kept per TCP flow
+FLAG_HISTORY_SIZE = 32
+
+FLOW_DIRECTION_FORWARD = 0
+FLOW_DIRECTION_REVERSE = 1
+
+FLOW_STATE_NEW = 'new'
+FLOW_STATE_SYN_SENT = 'syn_sent'
+FLOW_STATE_SYN_RECEIVED = 'syn_received'
+FLOW_STATE_ESTABLISHED = 'established'
+FLOW_STATE_CLOSING = 'closing'
+FLOW_STATE_CLOSED = 'closed'
+FLOW_STATE_RESET = 'reset'
+
+FlowKey = collections.namedtuple(
+    'FlowKey', ['protocol', 'source_ip', 'source_port', 'dest_ip',
+                'dest_port'])
+""" 5-tuple of a flow, oriented from the side which opened it. """
+
+
+def packet_time(packet):
+    """
+    Packets read from savefiles, rings and binary captures carry epoch
+    timestamps, but tcpdump's text output only gives a time of day, in
+    which case the packet is taken to have arrived now.
+    :type packet: pcap_packet.PCAPPacket
+    :return: float
+    """
+    try:
+        return float(packet.timestamp)
+    except (TypeError, ValueError):
+        return time.time()
+
+
+class Flow(object):
+    """
+    Statistics and TCP state of one flow, counted separately for each
+    direction (indexed by FLOW_DIRECTION_FORWARD/REVERSE, forward being
+    from the side which opened the flow).  Byte counts are of whole
+    frames.
+    """
+
+    __slots__ = ('key', 'first_seen', 'last_seen', 'packets', 'bytes',
+                 'tcp_flags', 'flag_history', 'state',
+                 'handshake_complete', '_fins')
+
+    def __init__(self, key, timestamp):
+        """
+        :type key: FlowKey
+        :type timestamp: float
+        """
+        self.key = key
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.packets = [0, 0]
+        """ :type: list[int] """
+        self.bytes = [0, 0]
+        """ :type: list[int] """
+        self.tcp_flags = [0, 0]
+        """ :type: list[int] Every flag seen, per direction"""
+        self.flag_history = collections.deque(maxlen=FLAG_HISTORY_SIZE)
+        """ :type: collections.deque[(int, int)] (direction, flags) of
+        the latest TCP segments"""
+        self.state = FLOW_STATE_NEW
+        """ :type: str """
+        self.handshake_complete = False
+        """ :type: bool Whether the opening SYN, SYN+ACK, ACK exchange
+        was seen (kept once the flow is closed or reset)"""
+        self._fins = [False, False]
+
+    @property
+    def packet_count(self):
+        return self.packets[0] + self.packets[1]
+
+    @property
+    def byte_count(self):
+        return self.bytes[0] + self.bytes[1]
+
+    @property
+    def duration(self):
+        return self.last_seen - self.first_seen
+
+    @property
+    def is_closed(self):
+        """
+        Whether both sides sent a FIN, or either sent a RST.
+        :return: bool
+        """
+        return self.state == FLOW_STATE_RESET or \
+            (self._fins[0] and self._fins[1])
+
+    def update(self, direction, size, timestamp, flags=None):
+        """
+        :type direction: int
+        :param size: int Bytes in the frame
+        :type timestamp: float
+        :param flags: int TCP flags of the segment (None if not TCP)
+        """
+        self.packets[direction] += 1
+        self.bytes[direction] += size
+        if timestamp > self.last_seen:
+            self.last_seen = timestamp
+        if flags is not None:
+            self.tcp_flags[direction] |= flags
+            self.flag_history.append((direction, flags))
+            self._track_state(direction, flags)
+
+    def _track_state(self, direction, flags):
+        syn = flags & pcap_packet.TCP_PROTOCOL_FLAG_SYN != 0
+        ack = flags & pcap_packet.TCP_PROTOCOL_FLAG_ACK != 0
+        if flags & pcap_packet.TCP_PROTOCOL_FLAG_RESET:
+            self.state = FLOW_STATE_RESET
+        elif self.state == FLOW_STATE_RESET:
+            return
+        elif syn:
+            if not ack and direction == FLOW_DIRECTION_FORWARD and \
+                    self.state == FLOW_STATE_NEW:
+                self.state = FLOW_STATE_SYN_SENT
+            elif ack and direction == FLOW_DIRECTION_REVERSE and \
+                    self.state == FLOW_STATE_SYN_SENT:
+                self.state = FLOW_STATE_SYN_RECEIVED
+        elif ack and direction == FLOW_DIRECTION_FORWARD and \
+                self.state == FLOW_STATE_SYN_RECEIVED:
+            self.state = FLOW_STATE_ESTABLISHED
+            self.handshake_complete = True
+
+        if flags & pcap_packet.TCP_PROTOCOL_FLAG_FINAL and \
+                self.state != FLOW_STATE_RESET:
+            self._fins[direction] = True
+            # Flows whose handshake wasn't seen keep their state, their
+            # FINs only count towards is_closed
+            if self.handshake_complete:
+                self.state = (FLOW_STATE_CLOSED
+                              if self._fins[0] and self._fins[1]
+                              else FLOW_STATE_CLOSING)
+
+    def to_str(self):
+        return 'flow[' + str(self.key.protocol) + ' ' + \
+               self.key.source_ip + ':' + str(self.key.source_port) + \
+               ' -> ' + self.key.dest_ip + ':' + \
+               str(self.key.dest_port) + '] state[' + self.state + \
+               '] pkts[' + str(self.packets) + '] bytes[' + \
+               str(self.bytes) + ']'
+
+    def __str__(self):
+        return self.to_str()
+
+    def __repr__(self):
+        return self.to_str()
+
+
+class FlowTable(object):
+    """
+    Table of TCP and UDP flows, updated incrementally from parsed packets
+    (PCAPIP4 with PCAPTCP/PCAPUDP layers).  Both directions of a flow map
+    to the same entry, so a flow is found in constant time from either
+    end's 5-tuple.  Flows are kept in order of their last packet: flows
+    idle for longer than idle_timeout (by packet time) are expired as new
+    packets arrive, and once max_flows are held, the least recently
+    active flow is evicted to make room.
+    """
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_flows=DEFAULT_MAX_FLOWS, expired_callback=None):
+        """
+        :param idle_timeout: float Seconds without a packet before a flow
+        is expired (0 never expires flows)
+        :param max_flows: int Most flows held (0 for no limit)
+        :param expired_callback: (Flow) -> None Called with each flow as
+        it is expired or evicted
+        """
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        self.expired_callback = expired_callback
+        self.expirations = 0
+        self.evictions = 0
+        self.latest_time = None
+        """ :type: float Timestamp of the latest packet added"""
+        self._flows = collections.OrderedDict()
+        """ :type: dict[FlowKey, Flow]"""
+
+    def __len__(self):
+        return len(self._flows)
+
+    def __iter__(self):
+        return iter(list(self._flows.values()))
+
+    @staticmethod
+    def _table_key(key):
+        # Either orientation of a 5-tuple gives the same table key
+        reverse = FlowKey(key.protocol, key.dest_ip, key.dest_port,
+                          key.source_ip, key.source_port)
+        return min(key, reverse)
+
+    def get(self, source_ip, source_port, dest_ip, dest_port,
+            protocol=pcap_packet.IP4_PROTOCOL_TCP):
+        """
+        Finds the flow between the given endpoints, in either direction.
+        :type source_ip: str
+        :type source_port: int
+        :type dest_ip: str
+        :type dest_port: int
+        :type protocol: int
+        :return: Flow
+        """
+        return self._flows.get(self._table_key(FlowKey(
+            protocol, source_ip, source_port, dest_ip, dest_port)))
+
+    def add(self, packet):
+        """
+        Counts a parsed packet against its flow, creating the flow if
+        needed.  Packets which aren't TCP or UDP over IP are ignored.
+        :type packet: pcap_packet.PCAPPacket
+        :return: Flow The packet's flow (None if ignored)
+        """
+        ip = packet.get_layer('ip')
+        if ip is None:
+            return None
+        transport = packet.get_layer('tcp')
+        if transport is None:
+            transport = packet.get_layer('udp')
+            if transport is None:
+                return None
+            flags = None
+        else:
+            flags = transport.flags
+
+        timestamp = packet_time(packet)
+        if self.latest_time is None or timestamp > self.latest_time:
+            self.latest_time = timestamp
+            self.expire()
+
+        key = FlowKey(ip.protocol, ip.source_ip, transport.source_port,
+                      ip.dest_ip, transport.dest_port)
+        table_key = self._table_key(key)
+        flow = self._flows.pop(table_key, None)
+        if flow is None:
+            if 0 < self.max_flows <= len(self._flows):
+                self._remove_oldest()
+                self.evictions += 1
+            # A SYN+ACK opening the flow (its SYN missed) comes from the
+            # side which didn't open it
+            if flags is not None and \
+                    flags & pcap_packet.TCP_PROTOCOL_FLAG_SYN and \
+                    flags & pcap_packet.TCP_PROTOCOL_FLAG_ACK:
+                key = FlowKey(key.protocol, key.dest_ip, key.dest_port,
+                              key.source_ip, key.source_port)
+            flow = Flow(key, timestamp)
+        # (Re)inserted at the most recently active end
+        self._flows[table_key] = flow
+
+        direction = (FLOW_DIRECTION_FORWARD
+                     if flow.key.source_ip == ip.source_ip and
+                     flow.key.source_port == transport.source_port
+                     else FLOW_DIRECTION_REVERSE)
+        flow.update(direction, len(packet.packet_data), timestamp, flags)
+        return flow
+
+    def add_packets(self, packets):
+        """
+        :type packets: collections.Iterable[pcap_packet.PCAPPacket]
+        """
+        for packet in packets:
+            self.add(packet)
+
+    def expire(self, now=None):
+        """
+        Removes the flows idle for longer than the idle timeout.
+        :param now: float Current time (default is the timestamp of the
+        latest packet added)
+        :return: int Number of flows expired
+        """
+        now = self.latest_time if now is None else now
+        if self.idle_timeout <= 0 or now is None:
+            return 0
+        expired = 0
+        while len(self._flows) > 0:
+            oldest = next(iter(self._flows.values()))
+            if now - oldest.last_seen <= self.idle_timeout:
+                break
+            self._remove_oldest()
+            expired += 1
+        self.expirations += expired
+        return expired
+
+    def _remove_oldest(self):
+        flow = self._flows.popitem(last=False)[1]
+        if self.expired_callback is not None:
+            self.expired_callback(flow)
+
+    def clear(self):
+        self._flows.clear()
+        self.latest_time = None
@@ -0,0 +1,243 @@
+import collections
+import struct
+
+from python_utils.net import flow_table
+from python_utils.net import pcap_packet
+
+# Seconds a datagram's fragments are held waiting for the rest
+DEFAULT_TIMEOUT = 30.0
+# Most fragment data held across all datagrams
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+MAX_DATAGRAM_SIZE = 65535
+
+IP4_TOTAL_LENGTH_OFFSET = 2
+IP4_FLAGS_FRAGMENT_OFFSET = 6
+IP4_CHECKSUM_OFFSET = 10
+
+FragmentKey = collections.namedtuple(
+    'FragmentKey', ['source_ip', 'dest_ip', 'protocol', 'id'])
+""" Fields shared by every fragment of a datagram. """
+
+
+def ip_checksum(header):
+    """
+    Internet checksum of an IP header (with its checksum field zeroed).
+    :type header: bytes | bytearray
+    :return: int
+    """
+    header = bytearray(header)
+    if len(header) % 2 != 0:
+        header.append(0)
+    total = sum(struct.unpack('!' + str(len(header) // 2) + 'H',
+                              bytes(header)))
+    while total > 0xffff:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def _data_bytes(data):
+    """
+    :type data: bytes | bytearray | memoryview | list[int]
+    :return: bytes
+    """
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(bytearray(data)) if isinstance(data, list) else bytes(data)
+
+
+class _Datagram(object):
+    """
+    Fragments of one datagram, by their offset (in bytes) in its payload.
+    """
+
+    __slots__ = ('first_seen', 'fragments', 'size', 'total', 'header',
+                 'ip_offset', 'link_class')
+
+    def __init__(self, timestamp):
+        self.first_seen = timestamp
+        self.fragments = {}
+        """ :type: dict[int, bytes]"""
+        self.size = 0
+        self.total = None
+        """ :type: int Payload length, known once the last fragment is in"""
+        self.header = None
+        """ :type: bytearray Link and IP headers of the first fragment"""
+        self.ip_offset = 0
+        self.link_class = None
+
+    def add(self, offset, data, last):
+        existing = self.fragments.get(offset)
+        if existing is not None:
+            self.size -= len(existing)
+        self.fragments[offset] = data
+        self.size += len(data)
+        if last:
+            self.total = offset + len(data)
+
+    def complete(self):
+        if self.total is None or self.header is None:
+            return False
+        end = 0
+        for offset in sorted(self.fragments):
+            if offset > end:
+                return False
+            end = max(end, offset + len(self.fragments[offset]))
+        return end >= self.total
+
+    def payload(self):
+        data = bytearray(self.total)
+        for offset in sorted(self.fragments):
+            fragment = self.fragments[offset][:self.total - offset]
+            data[offset:offset + len(fragment)] = fragment
+        return bytes(data)
+
+
+class IPReassembler(object):
+    """
+    Puts fragmented IPv4 datagrams back together.  Fragments are held by
+    (source, dest, protocol, id) until every part of the datagram has
+    arrived, and the whole datagram is then rebuilt behind the first
+    fragment's link and IP headers (with the length, fragment fields and
+    checksum fixed up) and parsed like a captured packet, so its
+    PCAPTCP/PCAPUDP/PCAPICMP layer is decoded as usual.  Datagrams still
+    incomplete timeout seconds (by packet time) after their first
+    fragment are dropped, as is the oldest datagram whenever holding a
+    fragment would take the reassembler past max_bytes.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_bytes=DEFAULT_MAX_BYTES,
+                 lazy=False):
+        """
+        :type timeout: float
+        :param max_bytes: int Most fragment data held
+        :param lazy: bool Parse reassembled datagrams lazily (see
+        PCAPPacket.parse)
+        """
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.lazy = lazy
+        self.buffered = 0
+        self.reassembled = 0
+        self.expired = 0
+        self.dropped = 0
+        self.latest_time = None
+        """ :type: float Timestamp of the latest packet added"""
+        self._datagrams = collections.OrderedDict()
+        """ :type: dict[FragmentKey, _Datagram]"""
+
+    def __len__(self):
+        return len(self._datagrams)
+
+    def add(self, packet):
+        """
+        Adds a parsed packet.  Packets which aren't IP fragments are
+        returned as they are, and fragments are held until the datagram
+        they complete is returned.
+        :type packet: pcap_packet.PCAPPacket
+        :return: pcap_packet.PCAPPacket The packet, the reassembled
+        datagram, or None if the datagram is still incomplete
+        """
+        ip = packet.get_layer('ip')
+        if ip is None or not ip.is_fragment():
+            return packet
+
+        timestamp = flow_table.packet_time(packet)
+        if self.latest_time is None or timestamp > self.latest_time:
+            self.latest_time = timestamp
+            self.expire()
+
+        end = min(ip.layer_end, ip.layer_offset + ip.total_length)
+        data = _data_bytes(packet.packet_data[ip.payload_offset:end])
+        offset = ip.fragment_offset * 8
+        if offset + len(data) > MAX_DATAGRAM_SIZE - ip.header_length * 4:
+            self.dropped += 1
+            return None
+
+        key = FragmentKey(ip.source_ip, ip.dest_ip, ip.protocol, ip.id)
+        datagram = self._datagrams.get(key)
+        if datagram is None:
+            datagram = _Datagram(timestamp)
+            self._datagrams[key] = datagram
+        # Make room by dropping the oldest of the other datagrams
+        for other in list(self._datagrams):
+            if self.buffered + len(data) <= self.max_bytes:
+                break
+            if other != key:
+                self._remove(other)
+                self.dropped += 1
+        if self.buffered + len(data) > self.max_bytes:
+            self._remove(key)
+            self.dropped += 1
+            return None
+
+        size = datagram.size
+        datagram.add(offset, data,
+                     not ip.is_flag_set(pcap_packet.IP4_FLAG_MORE_FRAGMENTS))
+        self.buffered += datagram.size - size
+        if offset == 0:
+            datagram.header = bytearray(_data_bytes(
+                packet.packet_data[:ip.payload_offset]))
+            datagram.ip_offset = ip.layer_offset
+            link_layer = packet.get_layer('ethernet')
+            datagram.link_class = (pcap_packet.PCAPIP4 if link_layer is None
+                                   else type(link_layer))
+
+        if not datagram.complete():
+            return None
+        self._remove(key)
+        self.reassembled += 1
+        return self._rebuild(datagram, packet.timestamp)
+
+    def reassemble(self, packets):
+        """
+        Yields the packets with fragments replaced by their reassembled
+        datagrams (each at the place of its last fragment).
+        :type packets: collections.Iterable[pcap_packet.PCAPPacket]
+        :return: collections.Iterable[pcap_packet.PCAPPacket]
+        """
+        for packet in packets:
+            packet = self.add(packet)
+            if packet is not None:
+                yield packet
+
+    def expire(self, now=None):
+        """
+        Drops the datagrams whose first fragment arrived more than the
+        timeout ago.
+        :param now: float Current time (default is the timestamp of the
+        latest packet added)
+        :return: int Number of datagrams dropped
+        """
+        now = self.latest_time if now is None else now
+        if now is None:
+            return 0
+        expired = [key for key, datagram in self._datagrams.items()
+                   if now - datagram.first_seen > self.timeout]
+        for key in expired:
+            self._remove(key)
+        self.expired += len(expired)
+        return len(expired)
+
+    def _remove(self, key):
+        self.buffered -= self._datagrams.pop(key).size
+
+    def _rebuild(self, datagram, timestamp):
+        header = datagram.header
+        ip_offset = datagram.ip_offset
+        payload = datagram.payload()
+        ip_header_length = len(header) - ip_offset
+        # Only the don't fragment flag is kept
+        flags = struct.unpack_from('!H', bytes(header),
+                                   ip_offset + IP4_FLAGS_FRAGMENT_OFFSET)[0]
+        struct.pack_into('!H', header, ip_offset + IP4_TOTAL_LENGTH_OFFSET,
+                         ip_header_length + len(payload))
+        struct.pack_into('!H', header,
+                         ip_offset + IP4_FLAGS_FRAGMENT_OFFSET,
+                         flags & (pcap_packet.IP4_FLAG_DONT_FRAGMENT << 13))
+        struct.pack_into('!H', header, ip_offset + IP4_CHECKSUM_OFFSET, 0)
+        struct.pack_into('!H', header, ip_offset + IP4_CHECKSUM_OFFSET,
+                         ip_checksum(header[ip_offset:]))
+
+        packet = pcap_packet.PCAPPacket(bytes(header) + payload, timestamp)
+        packet.parse_layers([datagram.link_class], lazy=self.lazy)
+        return packet
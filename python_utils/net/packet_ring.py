@@ -0,0 +1,193 @@
+import mmap
+import multiprocessing
+import struct
+import time
+
+from python_utils.common import exceptions
+from python_utils.net import pcap_packet
+
+DEFAULT_RING_SIZE = 16 * 1024 * 1024
+
+# Ring header: producer-owned counters in the first cache line, consumer
+# owned ones in the second, so each side only ever writes its own line.
+WRITE_POS_OFFSET = 0
+PACKETS_WRITTEN_OFFSET = 8
+PACKETS_DROPPED_OFFSET = 16
+BYTES_DROPPED_OFFSET = 24
+READ_POS_OFFSET = 64
+PACKETS_READ_OFFSET = 72
+READER_WAITING_OFFSET = 80
+RING_HEADER_SIZE = 128
+
+COUNTER = struct.Struct('<Q')
+# Record: frame length, then timestamp, then the frame (padded to 8 bytes)
+RECORD_HEADER = struct.Struct('<I4xd')
+RECORD_WRAP = 0xffffffff
+
+# Longest a blocked reader sleeps before checking the ring again, bounding
+# the delay of a wakeup lost to the producer racing the reader going to
+# sleep.
+READ_WAKEUP_INTERVAL = 0.01
+
+
+def _record_size(length):
+    return (RECORD_HEADER.size + length + 7) & ~7
+
+
+class PacketRing(object):
+    """
+    Single-producer/single-consumer ring of raw frames and timestamps in
+    shared memory, for handing captured packets from a capture process
+    to the process reading them without pickling or a syscall per packet.
+    The ring is an anonymous shared mmap, so it must be created before
+    the producer process is forked from the consumer.
+
+    Each side only advances its own position in the ring header, so no
+    lock is taken on either path.  A packet which doesn't fit in the free
+    space is dropped (and counted) rather than blocking the producer.
+    Readers can block with a timeout until packets arrive, and are only
+    woken (through an Event) while they flag themselves as waiting.
+    """
+
+    def __init__(self, size=DEFAULT_RING_SIZE):
+        """
+        :param size: int Bytes of frame data (plus 16 bytes of header per
+        frame) the ring holds
+        """
+        if size < RECORD_HEADER.size * 2 or size % 8 != 0:
+            raise exceptions.ArgMismatchException(
+                'Packet ring size must be a multiple of 8, and at least ' +
+                str(RECORD_HEADER.size * 2) + ' bytes')
+        self.size = size
+        self._map = mmap.mmap(-1, RING_HEADER_SIZE + size)
+        self._data_ready = multiprocessing.Event()
+        # Positions only grow, so they are kept locally by the side which
+        # owns them and just published to the header.
+        self._write_pos = 0
+        self._read_pos = 0
+
+    def _get(self, offset):
+        return COUNTER.unpack_from(self._map, offset)[0]
+
+    def _add(self, offset, value):
+        COUNTER.pack_into(self._map, offset, self._get(offset) + value)
+
+    @property
+    def packets_written(self):
+        return self._get(PACKETS_WRITTEN_OFFSET)
+
+    @property
+    def packets_dropped(self):
+        return self._get(PACKETS_DROPPED_OFFSET)
+
+    @property
+    def bytes_dropped(self):
+        return self._get(BYTES_DROPPED_OFFSET)
+
+    @property
+    def packets_read(self):
+        return self._get(PACKETS_READ_OFFSET)
+
+    @property
+    def used_bytes(self):
+        return self._get(WRITE_POS_OFFSET) - self._get(READ_POS_OFFSET)
+
+    def write(self, packet_data, timestamp):
+        """
+        Add a frame to the ring (producer side).  Returns False if there
+        wasn't room, in which case the frame is dropped and counted.
+        :type packet_data: bytes | bytearray | memoryview | list[int]
+        :type timestamp: float
+        :return: bool
+        """
+        length = len(packet_data)
+        record_size = _record_size(length)
+        index = self._write_pos % self.size
+        skip = self.size - index if index + record_size > self.size else 0
+
+        free = self.size - (self._write_pos - self._get(READ_POS_OFFSET))
+        if skip + record_size > free:
+            self._add(PACKETS_DROPPED_OFFSET, 1)
+            self._add(BYTES_DROPPED_OFFSET, length)
+            return False
+
+        if skip > 0:
+            # Not enough room before the end, continue at the start
+            struct.pack_into('<I', self._map, RING_HEADER_SIZE + index,
+                             RECORD_WRAP)
+            index = 0
+        start = RING_HEADER_SIZE + index
+        RECORD_HEADER.pack_into(self._map, start, length, timestamp)
+        start += RECORD_HEADER.size
+        if isinstance(packet_data, memoryview):
+            packet_data = packet_data.tobytes()
+        elif not isinstance(packet_data, bytes):
+            packet_data = bytes(bytearray(packet_data))
+        self._map[start:start + length] = packet_data
+
+        # Publish the record only once it is completely written
+        self._write_pos += skip + record_size
+        COUNTER.pack_into(self._map, WRITE_POS_OFFSET, self._write_pos)
+        self._add(PACKETS_WRITTEN_OFFSET, 1)
+        if self._get(READER_WAITING_OFFSET):
+            self._data_ready.set()
+        return True
+
+    def read(self, max_packets=0, timeout=0):
+        """
+        Take frames from the ring (consumer side) as a list of
+        (frame, timestamp) tuples.  If the ring is empty, block for up to
+        timeout seconds (forever if None) for frames to arrive, returning
+        an empty list if none do.
+        :param max_packets: int Most frames to return (0 for all waiting)
+        :param timeout: float
+        :return: list[(bytes, float)]
+        """
+        deadline_time = time.time() + timeout if timeout is not None \
+            else None
+        write_pos = self._get(WRITE_POS_OFFSET)
+        while write_pos == self._read_pos:
+            remaining = deadline_time - time.time() \
+                if deadline_time is not None else READ_WAKEUP_INTERVAL
+            if remaining <= 0:
+                return []
+
+            # Flag we're waiting and check again before sleeping, so a
+            # write after the check wakes us
+            self._data_ready.clear()
+            COUNTER.pack_into(self._map, READER_WAITING_OFFSET, 1)
+            write_pos = self._get(WRITE_POS_OFFSET)
+            if write_pos == self._read_pos:
+                self._data_ready.wait(min(remaining, READ_WAKEUP_INTERVAL))
+                write_pos = self._get(WRITE_POS_OFFSET)
+            COUNTER.pack_into(self._map, READER_WAITING_OFFSET, 0)
+
+        ret = []
+        while self._read_pos < write_pos and \
+                (max_packets == 0 or len(ret) < max_packets):
+            index = self._read_pos % self.size
+            start = RING_HEADER_SIZE + index
+            if struct.unpack_from('<I', self._map, start)[0] == RECORD_WRAP:
+                self._read_pos += self.size - index
+                continue
+            length, timestamp = RECORD_HEADER.unpack_from(self._map, start)
+            start += RECORD_HEADER.size
+            ret.append((self._map[start:start + length], timestamp))
+            self._read_pos += _record_size(length)
+
+        COUNTER.pack_into(self._map, READ_POS_OFFSET, self._read_pos)
+        self._add(PACKETS_READ_OFFSET, len(ret))
+        return ret
+
+    def read_packets(self, max_packets=0, timeout=0):
+        """
+        Same as read, but returns the frames as PCAPPackets.
+        :type max_packets: int
+        :type timeout: float
+        :return: list[PCAPPacket]
+        """
+        return [pcap_packet.PCAPPacket(packet_data, timestamp)
+                for packet_data, timestamp in self.read(max_packets, timeout)]
+
+    def close(self):
+        self._map.close()
@@ -0,0 +1,206 @@
+import numpy
+from numpy.lib import stride_tricks
+
+from python_utils.common import exceptions
+from python_utils.net import pcap_packet
+
+# Big-endian structured views of the fixed headers decoded in a batch.
+# Field layouts match the PCAPEthernet/PCAPSLL/PCAPIP4/PCAPTCP/PCAPUDP
+# layer decoders.
+ETHERNET_DTYPE = numpy.dtype([('dest_mac', 'u1', (6,)),
+                              ('source_mac', 'u1', (6,)),
+                              ('type', '>u2')])
+SLL_DTYPE = numpy.dtype([('info', 'u1', (6,)),
+                         ('source_mac', 'u1', (6,)),
+                         ('padding', '>u2'),
+                         ('type', '>u2')])
+IP4_DTYPE = numpy.dtype([('version_length', 'u1'),
+                         ('tos', 'u1'),
+                         ('total_length', '>u2'),
+                         ('id', '>u2'),
+                         ('flags_fragment', '>u2'),
+                         ('ttl', 'u1'),
+                         ('protocol', 'u1'),
+                         ('checksum', '>u2'),
+                         ('source_ip', '>u4'),
+                         ('dest_ip', '>u4')])
+TCP_DTYPE = numpy.dtype([('source_port', '>u2'),
+                         ('dest_port', '>u2'),
+                         ('seq', '>u4'),
+                         ('ack', '>u4'),
+                         ('offset_ns', 'u1'),
+                         ('flags', 'u1'),
+                         ('window_size', '>u2'),
+                         ('checksum', '>u2'),
+                         ('urgent', '>u2')])
+UDP_DTYPE = numpy.dtype([('source_port', '>u2'),
+                         ('dest_port', '>u2'),
+                         ('length', '>u2'),
+                         ('checksum', '>u2')])
+
+LINK_LAYER_DTYPES = {pcap_packet.PCAPEthernet: ETHERNET_DTYPE,
+                     pcap_packet.PCAPSLL: SLL_DTYPE}
+
+# Largest header window needed per frame: link header, an IP header with
+# the maximum amount of options, and a TCP header without options.
+HEADER_WINDOW = SLL_DTYPE.itemsize + 60 + TCP_DTYPE.itemsize
+
+
+def _byte_windows(data, width):
+    """
+    Returns a read-only (len(data) - width + 1, width) view of a uint8
+    array where row 'i' is the window of 'width' bytes starting at 'i'.
+    No data is copied.
+    :type data: numpy.ndarray
+    :type width: int
+    :return: numpy.ndarray
+    """
+    return stride_tricks.as_strided(
+        data, shape=(max(len(data) - width + 1, 0), width),
+        strides=(1, 1), writeable=False)
+
+
+def _header_view(rows, start, dtype):
+    """
+    Views 'dtype.itemsize' columns of the header rows, starting at the
+    'start' column (either an int or a per-row array), as structured
+    records (one per row).
+    :type rows: numpy.ndarray
+    :type start: int | numpy.ndarray
+    :type dtype: numpy.dtype
+    :return: numpy.ndarray
+    """
+    if isinstance(start, numpy.ndarray):
+        windows = _byte_windows(rows.reshape(-1), dtype.itemsize)
+        window = windows[numpy.arange(rows.shape[0]) * rows.shape[1] + start]
+    else:
+        window = numpy.ascontiguousarray(
+            rows[:, start:start + dtype.itemsize])
+    return window.view(dtype).reshape(-1)
+
+
+def decode_header_columns(frames, link_layer=pcap_packet.PCAPEthernet):
+    """
+    Decodes the headers of many raw frames at once into columns of NumPy
+    arrays (one entry per frame).  The frames (bytes-like objects, lists
+    of ints, or PCAPPackets) are copied into one contiguous buffer first.
+    See decode_buffer_columns for the returned columns.
+    :type frames: list[bytes | bytearray | list[int] | PCAPPacket]
+    :type link_layer: class
+    :return: dict[str, numpy.ndarray]
+    """
+    data = [f.packet_data if isinstance(f, pcap_packet.PCAPPacket) else f
+            for f in frames]
+    lengths = numpy.fromiter((len(f) for f in data), dtype=numpy.int64,
+                             count=len(data))
+    offsets = numpy.zeros(len(data), dtype=numpy.int64)
+    numpy.cumsum(lengths[:-1], out=offsets[1:])
+
+    buffer_data = bytearray(int(lengths.sum()))
+    for frame, offset, length in zip(data, offsets, lengths):
+        buffer_data[offset:offset + length] = frame
+    return decode_buffer_columns(buffer_data, offsets, lengths,
+                                 link_layer=link_layer)
+
+
+def decode_buffer_columns(buffer_data, offsets, lengths,
+                          link_layer=pcap_packet.PCAPEthernet):
+    """
+    Decodes the headers of frames stored back to back in one contiguous
+    buffer, with each frame given by its offset and length in the buffer.
+    Only a fixed window of header bytes is gathered per frame, and each
+    header is then decoded for every frame at once through a structured
+    dtype.  Layers are dispatched like PCAPPacket.parse does:
+    link_layer (PCAPEthernet or PCAPSLL) -> PCAPIP4 -> PCAPTCP/PCAPUDP.
+
+    The returned columns are:
+    length, ethertype, ip_source, ip_dest (uint32), ip_length, protocol,
+    source_port, dest_port, tcp_flags, seq, ack, plus the is_ip, is_tcp
+    and is_udp masks.  Fields of layers a frame doesn't carry are 0 (IP
+    fragments past the first carry no TCP or UDP header).
+    :type buffer_data: bytes | bytearray | memoryview | numpy.ndarray
+    :type offsets: list[int] | numpy.ndarray
+    :type lengths: list[int] | numpy.ndarray
+    :type link_layer: class
+    :return: dict[str, numpy.ndarray]
+    """
+    if link_layer not in LINK_LAYER_DTYPES:
+        raise exceptions.ArgMismatchException(
+            'Link layer for batch decoding must be one of: ' +
+            ', '.join(c.__name__ for c in LINK_LAYER_DTYPES))
+    link_dtype = LINK_LAYER_DTYPES[link_layer]
+    link_size = link_dtype.itemsize
+
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    lengths = numpy.asarray(lengths, dtype=numpy.int64)
+    count = len(offsets)
+
+    # Gather a fixed window of header bytes per frame, zeroing anything
+    # past the end of each frame.  Frames too close to the end of the
+    # buffer for a full window are gathered from a zero-padded copy of
+    # just the buffer's tail.
+    rows = numpy.zeros((count, HEADER_WINDOW), dtype=numpy.uint8)
+    if count > 0 and len(buffer_data) > 0:
+        buf = numpy.frombuffer(buffer_data, dtype=numpy.uint8)
+        full = offsets + HEADER_WINDOW <= len(buf)
+        rows[full] = _byte_windows(buf, HEADER_WINDOW)[offsets[full]]
+
+        tail_start = max(len(buf) - HEADER_WINDOW, 0)
+        tail = numpy.zeros(2 * HEADER_WINDOW, dtype=numpy.uint8)
+        tail[:len(buf) - tail_start] = buf[tail_start:]
+        rows[~full] = _byte_windows(tail, HEADER_WINDOW)[
+            offsets[~full] - tail_start]
+        rows[numpy.arange(HEADER_WINDOW) >= lengths[:, None]] = 0
+
+    link = _header_view(rows, 0, link_dtype)
+    is_link = lengths >= link_size
+    ethertype = numpy.where(is_link, link['type'], 0)
+
+    ip = _header_view(rows, link_size, IP4_DTYPE)
+    version = ip['version_length'] >> 4
+    header_length = (ip['version_length'] & 0x0f).astype(numpy.int64)
+    is_ip = (is_link &
+             (ethertype == pcap_packet.ETHERNET_PROTOCOL_TYPE_IP4) &
+             (lengths - link_size >= IP4_DTYPE.itemsize) &
+             ((version == 4) | (version == 6)) &
+             (header_length >= 5) &
+             (lengths - link_size >= header_length * 4))
+    protocol = numpy.where(is_ip, ip['protocol'], 0)
+    # Only the first fragment of a datagram carries the transport header
+    is_first_fragment = (ip['flags_fragment'] & 0x1fff) == 0
+
+    l4_offset = link_size + (numpy.maximum(header_length, 5) * 4)
+    l4_length = lengths - l4_offset
+    tcp = _header_view(rows, l4_offset, TCP_DTYPE)
+    is_tcp = (is_ip & is_first_fragment &
+              (protocol == pcap_packet.IP4_PROTOCOL_TCP) &
+              (l4_length >= TCP_DTYPE.itemsize) &
+              ((tcp['offset_ns'] >> 4) >= 5))
+    is_udp = (is_ip & is_first_fragment &
+              (protocol == pcap_packet.IP4_PROTOCOL_UDP) &
+              (l4_length >= UDP_DTYPE.itemsize))
+    is_ports = is_tcp | is_udp
+
+    # UDP's ports sit at the same place as TCP's
+    return {'length': lengths,
+            'ethertype': ethertype.astype(numpy.uint16),
+            'ip_source': numpy.where(is_ip, ip['source_ip'],
+                                     0).astype(numpy.uint32),
+            'ip_dest': numpy.where(is_ip, ip['dest_ip'],
+                                   0).astype(numpy.uint32),
+            'ip_length': numpy.where(is_ip, ip['total_length'],
+                                     0).astype(numpy.uint16),
+            'protocol': protocol.astype(numpy.uint8),
+            'source_port': numpy.where(is_ports, tcp['source_port'],
+                                       0).astype(numpy.uint16),
+            'dest_port': numpy.where(is_ports, tcp['dest_port'],
+                                     0).astype(numpy.uint16),
+            'tcp_flags': numpy.where(
+                is_tcp,
+                ((tcp['offset_ns'].astype(numpy.uint16) & 0x1) << 8) |
+                tcp['flags'], 0).astype(numpy.uint16),
+            'seq': numpy.where(is_tcp, tcp['seq'], 0).astype(numpy.uint32),
+            'ack': numpy.where(is_tcp, tcp['ack'], 0).astype(numpy.uint32),
+            'is_ip': is_ip,
+            'is_tcp': is_tcp,
+            'is_udp': is_udp}
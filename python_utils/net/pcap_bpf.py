@@ -0,0 +1,695 @@
+import collections
+import ctypes
+import os
+import socket
+import struct
+
+from python_utils.common.exceptions import *
+from python_utils.net import pcap_file
+from python_utils.net import pcap_packet
+from python_utils.net import pcap_rules
+
+# Classic BPF instruction classes, sizes, modes and operations (see
+# linux/filter.h)
+BPF_LD = 0x00
+BPF_LDX = 0x01
+BPF_ST = 0x02
+BPF_STX = 0x03
+BPF_ALU = 0x04
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_MISC = 0x07
+
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+
+BPF_IMM = 0x00
+BPF_ABS = 0x20
+BPF_IND = 0x40
+BPF_MEM = 0x60
+BPF_LEN = 0x80
+BPF_MSH = 0xa0
+
+BPF_ADD = 0x00
+BPF_SUB = 0x10
+BPF_MUL = 0x20
+BPF_DIV = 0x30
+BPF_OR = 0x40
+BPF_AND = 0x50
+BPF_LSH = 0x60
+BPF_RSH = 0x70
+BPF_NEG = 0x80
+BPF_MOD = 0x90
+
+BPF_JA = 0x00
+BPF_JEQ = 0x10
+BPF_JGT = 0x20
+BPF_JGE = 0x30
+BPF_JSET = 0x40
+
+BPF_K = 0x00
+BPF_X = 0x08
+BPF_A = 0x10
+
+BPF_TAX = 0x00
+BPF_TXA = 0x80
+
+BPF_MEMWORDS = 16
+BPF_MAXINSNS = 4096
+
+SO_ATTACH_FILTER = 26
+SO_DETACH_FILTER = 27
+ETH_P_ALL = 0x0003
+
+LOAD_SIZES = {4: BPF_W, 2: BPF_H, 1: BPF_B}
+ALU_OPERATIONS = {'+': BPF_ADD, '-': BPF_SUB, '*': BPF_MUL, '/': BPF_DIV,
+                  '%': BPF_MOD, '|': BPF_OR, '&': BPF_AND, '<<': BPF_LSH,
+                  '>>': BPF_RSH}
+# Jump and whether its targets are swapped, for each comparison
+COMPARISON_JUMPS = {'=': (BPF_JEQ, False), '==': (BPF_JEQ, False),
+                    '!=': (BPF_JEQ, True), '>': (BPF_JGT, False),
+                    '>=': (BPF_JGE, False), '<': (BPF_JGE, True),
+                    '<=': (BPF_JGT, True)}
+
+# Offset of the kernel's ancillary data in loads, and of the frame's
+# protocol (its ether type) in that data (see linux/filter.h)
+SKF_AD_OFF = -0x1000
+SKF_AD_PROTOCOL = 0
+# Pseudo link type of the frames read from a SOCK_DGRAM AF_PACKET socket
+# (as libpcap reads 'any'): they start at the network header, and their
+# ether type is only known to the kernel, as ancillary data.  Programs
+# compiled for it can only be run by the kernel.
+LINKTYPE_COOKED_SOCKET = -1
+
+# Offsets of the ether type and the network header for each link type
+LINK_LAYER_OFFSETS = {pcap_file.LINKTYPE_ETHERNET: (12, 14),
+                      pcap_file.LINKTYPE_LINUX_SLL: (14, 16),
+                      LINKTYPE_COOKED_SOCKET:
+                          ((SKF_AD_OFF + SKF_AD_PROTOCOL) & 0xffffffff, 0)}
+
+IP_FRAGMENT_OFFSET_MASK = 0x1fff
+BROADCAST_IP = 0xffffffff
+
+BPFInstruction = collections.namedtuple('BPFInstruction',
+                                        ['code', 'jt', 'jf', 'k'])
+# struct sock_filter
+BPF_INSTRUCTION = struct.Struct('HBBI')
+
+
+class BPFProgram(object):
+    """
+    A classic BPF program, as compiled from a pcap_rules Rule by
+    compile_rule.  It can be attached to a socket so the kernel filters
+    packets before copying them to userspace, or run in Python against a
+    frame (mainly to test the compiler).
+    """
+
+    def __init__(self, instructions):
+        """
+        :type instructions: list[BPFInstruction]
+        """
+        self.instructions = instructions
+
+    def __len__(self):
+        return len(self.instructions)
+
+    def pack(self):
+        """
+        The program as an array of struct sock_filter.
+        :return: bytes
+        """
+        return b''.join(BPF_INSTRUCTION.pack(*i) for i in self.instructions)
+
+    def run(self, packet_data):
+        """
+        Run the program against a frame, as the kernel does, returning how
+        many bytes of the frame to accept (0 to drop it).  Like the kernel,
+        a load past the end of the frame or a division by zero drops the
+        frame, whatever the rest of the program would have done.
+        :type packet_data: bytes | bytearray | list[int]
+        :return: int
+        """
+        data = bytearray(packet_data)
+        a = x = 0
+        mem = [0] * BPF_MEMWORDS
+        pc = 0
+        while True:
+            code, jt, jf, k = self.instructions[pc]
+            pc += 1
+            cls = code & 0x07
+            if cls == BPF_RET:
+                return a if code & 0x18 == BPF_A else k
+            elif cls in (BPF_LD, BPF_LDX):
+                mode = code & 0xe0
+                if mode == BPF_IMM:
+                    value = k
+                elif mode == BPF_LEN:
+                    value = len(data)
+                elif mode == BPF_MEM:
+                    value = mem[k]
+                elif mode == BPF_MSH:
+                    if k >= len(data):
+                        return 0
+                    value = (data[k] & 0xf) << 2
+                else:
+                    size = {BPF_W: 4, BPF_H: 2, BPF_B: 1}[code & 0x18]
+                    start = k + (x if mode == BPF_IND else 0)
+                    if start + size > len(data):
+                        return 0
+                    value = 0
+                    for byte in data[start:start + size]:
+                        value = (value << 8) | byte
+                if cls == BPF_LD:
+                    a = value
+                else:
+                    x = value
+            elif cls == BPF_ST:
+                mem[k] = a
+            elif cls == BPF_STX:
+                mem[k] = x
+            elif cls == BPF_ALU:
+                op = code & 0xf0
+                operand = x if code & BPF_X else k
+                if op == BPF_NEG:
+                    a = -a
+                elif op in (BPF_DIV, BPF_MOD) and operand == 0:
+                    return 0
+                elif op == BPF_ADD:
+                    a += operand
+                elif op == BPF_SUB:
+                    a -= operand
+                elif op == BPF_MUL:
+                    a *= operand
+                elif op == BPF_DIV:
+                    a //= operand
+                elif op == BPF_MOD:
+                    a %= operand
+                elif op == BPF_OR:
+                    a |= operand
+                elif op == BPF_AND:
+                    a &= operand
+                elif op == BPF_LSH:
+                    a <<= operand
+                elif op == BPF_RSH:
+                    a >>= operand
+                a &= 0xffffffff
+            elif cls == BPF_JMP:
+                op = code & 0xf0
+                operand = x if code & BPF_X else k
+                if op == BPF_JA:
+                    pc += k
+                    continue
+                if op == BPF_JEQ:
+                    taken = a == operand
+                elif op == BPF_JGT:
+                    taken = a > operand
+                elif op == BPF_JGE:
+                    taken = a >= operand
+                else:
+                    taken = a & operand != 0
+                pc += jt if taken else jf
+            else:
+                if code & 0xf8 == BPF_TXA:
+                    a = x
+                else:
+                    x = a
+
+    def matches(self, packet_data):
+        """
+        :type packet_data: bytes | bytearray | list[int]
+        :return: bool
+        """
+        return self.run(packet_data) != 0
+
+    def attach(self, sock):
+        """
+        :type sock: socket.socket
+        """
+        attach_filter(sock, self)
+
+
+class _Label(object):
+    """
+    Jump target in a program being compiled, placed once the code before
+    it has been emitted.
+    """
+
+    def __init__(self):
+        self.position = None
+
+
+class _BPFCompiler(object):
+    """
+    Generates the instructions for a Rule.  Each rule's code is generated
+    given the labels to jump to when it matches and when it doesn't, so
+    the boolean rules just chain their children's code together.  Every
+    jump is forwards, as classic BPF requires.
+    """
+
+    def __init__(self, linktype):
+        if linktype not in LINK_LAYER_OFFSETS:
+            raise ArgMismatchException(
+                'Cannot compile BPF for link type ' + str(linktype))
+        self.linktype = linktype
+        self.type_offset, self.net_offset = LINK_LAYER_OFFSETS[linktype]
+        self.code = []
+
+    def compile(self, rule, snaplen):
+        match = _Label()
+        no_match = _Label()
+        self.rule(rule, match, no_match)
+        self.place(match)
+        self.emit(BPF_RET | BPF_K, k=snaplen)
+        self.place(no_match)
+        self.emit(BPF_RET | BPF_K, k=0)
+
+        instructions = []
+        for index, (code, jt, jf, k) in enumerate(self.code):
+            if isinstance(k, _Label):
+                k = k.position - index - 1
+            jt = jt.position - index - 1 if isinstance(jt, _Label) else jt
+            jf = jf.position - index - 1 if isinstance(jf, _Label) else jf
+            if jt > 255 or jf > 255:
+                raise ArgMismatchException(
+                    'Rule is too large to compile to BPF (jump of over '
+                    '255 instructions)')
+            instructions.append(BPFInstruction(code, jt, jf, k))
+        if len(instructions) > BPF_MAXINSNS:
+            raise ArgMismatchException(
+                'Rule is too large to compile to BPF (' +
+                str(len(instructions)) + ' instructions)')
+        return BPFProgram(instructions)
+
+    def emit(self, code, jt=0, jf=0, k=0):
+        self.code.append((code, jt, jf, k))
+
+    def place(self, label):
+        label.position = len(self.code)
+
+    def jump(self, op, k, match, no_match, use_x=False):
+        self.emit(BPF_JMP | op | (BPF_X if use_x else BPF_K),
+                  match, no_match, k)
+
+    def all(self, steps, match, no_match):
+        """
+        Generate code matching when every step (a function of the match
+        and no match labels) matches.
+        """
+        if len(steps) == 0:
+            self.emit(BPF_JMP | BPF_JA, k=match)
+            return
+        for step in steps[:-1]:
+            next_step = _Label()
+            step(next_step, no_match)
+            self.place(next_step)
+        steps[-1](match, no_match)
+
+    def any(self, steps, match, no_match):
+        """
+        Generate code matching when any step matches.
+        """
+        if len(steps) == 0:
+            self.emit(BPF_JMP | BPF_JA, k=match)
+            return
+        for step in steps[:-1]:
+            next_step = _Label()
+            step(match, next_step)
+            self.place(next_step)
+        steps[-1](match, no_match)
+
+    def field(self, size, offset, value, mask=None, indexed=False):
+        """
+        Step matching when a field of the frame (masked, if a mask is
+        given) equals the value.
+        """
+        def step(match, no_match):
+            self.emit(BPF_LD | LOAD_SIZES[size] |
+                      (BPF_IND if indexed else BPF_ABS), k=offset)
+            if mask is not None:
+                self.emit(BPF_ALU | BPF_AND | BPF_K, k=mask)
+            self.jump(BPF_JEQ, value, match, no_match)
+        return step
+
+    def ether_type(self, ether_type):
+        return self.field(2, self.type_offset, ether_type)
+
+    def ip_protocol(self, protocol):
+        return lambda match, no_match: self.all(
+            [self.ether_type(pcap_packet.ETHERNET_PROTOCOL_TYPE_IP4),
+             self.field(1, self.net_offset + 9, protocol)],
+            match, no_match)
+
+    def not_fragment(self, match, no_match):
+        # Only the first fragment has the transport header
+        self.emit(BPF_LD | BPF_H | BPF_ABS, k=self.net_offset + 6)
+        self.jump(BPF_JSET, IP_FRAGMENT_OFFSET_MASK, no_match, match)
+
+    def transport(self, protocols):
+        """
+        Step matching an unfragmented IP packet of any of the given
+        protocols.
+        """
+        return lambda match, no_match: self.all(
+            [self.ether_type(pcap_packet.ETHERNET_PROTOCOL_TYPE_IP4),
+             lambda m, n: self.any(
+                 [self.field(1, self.net_offset + 9, p) for p in protocols],
+                 m, n),
+             self.not_fragment],
+            match, no_match)
+
+    def direction(self, rule, source_step, dest_step, match, no_match):
+        if rule.source and rule.dest:
+            self.all([source_step, dest_step], match, no_match)
+        elif rule.source:
+            source_step(match, no_match)
+        elif rule.dest:
+            dest_step(match, no_match)
+        else:
+            self.any([source_step, dest_step], match, no_match)
+
+    def cannot_compile(self, rule):
+        return ArgMismatchException(
+            'Cannot compile ' + type(rule).__name__ + ' rule [' +
+            rule.to_str() + '] to BPF')
+
+    def rule(self, rule, match, no_match):
+        if isinstance(rule, pcap_rules.Null):
+            self.emit(BPF_JMP | BPF_JA, k=match)
+        elif isinstance(rule, pcap_rules.And):
+            self.all([self.rule_step(r) for r in rule.rule_set],
+                     match, no_match)
+        elif isinstance(rule, pcap_rules.Or):
+            if len(rule.rule_set) == 0:
+                self.emit(BPF_JMP | BPF_JA, k=match)
+            else:
+                self.any([self.rule_step(r) for r in rule.rule_set],
+                         match, no_match)
+        elif isinstance(rule, pcap_rules.Not):
+            self.rule(rule.rule, no_match, match)
+        elif isinstance(rule, pcap_rules.Host):
+            self.host(rule, match, no_match)
+        elif isinstance(rule, pcap_rules.Net):
+            self.net(rule, match, no_match)
+        elif isinstance(rule, (pcap_rules.Port, pcap_rules.PortRange)):
+            self.port(rule, match, no_match)
+        elif isinstance(rule, pcap_rules.IPProto):
+            self.ip_protocol(rule.protocol_number())(match, no_match)
+        elif isinstance(rule, pcap_rules.EtherProto):
+            self.ether_type(rule.protocol_number())(match, no_match)
+        elif isinstance(rule, (pcap_rules.ICMPProto, pcap_rules.TCPProto,
+                               pcap_rules.UDPProto)):
+            self.ip_protocol(pcap_rules.IP_PROTOCOLS[rule.proto])(
+                match, no_match)
+        elif isinstance(rule, pcap_rules._PrimitiveCast):
+            self.cast(rule, match, no_match)
+        elif isinstance(rule, pcap_rules._PrimitiveComparison):
+            self.comparison(rule, match, no_match)
+        else:
+            raise self.cannot_compile(rule)
+
+    def rule_step(self, rule):
+        return lambda match, no_match: self.rule(rule, match, no_match)
+
+    def address_fields(self, rule):
+        """
+        The (ether type, source offset, dest offset) of the IPv4 addresses
+        for a host or net rule's proto.
+        :return: list[(int, int, int)]
+        """
+        ip = (pcap_packet.ETHERNET_PROTOCOL_TYPE_IP4,
+              self.net_offset + 12, self.net_offset + 16)
+        arp = (pcap_packet.ETHERNET_PROTOCOL_TYPE_ARP,
+               self.net_offset + 14, self.net_offset + 24)
+        if rule.proto == '':
+            return [ip, arp]
+        if rule.proto == 'ip':
+            return [ip]
+        if rule.proto == 'arp':
+            return [arp]
+        if rule.proto == 'rarp':
+            return [(pcap_packet.ETHERNET_PROTOCOL_TYPE_RARP,) + arp[1:]]
+        raise self.cannot_compile(rule)
+
+    def addresses(self, rule, value, mask, match, no_match):
+        def protocol_step(ether_type, source, dest):
+            def address_step(m, n):
+                self.direction(rule, self.field(4, source, value, mask),
+                               self.field(4, dest, value, mask), m, n)
+            return lambda m, n: self.all(
+                [self.ether_type(ether_type), address_step], m, n)
+
+        self.any([protocol_step(*fields)
+                  for fields in self.address_fields(rule)],
+                 match, no_match)
+
+    def host(self, rule, match, no_match):
+        if rule.proto != 'ether':
+            self.addresses(rule, pcap_rules.ip_to_int(
+                pcap_rules.resolve_host(rule.host)), None, match, no_match)
+            return
+        if self.linktype != pcap_file.LINKTYPE_ETHERNET:
+            raise self.cannot_compile(rule)
+        mac = bytearray(int(octet, 16) for octet in rule.host.split(':'))
+        high, low = struct.unpack('!HI', bytes(mac))
+
+        def mac_step(offset):
+            return lambda m, n: self.all([self.field(2, offset, high),
+                                          self.field(4, offset + 2, low)],
+                                         m, n)
+        self.direction(rule, mac_step(6), mac_step(0), match, no_match)
+
+    def net(self, rule, match, no_match):
+        net_int, mask_int = rule.network()
+        self.addresses(rule, net_int, mask_int, match, no_match)
+
+    def port(self, rule, match, no_match):
+        if rule.proto == '':
+            protocols = [pcap_packet.IP4_PROTOCOL_TCP,
+                         pcap_packet.IP4_PROTOCOL_UDP]
+        elif rule.proto in ('tcp', 'udp'):
+            protocols = [pcap_rules.IP_PROTOCOLS[rule.proto]]
+        else:
+            raise self.cannot_compile(rule)
+        if isinstance(rule, pcap_rules.Port):
+            start_port = end_port = int(rule.port)
+        else:
+            start_port, end_port = int(rule.start_port), int(rule.end_port)
+
+        def port_step(offset):
+            def step(m, n):
+                self.emit(BPF_LD | BPF_H | BPF_IND,
+                          k=self.net_offset + offset)
+                if start_port == end_port:
+                    self.jump(BPF_JEQ, start_port, m, n)
+                    return
+                in_range = _Label()
+                self.jump(BPF_JGE, start_port, in_range, n)
+                self.place(in_range)
+                self.jump(BPF_JGT, end_port, n, m)
+            return step
+
+        def ports(m, n):
+            self.emit(BPF_LDX | BPF_B | BPF_MSH, k=self.net_offset)
+            self.direction(rule, port_step(0), port_step(2), m, n)
+        self.all([self.transport(protocols), ports], match, no_match)
+
+    def cast(self, rule, match, no_match):
+        if rule.proto == 'ether':
+            if self.linktype != pcap_file.LINKTYPE_ETHERNET:
+                raise self.cannot_compile(rule)
+            if rule.type == 'broadcast':
+                self.all([self.field(4, 2, 0xffffffff),
+                          self.field(2, 0, 0xffff)], match, no_match)
+            else:
+                self.emit(BPF_LD | BPF_B | BPF_ABS, k=0)
+                self.jump(BPF_JSET, 1, match, no_match)
+        elif rule.proto == 'ip':
+            if rule.type == 'broadcast':
+                dest_step = self.field(4, self.net_offset + 16, BROADCAST_IP)
+            else:
+                dest_step = self.field(1, self.net_offset + 16, 0xe0,
+                                       mask=0xf0)
+            self.all([self.ether_type(pcap_packet.ETHERNET_PROTOCOL_TYPE_IP4),
+                      dest_step], match, no_match)
+        else:
+            raise self.cannot_compile(rule)
+
+    def comparison(self, rule, match, no_match):
+        lhs = pcap_rules.parse_expression(str(rule.lhs))
+        rhs = pcap_rules.parse_expression(str(rule.rhs))
+        layers = set()
+        _expression_layers(lhs, layers)
+        _expression_layers(rhs, layers)
+
+        # Packets without a layer the expression reads don't match
+        requirements = []
+        if 'arp' in layers:
+            requirements.append(self.ether_type(
+                pcap_packet.ETHERNET_PROTOCOL_TYPE_ARP))
+        for name in ('tcp', 'udp', 'icmp'):
+            if name in layers:
+                requirements.append(self.transport(
+                    [pcap_rules.IP_PROTOCOLS[name]]))
+        if 'ip' in layers:
+            requirements.append(self.ether_type(
+                pcap_packet.ETHERNET_PROTOCOL_TYPE_IP4))
+
+        jump, swapped = COMPARISON_JUMPS[rule.operation]
+
+        def compare(m, n):
+            if swapped:
+                m, n = n, m
+            if rhs[0] == 'value':
+                self.expression(lhs, 0)
+                self.jump(jump, rhs[1], m, n)
+            else:
+                self.expression(rhs, 0)
+                self.emit(BPF_ST, k=0)
+                self.expression(lhs, 1)
+                self.emit(BPF_LDX | BPF_W | BPF_MEM, k=0)
+                self.jump(jump, 0, m, n, use_x=True)
+        self.all(requirements + [compare], match, no_match)
+
+    def expression(self, tree, depth):
+        """
+        Generate code leaving the value of an expression tree (see
+        pcap_rules.parse_expression) in the accumulator, using scratch
+        memory from index depth on for intermediate values.
+        """
+        if depth >= BPF_MEMWORDS:
+            raise ArgMismatchException(
+                'Expression is too deeply nested to compile to BPF')
+        if tree[0] == 'value':
+            self.emit(BPF_LD | BPF_IMM, k=tree[1])
+        elif tree[0] == 'len':
+            self.emit(BPF_LD | BPF_W | BPF_LEN)
+        elif tree[0] == 'load':
+            self.load(tree, depth)
+        else:
+            op = ALU_OPERATIONS[tree[1]]
+            if tree[3][0] == 'value':
+                self.expression(tree[2], depth)
+                self.emit(BPF_ALU | op | BPF_K, k=tree[3][1])
+            else:
+                self.expression(tree[3], depth)
+                self.emit(BPF_ST, k=depth)
+                self.expression(tree[2], depth + 1)
+                self.emit(BPF_LDX | BPF_W | BPF_MEM, k=depth)
+                self.emit(BPF_ALU | op | BPF_X)
+
+    def load(self, tree, depth):
+        _, layer, offset, size = tree
+        code = BPF_LD | LOAD_SIZES[size]
+        if layer == 'ethernet' and self.linktype == LINKTYPE_COOKED_SOCKET:
+            raise ArgMismatchException(
+                'Cannot compile BPF loads from the link header of cooked '
+                'socket frames')
+        base = 0 if layer == 'ethernet' else self.net_offset
+        transport = layer in ('tcp', 'udp', 'icmp')
+        if offset[0] == 'value':
+            if transport:
+                self.emit(BPF_LDX | BPF_B | BPF_MSH, k=self.net_offset)
+                self.emit(code | BPF_IND, k=base + offset[1])
+            else:
+                self.emit(code | BPF_ABS, k=base + offset[1])
+            return
+        self.expression(offset, depth)
+        if transport:
+            self.emit(BPF_ST, k=depth)
+            self.emit(BPF_LDX | BPF_B | BPF_MSH, k=self.net_offset)
+            self.emit(BPF_LD | BPF_W | BPF_MEM, k=depth)
+            self.emit(BPF_ALU | BPF_ADD | BPF_X)
+        self.emit(BPF_MISC | BPF_TAX)
+        self.emit(code | BPF_IND, k=base)
+
+
+def _expression_layers(tree, layers):
+    if tree[0] == 'load':
+        layers.add(tree[1])
+        _expression_layers(tree[2], layers)
+    elif tree[0] == 'op':
+        _expression_layers(tree[2], layers)
+        _expression_layers(tree[3], layers)
+
+
+def compile_rule(rule, linktype=pcap_file.LINKTYPE_ETHERNET, snaplen=65535):
+    """
+    Compile a pcap_rules Rule into a classic BPF program accepting (up to
+    snaplen bytes of) the frames the rule matches.  Host, Net, Port,
+    PortRange, the proto and cast rules, comparisons and the boolean rules
+    are supported; other rules raise an ArgMismatchException.
+    :type rule: pcap_rules.Rule
+    :param linktype: int Link type of the frames filtered (Ethernet, Linux
+    cooked frames, or LINKTYPE_COOKED_SOCKET)
+    :type snaplen: int
+    :return: BPFProgram
+    """
+    return _BPFCompiler(linktype).compile(rule, snaplen)
+
+
+def attach_filter(sock, program):
+    """
+    Attach a BPF program to a socket (usually an AF_PACKET one), so the
+    kernel drops the frames it doesn't accept before they are queued.
+    :type sock: socket.socket
+    :type program: BPFProgram
+    """
+    code = ctypes.create_string_buffer(program.pack())
+    # struct sock_fprog: instruction count and a pointer to them
+    fprog = struct.pack('HL', len(program), ctypes.addressof(code))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def detach_filter(sock):
+    """
+    :type sock: socket.socket
+    """
+    sock.setsockopt(socket.SOL_SOCKET, SO_DETACH_FILTER, 0)
+
+
+def bind_capture_socket(sock, interface):
+    """
+    Bind an AF_PACKET socket opened with protocol 0 (so it receives
+    nothing until now) to every protocol on an interface, or on all of
+    them for 'any'.  Binding last, once the filter is attached, means
+    no frame which the filter would drop, or from another interface, is
+    queued.
+    :type sock: socket.socket
+    :type interface: str
+    """
+    if interface != 'any':
+        sock.bind((interface, ETH_P_ALL))
+        return
+    # Python can't bind to interface index 0, so call bind() directly
+    # with a struct sockaddr_ll
+    address = struct.pack('HHi12x', socket.AF_PACKET,
+                          socket.htons(ETH_P_ALL), 0)
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.bind(sock.fileno(), ctypes.c_char_p(address),
+                 len(address)) != 0:
+        errno = ctypes.get_errno()
+        raise socket.error(errno, os.strerror(errno))
+
+
+def open_capture_socket(interface, rule=None, snaplen=65535):
+    """
+    Open a raw AF_PACKET socket capturing Ethernet frames on an interface,
+    filtered in the kernel by a rule (if given).  The socket receives
+    nothing until it is bound, which is only done once the filter is
+    attached, so no unfiltered frame (or frame from another interface)
+    is queued.
+    :type interface: str
+    :type rule: pcap_rules.Rule
+    :type snaplen: int
+    :return: socket.socket
+    """
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+    try:
+        if rule is not None:
+            attach_filter(sock, compile_rule(rule, snaplen=snaplen))
+        bind_capture_socket(sock, interface)
+    except Exception:
+        sock.close()
+        raise
+    return sock
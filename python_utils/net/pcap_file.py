@@ -0,0 +1,531 @@
+import collections
+import mmap
+import os
+import struct
+import time
+
+from python_utils.common import exceptions
+from python_utils.net import pcap_packet
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+
+PCAPNG_BLOCK_SECTION_HEADER = 0x0a0d0d0a
+PCAPNG_BLOCK_INTERFACE_DESCRIPTION = 0x00000001
+PCAPNG_BLOCK_PACKET = 0x00000002
+PCAPNG_BLOCK_SIMPLE_PACKET = 0x00000003
+PCAPNG_BLOCK_ENHANCED_PACKET = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+PCAPNG_OPTION_END = 0
+PCAPNG_OPTION_IF_TSRESOL = 9
+PCAPNG_OPTION_IF_TSOFFSET = 14
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_LINUX_SLL = 113
+
+# Layer class to start parsing with for each supported link type
+LINK_LAYER_CLASSES = {LINKTYPE_ETHERNET: pcap_packet.PCAPEthernet,
+                      LINKTYPE_LINUX_SLL: pcap_packet.PCAPSLL}
+
+PCAP_GLOBAL_HEADER_SIZE = 24
+PCAP_RECORD_HEADER_SIZE = 16
+
+PCAPRecord = collections.namedtuple(
+    'PCAPRecord', ['timestamp', 'timestamp_ns', 'linktype', 'data',
+                   'orig_len'])
+""" Raw frame read from a savefile.  'timestamp' is in seconds since the
+epoch (float), 'timestamp_ns' the same time in integer nanoseconds. """
+
+
+def ns_to_seconds(timestamp_ns):
+    """
+    Converts integer nanoseconds to float seconds, rounding only once.
+    :type timestamp_ns: int
+    :return: float
+    """
+    return timestamp_ns // 1000000000 + (timestamp_ns % 1000000000) / 1e9
+
+
+def parse_global_header(data, offset=0):
+    """
+    Decodes a libpcap savefile global header, which can be written in
+    either byte order and with micro or nanosecond timestamps.  Returns
+    the struct byte order prefix for the rest of the file, the number of
+    nanoseconds per timestamp fraction unit, the snap length and the link
+    type.
+    :type data: bytes | bytearray | memoryview | mmap.mmap
+    :type offset: int
+    :return: (str, int, int, int)
+    """
+    if len(data) - offset < PCAP_GLOBAL_HEADER_SIZE:
+        raise exceptions.PacketParsingException(
+            'pcap file header must be ' + str(PCAP_GLOBAL_HEADER_SIZE) +
+            ' bytes, but only [' + str(len(data) - offset) +
+            '] bytes are available', fatal=True)
+
+    for order in ('<', '>'):
+        magic = struct.unpack_from(order + 'I', data, offset)[0]
+        if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+            break
+    else:
+        raise exceptions.PacketParsingException(
+            'Unknown pcap file magic number [0x' +
+            '{0:08x}'.format(struct.unpack_from('>I', data, offset)[0]) +
+            ']', fatal=True)
+
+    snaplen, linktype = struct.unpack_from(order + 'II', data, offset + 16)
+    frac_ns = 1 if magic == PCAP_MAGIC_NSEC else 1000
+    return order, frac_ns, snaplen, linktype
+
+
+class PCAPFileReader(object):
+    """
+    Streaming reader for binary libpcap (.pcap) and pcapng (.pcapng)
+    savefiles.  The file is mmapped and its record headers decoded in
+    place, so multi-GB captures can be walked without loading them.
+    Iterating the reader yields PCAPPackets with real (epoch)
+    timestamps, whose data is a view into the mapped file where the
+    Python version allows it (Python 3), or a copy of the frame.
+    """
+
+    def __init__(self, filename, parse=False, lazy=False):
+        """
+        :param filename: str
+        :param parse: bool Parse each packet (starting with the right layer
+        for the file's link type) before yielding it
+        :param lazy: bool Parse the packets lazily (see PCAPPacket.parse)
+        """
+        if not os.path.isfile(filename):
+            raise exceptions.FileNotFoundException(
+                'pcap file not found: ' + filename)
+        self.filename = filename
+        self.parse = parse
+        self.lazy = lazy
+        self.truncated = False
+        """ :type: bool """
+
+        self._file = open(filename, 'rb')
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.close()
+            raise exceptions.PacketParsingException(
+                'pcap file is empty: ' + filename, fatal=True)
+        self._map = mmap.mmap(self._file.fileno(), 0,
+                              access=mmap.ACCESS_READ)
+        try:
+            self._data = memoryview(self._map)
+        except TypeError:
+            # Python 2 mmaps can't be viewed, so slicing copies the frames
+            self._data = self._map
+
+        magic = struct.unpack_from('<I', self._map, 0)[0]
+        self.is_pcapng = magic == PCAPNG_BLOCK_SECTION_HEADER
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        return self.read_packets()
+
+    def close(self):
+        self._data = None
+        try:
+            self._map.close()
+        except BufferError:
+            # Packets still reference the mapped data, leave the map to be
+            # released along with them
+            pass
+        self._file.close()
+
+    def read_packets(self, start=None, end=None):
+        """
+        Yields a PCAPPacket for every frame in the file (or in the given
+        byte range, see read_records).
+        :type start: int
+        :type end: int
+        :return: collections.Iterable[PCAPPacket]
+        """
+        for record in self.read_records(start, end):
+            packet = pcap_packet.PCAPPacket(record.data, record.timestamp)
+            if self.parse:
+                link_class = LINK_LAYER_CLASSES.get(record.linktype)
+                if link_class is None:
+                    raise exceptions.PacketParsingException(
+                        'No known layer for link type [' +
+                        str(record.linktype) + ']', fatal=True)
+                packet.parse_layers([link_class], lazy=self.lazy)
+            yield packet
+
+    def read_records(self, start=None, end=None):
+        """
+        Yields a PCAPRecord for every frame in the file.  For libpcap
+        files, a byte range of records (such as one from record_ranges)
+        can be read instead: start must be the offset of a record header,
+        and reading stops at the first record starting at or after end.
+        :type start: int
+        :type end: int
+        :return: collections.Iterable[PCAPRecord]
+        """
+        if self.is_pcapng:
+            if start is not None or end is not None:
+                raise exceptions.ArgMismatchException(
+                    'Byte ranges can only be read from libpcap files')
+            return self._read_pcapng_records()
+        return self._read_pcap_records(start, end)
+
+    def record_ranges(self, range_size):
+        """
+        Splits a libpcap file into byte ranges of whole records, each
+        about range_size bytes long (or one record, if that is longer),
+        which read_records can then read independently.  Only the record
+        headers are decoded.
+        :type range_size: int
+        :return: collections.Iterable[(int, int)]
+        """
+        if self.is_pcapng:
+            raise exceptions.ArgMismatchException(
+                'Byte ranges can only be read from libpcap files')
+        size = len(self._map)
+        order = parse_global_header(self._map)[0]
+        length_field = struct.Struct(order + 'I')
+
+        start = offset = PCAP_GLOBAL_HEADER_SIZE
+        while size - offset >= PCAP_RECORD_HEADER_SIZE:
+            offset += PCAP_RECORD_HEADER_SIZE + length_field.unpack_from(
+                self._map, offset + 8)[0]
+            if offset - start >= range_size:
+                yield start, min(offset, size)
+                start = offset
+        if start < size:
+            yield start, size
+
+    def _read_pcap_records(self, start=None, end=None):
+        data = self._data
+        size = len(self._map)
+        order, frac_ns, _, linktype = parse_global_header(self._map)
+        record_header = struct.Struct(order + 'IIII')
+
+        offset = PCAP_GLOBAL_HEADER_SIZE if start is None else start
+        end = size if end is None else min(end, size)
+        while offset < end:
+            if size - offset < PCAP_RECORD_HEADER_SIZE:
+                self.truncated = True
+                return
+            ts_sec, ts_frac, incl_len, orig_len = \
+                record_header.unpack_from(self._map, offset)
+            offset += PCAP_RECORD_HEADER_SIZE
+            if size - offset < incl_len:
+                self.truncated = True
+                return
+            timestamp_ns = ts_sec * 1000000000 + ts_frac * frac_ns
+            yield PCAPRecord(ns_to_seconds(timestamp_ns), timestamp_ns,
+                             linktype, data[offset:offset + incl_len],
+                             orig_len)
+            offset += incl_len
+
+    def _read_pcapng_records(self):
+        data = self._data
+        size = len(self._map)
+        order = '<'
+        # Per interface: (link type, ns per timestamp unit as a
+        # (numerator, denominator) pair, timestamp offset in seconds)
+        interfaces = []
+
+        offset = 0
+        while offset < size:
+            if size - offset < 12:
+                self.truncated = True
+                return
+            block_type = struct.unpack_from(order + 'I', self._map,
+                                            offset)[0]
+            if block_type == PCAPNG_BLOCK_SECTION_HEADER:
+                # A new section may switch byte order, and resets the
+                # interface list
+                bom = struct.unpack_from('<I', self._map, offset + 8)[0]
+                if bom == PCAPNG_BYTE_ORDER_MAGIC:
+                    order = '<'
+                elif bom == struct.unpack('<I', struct.pack(
+                        '>I', PCAPNG_BYTE_ORDER_MAGIC))[0]:
+                    order = '>'
+                else:
+                    raise exceptions.PacketParsingException(
+                        'Unknown pcapng byte order magic [0x' +
+                        '{0:08x}'.format(bom) + ']', fatal=True)
+                interfaces = []
+
+            block_len = struct.unpack_from(order + 'I', self._map,
+                                           offset + 4)[0]
+            if block_len < 12 or size - offset < block_len:
+                self.truncated = True
+                return
+            body = offset + 8
+            body_end = offset + block_len - 4
+
+            if block_type == PCAPNG_BLOCK_INTERFACE_DESCRIPTION:
+                interfaces.append(self._read_pcapng_interface(
+                    order, body, body_end))
+            elif block_type in (PCAPNG_BLOCK_ENHANCED_PACKET,
+                                PCAPNG_BLOCK_PACKET):
+                if block_type == PCAPNG_BLOCK_ENHANCED_PACKET:
+                    (if_id, ts_high, ts_low, cap_len,
+                     orig_len) = struct.unpack_from(order + 'IIIII',
+                                                    self._map, body)
+                else:
+                    (if_id, _, ts_high, ts_low, cap_len,
+                     orig_len) = struct.unpack_from(order + 'HHIIII',
+                                                    self._map, body)
+                if if_id >= len(interfaces):
+                    raise exceptions.PacketParsingException(
+                        'pcapng packet block references unknown interface '
+                        '[' + str(if_id) + ']', fatal=True)
+                linktype, ts_num, ts_den, ts_offset = interfaces[if_id]
+                timestamp_ns = ((((ts_high << 32) | ts_low) * ts_num) //
+                                ts_den) + ts_offset * 1000000000
+                yield PCAPRecord(ns_to_seconds(timestamp_ns), timestamp_ns,
+                                 linktype,
+                                 data[body + 20:body + 20 + cap_len],
+                                 orig_len)
+            elif block_type == PCAPNG_BLOCK_SIMPLE_PACKET:
+                if len(interfaces) == 0:
+                    raise exceptions.PacketParsingException(
+                        'pcapng simple packet block without an interface',
+                        fatal=True)
+                orig_len = struct.unpack_from(order + 'I', self._map,
+                                              body)[0]
+                cap_len = min(orig_len, body_end - body - 4)
+                # Simple packets carry no timestamp
+                yield PCAPRecord(0.0, 0, interfaces[0][0],
+                                 data[body + 4:body + 4 + cap_len],
+                                 orig_len)
+
+            offset += block_len
+
+    def _read_pcapng_interface(self, order, body, body_end):
+        linktype = struct.unpack_from(order + 'H', self._map, body)[0]
+        # Default resolution is microseconds
+        ts_num, ts_den, ts_offset = 1000, 1, 0
+
+        option = body + 8
+        while option + 4 <= body_end:
+            code, length = struct.unpack_from(order + 'HH', self._map,
+                                              option)
+            if code == PCAPNG_OPTION_END:
+                break
+            value = option + 4
+            if code == PCAPNG_OPTION_IF_TSRESOL and length >= 1:
+                tsresol = struct.unpack_from('B', self._map, value)[0]
+                if tsresol & 0x80:
+                    # Negative power of 2 of a second
+                    ts_num, ts_den = 1000000000, 1 << (tsresol & 0x7f)
+                elif tsresol <= 9:
+                    ts_num, ts_den = 10 ** (9 - tsresol), 1
+                else:
+                    ts_num, ts_den = 1, 10 ** (tsresol - 9)
+            elif code == PCAPNG_OPTION_IF_TSOFFSET and length >= 8:
+                ts_offset = struct.unpack_from(order + 'q', self._map,
+                                               value)[0]
+            # Options are padded to 32 bits
+            option = value + ((length + 3) & ~3)
+
+        return linktype, ts_num, ts_den, ts_offset
+
+
+class PCAPFileWriter(object):
+    """
+    Streaming writer for binary libpcap (.pcap) savefiles, readable by
+    PCAPFileReader, tcpdump and Wireshark.  Records are appended as they
+    are written.  If a max_size is given, the file is rotated once the
+    next record would take it past that size: the full file is renamed to
+    '<filename>.<n>' (n counting up from 1) and a new file is started.
+    If max_files is also given, only that many rotated files are kept,
+    the oldest being deleted first.
+    """
+
+    def __init__(self, filename, linktype=LINKTYPE_ETHERNET, snaplen=65535,
+                 nanosecond=False, max_size=0, max_files=0, append=False):
+        """
+        :param filename: str
+        :param linktype: int Link type of the written frames
+        :param snaplen: int
+        :param nanosecond: bool Write nanosecond rather than microsecond
+        timestamps
+        :param max_size: int Size in bytes to rotate the file at (0 never
+        rotates)
+        :param max_files: int Number of rotated files to keep (0 keeps all)
+        :param append: bool Append to an existing savefile rather than
+        replacing it.  The existing file's byte order, timestamp precision
+        and link type are used.
+        """
+        self.filename = filename
+        self.linktype = linktype
+        self.snaplen = snaplen
+        self.nanosecond = nanosecond
+        self.max_size = max_size
+        self.max_files = max_files
+        self.order = '<'
+        self.rotated_files = []
+        """ :type: list[str] """
+        self.packets_written = 0
+        self.bytes_written = 0
+
+        self._file = None
+        self._file_size = 0
+
+        if append and os.path.isfile(filename) and \
+                os.path.getsize(filename) > 0:
+            with open(filename, 'rb') as f:
+                header = f.read(PCAP_GLOBAL_HEADER_SIZE)
+            self.order, frac_ns, self.snaplen, self.linktype = \
+                parse_global_header(header)
+            self.nanosecond = frac_ns == 1
+            self._file = open(filename, 'ab')
+            self._file_size = os.path.getsize(filename)
+        else:
+            self._open_new_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _open_new_file(self):
+        self._file = open(self.filename, 'wb')
+        self._file.write(struct.pack(
+            self.order + 'IHHiIII',
+            PCAP_MAGIC_NSEC if self.nanosecond else PCAP_MAGIC_USEC,
+            2, 4, 0, 0, self.snaplen, self.linktype))
+        self._file_size = PCAP_GLOBAL_HEADER_SIZE
+
+    def _rotate(self):
+        self._file.close()
+        rotated = self.filename + '.' + str(len(self.rotated_files) + 1)
+        os.rename(self.filename, rotated)
+        self.rotated_files.append(rotated)
+        if self.max_files > 0:
+            for old_file in self.rotated_files[:-self.max_files]:
+                if os.path.isfile(old_file):
+                    os.remove(old_file)
+        self._open_new_file()
+
+    def write(self, data, timestamp=None, orig_len=None):
+        """
+        Appends a frame to the savefile, truncated to the snap length.
+        :param data: bytes | bytearray | memoryview | list[int]
+        :param timestamp: float Seconds since the epoch (default is now)
+        :param orig_len: int Length of the frame on the wire (default is
+        the length of the data)
+        """
+        if self._file is None:
+            raise exceptions.ArgMismatchException(
+                'pcap writer for ' + self.filename + ' is closed')
+        if isinstance(data, list):
+            data = bytearray(data)
+        if orig_len is None:
+            orig_len = len(data)
+        if len(data) > self.snaplen:
+            data = data[:self.snaplen]
+        if timestamp is None:
+            timestamp = time.time()
+
+        record_size = PCAP_RECORD_HEADER_SIZE + len(data)
+        if 0 < self.max_size < self._file_size + record_size and \
+                self._file_size > PCAP_GLOBAL_HEADER_SIZE:
+            self._rotate()
+
+        ts_sec = int(timestamp)
+        frac_units = 1000000000 if self.nanosecond else 1000000
+        ts_frac = min(int(round((timestamp - ts_sec) * frac_units)),
+                      frac_units - 1)
+        self._file.write(struct.pack(self.order + 'IIII', ts_sec, ts_frac,
+                                     len(data), orig_len))
+        self._file.write(data)
+        self._file_size += record_size
+        self.packets_written += 1
+        self.bytes_written += record_size
+
+    def write_packet(self, packet, timestamp=None):
+        """
+        Appends a PCAPPacket's frame to the savefile.  The packet's own
+        timestamp is used unless one is given.
+        :type packet: PCAPPacket
+        :param timestamp: float Seconds since the epoch
+        """
+        if timestamp is None:
+            timestamp = packet.timestamp
+        self.write(packet.packet_data, timestamp)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class PCAPStreamDecoder(object):
+    """
+    Incremental decoder for a libpcap savefile arriving as a byte stream
+    (such as the output of 'tcpdump -w -').  Data is fed in chunks of any
+    size, and every record completed so far is returned.  The global
+    header is decoded from the start of the stream, so either byte order
+    and either timestamp precision is handled.
+    """
+
+    def __init__(self):
+        self.order = None
+        """ :type: str """
+        self.linktype = None
+        """ :type: int """
+        self.snaplen = None
+        """ :type: int """
+        self._frac_ns = None
+        self._record_header = None
+        self._buffer = bytearray()
+
+    @property
+    def pending_bytes(self):
+        """
+        Number of bytes fed which don't yet form a complete record.
+        :return: int
+        """
+        return len(self._buffer)
+
+    def feed(self, data):
+        """
+        Adds stream data and returns the records it completes.
+        :type data: bytes | bytearray
+        :return: list[PCAPRecord]
+        """
+        buf = self._buffer
+        buf += data
+        offset = 0
+        if self.order is None:
+            if len(buf) < PCAP_GLOBAL_HEADER_SIZE:
+                return []
+            self.order, self._frac_ns, self.snaplen, self.linktype = \
+                parse_global_header(buf)
+            self._record_header = struct.Struct(self.order + 'IIII')
+            offset = PCAP_GLOBAL_HEADER_SIZE
+
+        records = []
+        size = len(buf)
+        while size - offset >= PCAP_RECORD_HEADER_SIZE:
+            ts_sec, ts_frac, incl_len, orig_len = \
+                self._record_header.unpack_from(buf, offset)
+            start = offset + PCAP_RECORD_HEADER_SIZE
+            if size - start < incl_len:
+                break
+            timestamp_ns = ts_sec * 1000000000 + ts_frac * self._frac_ns
+            records.append(PCAPRecord(
+                ns_to_seconds(timestamp_ns), timestamp_ns, self.linktype,
+                bytes(buf[start:start + incl_len]), orig_len))
+            offset = start + incl_len
+
+        del buf[:offset]
+        return records
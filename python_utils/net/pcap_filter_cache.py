@@ -0,0 +1,164 @@
+import collections
+import threading
+
+from python_utils.net import pcap_bpf
+from python_utils.net import pcap_file
+
+DEFAULT_FILTER_CACHE_SIZE = 256
+
+
+class CompiledFilter(object):
+    """
+    The compiled forms of one (normalized) pcap_rules Rule: the filter
+    string passed to tcpdump, the in-process predicate and BPF programs.
+    The predicate and programs are only compiled when first asked for,
+    as not every rule can be compiled to them.
+    """
+
+    def __init__(self, rule):
+        """
+        :param rule: pcap_rules.Rule Normalized rule
+        """
+        self.rule = rule
+        self.filter_str = rule.to_str()
+        self._predicate = None
+        self._bpf_programs = {}
+        """ :type: dict[(int, int), pcap_bpf.BPFProgram]"""
+
+    @property
+    def predicate(self):
+        """
+        :return: callable See Rule.compile
+        """
+        if self._predicate is None:
+            self._predicate = self.rule.compile()
+        return self._predicate
+
+    def bpf_program(self, linktype=pcap_file.LINKTYPE_ETHERNET,
+                    snaplen=65535):
+        """
+        :type linktype: int
+        :type snaplen: int
+        :return: pcap_bpf.BPFProgram
+        """
+        program = self._bpf_programs.get((linktype, snaplen))
+        if program is None:
+            program = pcap_bpf.compile_rule(self.rule, linktype, snaplen)
+            self._bpf_programs[(linktype, snaplen)] = program
+        return program
+
+
+class FilterCache(object):
+    """
+    LRU cache of CompiledFilters, keyed by the normalized form of the
+    rules, so rebuilding an identical (or equivalent) filter doesn't
+    compile it again.  Normalizing a rule tree (and hashing the result)
+    costs more than building its filter string, so the rule objects most
+    recently looked up are also remembered by identity along with their
+    filter string: looking one up again, unchanged since, only rebuilds
+    its string to check against.  Safe to use from several threads.
+    """
+
+    def __init__(self, max_size=DEFAULT_FILTER_CACHE_SIZE):
+        """
+        :param max_size: int Most filters held before the least recently
+        used is evicted (0 for no limit)
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._filters = collections.OrderedDict()
+        """ :type: dict[pcap_rules.Rule, CompiledFilter]"""
+        self._identities = collections.OrderedDict()
+        """ :type: dict[int, (pcap_rules.Rule, str, pcap_rules.Rule)] By
+        the id of the rule looked up (which the entry keeps alive): the
+        rule, its filter string then and its normalized form"""
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._filters)
+
+    def get(self, rule):
+        """
+        :type rule: pcap_rules.Rule
+        :return: CompiledFilter
+        """
+        rule_str = rule.to_str()
+        with self._lock:
+            entry = self._identities.pop(id(rule), None)
+            # Only a hit if the rule hasn't been changed since, and its
+            # filter hasn't been evicted
+            if entry is not None and entry[0] is rule and \
+                    entry[1] == rule_str:
+                compiled = self._filters.pop(entry[2], None)
+                if compiled is not None:
+                    self.hits += 1
+                    self._filters[entry[2]] = compiled
+                    self._identities[id(rule)] = entry
+                    return compiled
+
+        normalized = rule.normalize()
+        with self._lock:
+            compiled = self._filters.pop(normalized, None)
+            if compiled is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                compiled = CompiledFilter(normalized)
+                if 0 < self.max_size <= len(self._filters):
+                    self._filters.popitem(last=False)
+                    self.evictions += 1
+            # (Re)inserted at the most recently used end
+            self._filters[normalized] = compiled
+            if len(self._identities) >= (self.max_size if self.max_size > 0
+                                         else DEFAULT_FILTER_CACHE_SIZE):
+                self._identities.popitem(last=False)
+            self._identities[id(rule)] = (rule, rule_str, normalized)
+            return compiled
+
+    def clear(self):
+        with self._lock:
+            self._filters.clear()
+            self._identities.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+_filter_cache = FilterCache()
+
+
+def get_filter_cache():
+    """
+    The process-wide filter cache.
+    :return: FilterCache
+    """
+    return _filter_cache
+
+
+def filter_string(rule):
+    """
+    The (normalized) filter string for a rule, to pass to tcpdump.
+    :type rule: pcap_rules.Rule
+    :return: str
+    """
+    return _filter_cache.get(rule).filter_str
+
+
+def compile_predicate(rule):
+    """
+    :type rule: pcap_rules.Rule
+    :return: callable See Rule.compile
+    """
+    return _filter_cache.get(rule).predicate
+
+
+def compile_bpf(rule, linktype=pcap_file.LINKTYPE_ETHERNET, snaplen=65535):
+    """
+    :type rule: pcap_rules.Rule
+    :type linktype: int
+    :type snaplen: int
+    :return: pcap_bpf.BPFProgram
+    """
+    return _filter_cache.get(rule).bpf_program(linktype, snaplen)
@@ -1,31 +1,218 @@
+import array
+import collections
+import select
+import threading
+import time
+
 import pytcpcap
 from python_utils.common import exceptions
-from python_utils.common import mp_thread
+from python_utils.net import pcap_filter_cache
+from python_utils.net import pcap_packet
+from python_utils.net import pcap_rules
+
+PCAP_SNAPLEN = 0xFFFF
+# Most packets held by the capture before newer ones are dropped
+PCAP_RING_SIZE = 65536
+
+
+def _batch_packets(batch):
+    """
+    :param batch: (bytes, bytes, bytes) Packet data, offsets and timestamps
+    as returned by pytcpcap.get_packets and pytcpcap.dispatch
+    :return: list[pcap_packet.PCAPPacket]
+    """
+    data, offsets, timestamps = batch
+    offsets = array.array('I', offsets)
+    timestamps = array.array('d', timestamps)
+    return [pcap_packet.PCAPPacket(data[offsets[i]:offsets[i + 1]],
+                                   timestamps[i])
+            for i in range(len(timestamps))]
 
 
 class Pcap:
-    def __init__(self, device, filter_str=""):
-        self.handle = pytcpcap.init(device, filter_str)
-        self._server_thread = mp_thread.MPThread(self._listen_server)
+    """
+    Packet capture through libpcap (the pytcpcap extension).  The capture
+    loop runs in a thread of this process with the GIL released, storing
+    packets in a ring which get_packets takes them from in batches.
+    """
 
-    def start_capture(self):
-        self._server_thread.start()
-        ret = self._server_thread.get_data()
-        if ret is not None:
-            raise ret
+    def __init__(self, device, filter_str="", snaplen=PCAP_SNAPLEN,
+                 ring_size=PCAP_RING_SIZE):
+        """
+        :type device: str
+        :param filter_str: str | pcap_rules.Rule
+        :type snaplen: int
+        :param ring_size: int Most packets held for get_packets, packets
+        captured while it is full are dropped (see stats)
+        """
+        if isinstance(filter_str, pcap_rules.Rule):
+            filter_str = pcap_filter_cache.filter_string(filter_str)
+        self.handle = pytcpcap.init(device, filter_str, snaplen, ring_size)
+        self._loop_thread = None
+        """ :type: threading.Thread"""
 
-    def _listen_server(self):
+    def start_capture(self):
         try:
             pytcpcap.start(self.handle)
-            self._server_thread.put_data(None)
-        except exceptions.SubprocessFailedException as e:
-            self._server_thread.put_data(e)
-        pytcpcap.loop(self.handle)
+        except RuntimeError as e:
+            raise exceptions.SubprocessFailedException(str(e))
+        self._loop_thread = threading.Thread(target=pytcpcap.loop,
+                                             args=(self.handle,))
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
 
-    def get_packets(self):
-        ret = pytcpcap.get_packets(self.handle)
-        print str(ret)
+    def get_packets(self, max_count=0, timeout=0):
+        """
+        Take the captured packets (at most max_count, if set), waiting up
+        to timeout seconds (forever if None) for a packet if none have
+        been captured yet.
+        :type max_count: int
+        :type timeout: float
+        :return: list[pcap_packet.PCAPPacket]
+        """
+        return _batch_packets(pytcpcap.get_packets(
+            self.handle, max_count, -1.0 if timeout is None else timeout))
+
+    def stats(self):
+        """
+        :return: (int, int, int) Packets received, dropped because the
+        ring was full, and dropped by the kernel
+        """
+        return pytcpcap.stats(self.handle)
 
     def close(self):
+        if self.handle is None:
+            return
         pytcpcap.stop(self.handle)
-        self._server_thread.join()
+        if self._loop_thread is not None:
+            self._loop_thread.join()
+        pytcpcap.close(self.handle)
+        self.handle = None
+
+
+class AsyncPcap(Pcap):
+    """
+    Packet capture without a loop thread: the pcap handle is put in
+    non-blocking mode and its selectable file descriptor is exposed through
+    fileno, so the capture can sit in a select loop (select.select([cap],
+    [], [])) next to other sockets, and dispatch reads whatever is waiting.
+    Under asyncio, "async for packet in cap" waits for packets with the
+    event loop's reader callbacks instead.
+    """
+
+    def __init__(self, device, filter_str="", snaplen=PCAP_SNAPLEN):
+        """
+        :type device: str
+        :param filter_str: str | pcap_rules.Rule
+        :type snaplen: int
+        """
+        Pcap.__init__(self, device, filter_str, snaplen, ring_size=1)
+        self.fd = None
+        """ :type: int"""
+        self.closed = False
+        self._buffer = collections.deque()
+        """ :type: collections.deque[pcap_packet.PCAPPacket]"""
+        self._waiter = None
+        self._waiter_loop = None
+
+    def start_capture(self):
+        try:
+            pytcpcap.start(self.handle)
+            self.fd = pytcpcap.selectable_fd(self.handle)
+        except RuntimeError as e:
+            raise exceptions.SubprocessFailedException(str(e))
+
+    def fileno(self):
+        return self.fd
+
+    def dispatch(self, max_count=-1):
+        """
+        Read the packets waiting on the handle (at most max_count, if not
+        -1) without blocking.
+        :type max_count: int
+        :return: list[pcap_packet.PCAPPacket]
+        """
+        packets = list(self._buffer)
+        self._buffer.clear()
+        if max_count == -1 or len(packets) < max_count:
+            try:
+                packets += _batch_packets(pytcpcap.dispatch(
+                    self.handle,
+                    -1 if max_count == -1 else max_count - len(packets)))
+            except RuntimeError as e:
+                raise exceptions.SubprocessFailedException(str(e))
+        if max_count != -1:
+            self._buffer.extend(packets[max_count:])
+            del packets[max_count:]
+        return packets
+
+    def get_packets(self, max_count=0, timeout=0):
+        """
+        Take the waiting packets (at most max_count, if set), selecting on
+        the handle for up to timeout seconds (forever if None) if there are
+        none yet.
+        :type max_count: int
+        :type timeout: float
+        :return: list[pcap_packet.PCAPPacket]
+        """
+        max_count = max_count or -1
+        deadline = None if timeout is None else time.time() + timeout
+        packets = self.dispatch(max_count)
+        while not packets and not self.closed:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                break
+            select.select([self], [], [], remaining)
+            packets = self.dispatch(max_count)
+        return packets
+
+    def __iter__(self):
+        while not self.closed:
+            for packet in self.get_packets(timeout=None):
+                yield packet
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        """
+        :return: asyncio.Future Resolves to the next packet, or raises
+        StopAsyncIteration once the capture is closed
+        """
+        import asyncio
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        if not self._buffer and not self.closed:
+            self._buffer.extend(self.dispatch())
+        if self._buffer:
+            future.set_result(self._buffer.popleft())
+        elif self.closed:
+            future.set_exception(StopAsyncIteration())
+        else:
+            self._waiter = future
+            self._waiter_loop = loop
+            loop.add_reader(self.fd, self._on_readable)
+        return future
+
+    def _on_readable(self):
+        self._buffer.extend(self.dispatch())
+        if self._buffer:
+            self._resolve_waiter()
+
+    def _resolve_waiter(self, exception=None):
+        future, loop = self._waiter, self._waiter_loop
+        self._waiter = self._waiter_loop = None
+        loop.remove_reader(self.fd)
+        # A cancelled waiter leaves its packet buffered for the next one
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(self._buffer.popleft())
+
+    def close(self):
+        self.closed = True
+        if self._waiter is not None:
+            self._resolve_waiter(exception=StopAsyncIteration())
+        Pcap.close(self)
@@ -1,3 +1,6 @@
+import copy
+import struct
+
 from python_utils.common import exceptions
 
 ETHERNET_PROTOCOL_TYPE_IP4 = 0x0800
@@ -11,6 +14,9 @@ IP4_PROTOCOL_ICMP = 1
 IP4_PROTOCOL_TCP = 6
 IP4_PROTOCOL_UDP = 17
 
+IP4_FLAG_DONT_FRAGMENT = 0x2
+IP4_FLAG_MORE_FRAGMENTS = 0x1
+
 TCP_PROTOCOL_FLAG_NS = 0x100
 TCP_PROTOCOL_FLAG_CWS = 0x80
 TCP_PROTOCOL_FLAG_ECE = 0x40
@@ -45,14 +51,60 @@ ICMP_PROTOCOL_DU_CODE_COMM_PROHIBIT = 13
 ICMP_PROTOCOL_DU_CODE_HOST_PRECEDENCE_VIOLATION = 14
 ICMP_PROTOCOL_DU_CODE_PRECEDENCE_CUTOFF = 15
 
+# Precompiled (network byte order) decoders for each layer's fixed header
+ETHERNET_HEADER = struct.Struct('!6B6BH')
+SLL_HEADER = struct.Struct('!6x6B2xH')
+IP4_HEADER = struct.Struct('!BBHHHBBH4B4B')
+ARP_HEADER = struct.Struct('!HHBBH')
+TCP_HEADER = struct.Struct('!HHIIBBHHH')
+UDP_HEADER = struct.Struct('!HHHH')
+ICMP_HEADER = struct.Struct('!BBH')
+
+# Decoders for just the fields needed to find a layer's bounds and the
+# next layer's parser (see PCAPEncapsulatedLayer.locate_layer)
+ETHERNET_TYPE = struct.Struct('!12xH')
+SLL_TYPE = struct.Struct('!14xH')
+IP4_DISPATCH = struct.Struct('!B5xHxB')
+TCP_DATA_OFFSET = struct.Struct('!12xB')
+
+
+def unpack_header(header, packet_data, offset):
+    """
+    Decodes a fixed-size header from the packet data at the given offset
+    with a single call to the precompiled struct.  Lists of ints (the
+    legacy packet representation) have just the header's bytes converted
+    before decoding.
+    :param header: struct.Struct
+    :param packet_data: list[int] | bytearray | bytes | memoryview
+    :param offset: int
+    :return: tuple
+    """
+    if isinstance(packet_data, list):
+        return header.unpack(
+            bytearray(packet_data[offset:offset + header.size]))
+    return header.unpack_from(packet_data, offset)
+
 
 class PCAPPacket(object):
+    """
+    A captured packet and its parsed layers.  Packets (and their layers)
+    are slotted and only allocate error information when a parse error
+    actually occurs, so large captures can be kept in memory.  The target
+    is for a parsed Ethernet/IP4/TCP packet backed by a bytes buffer to
+    cost under 1KB on top of the frame's own data (64-bit CPython) when
+    parsed eagerly, and about 600 bytes when parsed lazily and left
+    undecoded.
+    """
+
+    __slots__ = ('timestamp', 'packet_data', '_layers', '_parse_errors',
+                 '_layer_data', '_extra_data')
 
     @staticmethod
     def char8_to_int16(char_msb, char_lsb):
         """
         Converts two 'char's into a single int in "Big-Endian" fashion and
-        returns the new 16-bit integer.
+        returns the new 16-bit integer.  Kept for compatibility, the layers
+        decode their headers with the precompiled structs instead.
         :param char_msb: int Most significant byte
         :param char_lsb: int Least significant byte
         :return: int
@@ -63,7 +115,8 @@ class PCAPPacket(object):
     def char8_to_int32(char_msbh, char_msbl, char_lsbh, char_lsbl):
         """
         Converts four 'char's into a single int in "Big-Endian" fashion and
-        returns the new 32-bit integer.
+        returns the new 32-bit integer.  Kept for compatibility, the layers
+        decode their headers with the precompiled structs instead.
         :param char_msbh: int Most significant byte
         :param char_msbl: int 2nd most significant byte
         :param char_lsbh: int 3rd byte
@@ -108,41 +161,155 @@ class PCAPPacket(object):
 
     def __init__(self, packet_data, timestamp):
         """
-        :param packet_data: list[int]
+        The packet data may either be a list of ints (one per octet), or a
+        bytes-like object (bytes, bytearray, memoryview).  In the latter
+        case, the packet is parsed in place: every layer only records the
+        offsets of its header and payload in the shared buffer, and no
+        per-layer copies of the data are made.
+        :param packet_data: list[int] | bytes | bytearray | memoryview
         :param timestamp: str
         """
         self.timestamp = timestamp
         self.packet_data = packet_data
-        self.layer_data = {}
+        self._layers = ()
+        """ :type: tuple[PCAPEncapsulatedLayer] """
+        self._parse_errors = None
+        """ :type: list[(class, str, bool)] """
+        self._layer_data = None
         """ :type: dict[str, PCAPEncapsulatedLayer] """
-        self.extra_data = {}
+        self._extra_data = None
         """ :type: dict[str, list[str]] """
 
+    @property
+    def layer_data(self):
+        """
+        The parsed layers keyed by their layer names.  The packet only
+        keeps the layers in parse order, so this map is built on first
+        access.  It is then kept (along with anything written to it) until
+        the packet is parsed again, though get_layer only looks at the
+        parsed layers.
+        :return: dict[str, PCAPEncapsulatedLayer]
+        """
+        if self._layer_data is None:
+            self._layer_data = self._layer_map()
+        return self._layer_data
+
+    def _layer_map(self):
+        return dict((l.layer_name(), l) for l in self._layers)
+
+    @property
+    def extra_data(self):
+        """
+        Information about the last parse: the classes and layer types used
+        and the errors hit per layer type (as 'parse_errors.<type>').  Like
+        layer_data, this map is built on first access and then kept until
+        the packet is parsed again.
+        :return: dict[str, list[str]]
+        """
+        if self._extra_data is None:
+            self._extra_data = self._build_extra_data()
+        return self._extra_data
+
+    def _build_extra_data(self):
+        if not self._layers and self._parse_errors is None:
+            return {}
+        parse_classes = [type(l) for l in self._layers]
+        errors = self._parse_errors if self._parse_errors is not None else []
+        if len(errors) > 0 and errors[-1][2] is True:
+            # The layer which failed fatally wasn't added to the packet
+            parse_classes.append(errors[-1][0])
+
+        ret = {'parse_classes': [c.__name__ for c in parse_classes],
+               'parse_types': [c.layer_name() for c in parse_classes]}
+        for c in parse_classes:
+            ret['parse_errors.' + c.layer_name()] = []
+        for c, info, _ in errors:
+            ret['parse_errors.' + c.layer_name()].append(info)
+        return ret
+
     def __iter__(self):
-        return iter(self.layer_data)
+        # Doesn't build (and keep) layer_data if it hasn't been accessed
+        return iter(self._layer_data if self._layer_data is not None
+                    else self._layer_map())
+
+    def __contains__(self, layer_name):
+        return self.get_layer(layer_name) is not None
 
     def to_str(self):
         ret_str = 'PACKET { time[' + str(self.timestamp) + '] '
-        for n, l in self.layer_data.iteritems():
-            ret_str += '<layer [' + n + '] ' + l.to_str() + '>'
+        for l in self._layers:
+            ret_str += '<layer [' + l.layer_name() + '] ' + l.to_str() + '>'
         ret_str += '}'
         return ret_str
 
     def get_data(self):
         return self.layer_data
 
-    def parse(self, parse_class_stack=None):
+    def get_layer(self, layer_name):
+        """
+        Returns the parsed layer with the given name, or None if no such
+        layer was parsed.  Cheaper than going through 'layer_data'.
+        :param layer_name: str
+        :return: PCAPEncapsulatedLayer
+        """
+        for l in reversed(self._layers):
+            if l.layer_name() == layer_name:
+                return l
+        return None
+
+    def get_payload(self, layer_name):
+        """
+        Returns the payload carried by the given parsed layer (i.e. the data
+        following that layer's header).  For bytes-backed packets this is a
+        memoryview into the packet buffer, so no data is copied.
+        :param layer_name: str
+        :return: list[int] | memoryview
         """
+        layer = self.get_layer(layer_name)
+        if layer is None:
+            raise exceptions.ObjectNotFoundException(
+                'Layer [' + layer_name + '] not parsed in packet')
+        if isinstance(self.packet_data, list):
+            return self.packet_data[layer.payload_offset:layer.layer_end]
+        return memoryview(self.packet_data)[
+            layer.payload_offset:layer.layer_end]
+
+    def parse(self, parse_class_stack=None, lazy=False):
+        """
+        Parse the packet's layers (see parse_layers), returning the packet's
+        layer_data map.
         :param parse_class_stack: list[class] Stack of classes to parse
         packet (highest layer first in list)
+        :param lazy: bool
         :return: dict[str, PCAPEncapsulatedLayer]
         """
+        self.parse_layers(parse_class_stack, lazy)
+        return self.layer_data
 
-        self.extra_data['parse_classes'] = []
-        self.extra_data['parse_types'] = []
+    def parse_layers(self, parse_class_stack=None, lazy=False):
+        """
+        Parse the packet's layers, without building the layer_data map
+        (for callers which only look layers up with get_layer, 'in' or
+        iteration).  If 'lazy' is set, only the layers' bounds and the
+        next layer to parse are found here, and the rest of each layer's
+        fields (including the MAC/IP address strings) are decoded the
+        first time one of them is accessed.
+        :param parse_class_stack: list[class] Stack of classes to parse
+        packet (highest layer first in list)
+        :param lazy: bool
+        """
+
+        layers = []
+        self._layers = ()
+        self._parse_errors = None
+        self._layer_data = None
+        self._extra_data = None
 
-        # Start parsing with the whole packet (starting from Link-Layer)
-        current_data = self.packet_data
+        # Start parsing with the whole packet (starting from Link-Layer).
+        # Each layer is handed the shared packet buffer along with the
+        # offset where its own data starts, so the data is never copied.
+        current_offset = 0
+        data_end = len(self.packet_data)
 
         # By default, the parsing stack is None, which tells us to figure
         # it out automatically, so let's start with Ethernet_II, as it's
@@ -158,38 +325,40 @@ class PCAPPacket(object):
         # If there are no more parsers to run in the stack, finish up
         while parse_class_name is not None:
 
-            # Check type and set up some extra information about the classes
-            # used to parse
-            if not isinstance(parse_class_name(), PCAPEncapsulatedLayer):
+            # Check type of the classes used to parse
+            if not (isinstance(parse_class_name, type) and
+                    issubclass(parse_class_name, PCAPEncapsulatedLayer)):
                 raise exceptions.ArgMismatchException(
                     'Parsing classes must be of type "PCAPEncapsulatedLayer"')
 
-            self.extra_data['parse_classes'].append(
-                parse_class_name.__name__)
-            self.extra_data['parse_types'].append(
-                parse_class_name.layer_name())
-            self.extra_data['parse_errors.' +
-                            parse_class_name.layer_name()] = []
-
             # Instantiate the object based on the class given as the
             # "next parser"
             link_obj = parse_class_name()
             """ :type: PCAPEncapsulatedLayer"""
 
             try:
-                # Parse the current packet data and set the result as the
-                # new packet data for the
-                #  next layer to parse.
-                current_data = link_obj.parse_layer(current_data)
+                # Parse the current layer and set the returned payload
+                # offset as the start of the data for the next layer to
+                # parse.
+                if lazy:
+                    current_offset = link_obj.locate_layer(
+                        self.packet_data, current_offset, data_end)
+                else:
+                    current_offset = link_obj.decode_layer(
+                        self.packet_data, current_offset, data_end)
             except exceptions.PacketParsingException as e:
-                self.extra_data['parse_errors.' +
-                                parse_class_name.layer_name()].append(e.info)
+                # Error information is only allocated when errors happen
+                if self._parse_errors is None:
+                    self._parse_errors = []
+                self._parse_errors.append((parse_class_name, e.info,
+                                           e.fatal is True))
                 if e.fatal is True:
+                    self._layers = tuple(layers)
                     raise e
 
-            # Set the item in the data map with the parsed object keyed to
-            # the name the object itself uses to access the data
-            self.layer_data[parse_class_name.layer_name()] = link_obj
+            # Add the parsed object to the packet's layers, which are looked
+            # up by the name the object itself uses to access the data
+            layers.append(link_obj)
 
             # If the last parser recommended a parser for the rest of the
             # data and there were no other parsers configured manually to
@@ -207,7 +376,7 @@ class PCAPPacket(object):
                 # None", that signals us to stop parsing and finish the loop.
                 parse_class_name = parse_class_stack.pop()
 
-        return self.layer_data
+        self._layers = tuple(layers)
 
     def __str__(self):
         return self.to_str()
@@ -217,6 +386,21 @@ class PCAPPacket(object):
 
 
 class PCAPEncapsulatedLayer(object):
+    """
+    Base class for all packet layers.  Built-in layers are split into two
+    decoding steps: 'locate_layer' validates the header, records the layer's
+    bounds in the packet buffer and picks the next layer's parser, while
+    '_decode_fields' decodes the rest of the header fields (listed in
+    'lazy_fields' with their default values).  When a packet is parsed
+    lazily, the second step only runs the first time one of those fields
+    is accessed.  Layers are slotted to keep captured packets compact.
+    """
+
+    __slots__ = ('next_parse_recommendation', 'layer_offset',
+                 'payload_offset', 'layer_end', '_pending_data')
+
+    lazy_fields = {}
+    """ :type: dict[str, T] """
 
     @staticmethod
     def layer_name():
@@ -230,6 +414,24 @@ class PCAPEncapsulatedLayer(object):
 
     def __init__(self):
         self.next_parse_recommendation = None
+        self.layer_offset = 0
+        """ :type: int """
+        self.payload_offset = 0
+        """ :type: int """
+        self.layer_end = 0
+        """ :type: int """
+        self._pending_data = None
+        """ :type: list[int] | bytearray | bytes | memoryview """
+
+    def __getattr__(self, name):
+        # Only called when the attribute isn't set, which for the lazy
+        # fields means they haven't been decoded (yet).
+        if name not in type(self).lazy_fields:
+            raise AttributeError(name)
+        if self._pending_data is None:
+            return copy.copy(type(self).lazy_fields[name])
+        self._decode_pending()
+        return object.__getattribute__(self, name)
 
     def to_str(self):
         return ''
@@ -240,14 +442,91 @@ class PCAPEncapsulatedLayer(object):
         the packet
         :return: list[int]
         """
+        if not self.lazy_fields:
+            raise exceptions.PacketParsingException(
+                "Base layer class shouldn't be used directly.  "
+                "Use a specific layer type instead.",
+                fatal=False)
+        return packet_data[self.decode_layer(packet_data, 0,
+                                             len(packet_data)):]
+
+    def decode_layer(self, packet_data, offset, end):
+        """
+        Decodes this layer in place from the shared packet buffer, starting
+        at 'offset' and with the layer's data ending at 'end'.  The offsets
+        of the layer and its payload are recorded on the object, and the
+        payload's offset (i.e. where the next layer starts) is returned.
+
+        Layers which only implement 'parse_layer' are handed a slice of the
+        data instead, so they keep working unchanged.
+        :param packet_data: list[int] | bytearray | bytes | memoryview
+        :param offset: int
+        :param end: int
+        :return: int
+        """
+        if not self.lazy_fields:
+            self.layer_offset = offset
+            self.layer_end = end
+            self.payload_offset = end
+            remaining = self.parse_layer(packet_data[offset:end])
+            self.payload_offset = end - len(remaining)
+            return self.payload_offset
+
+        try:
+            return self.locate_layer(packet_data, offset, end)
+        finally:
+            # Decode the fields even if a non-fatal error was raised after
+            # the layer's bounds were found
+            if self._pending_data is not None:
+                self._decode_pending()
+
+    def locate_layer(self, packet_data, offset, end):
+        """
+        Finds the layer's bounds and the next layer's parser, leaving the
+        rest of the fields to be decoded on first access.  Returns the
+        payload's offset, like 'decode_layer'.
+        :param packet_data: list[int] | bytearray | bytes | memoryview
+        :param offset: int
+        :param end: int
+        :return: int
+        """
+        if not self.lazy_fields:
+            return self.decode_layer(packet_data, offset, end)
         raise exceptions.PacketParsingException(
             "Base layer class shouldn't be used directly.  "
             "Use a specific layer type instead.",
             fatal=False)
 
+    def _decode_fields(self, packet_data, offset):
+        """
+        :param packet_data: list[int] | bytearray | bytes | memoryview
+        :param offset: int
+        """
+        pass
+
+    def _decode_pending(self):
+        # Only mark the layer decoded once every field is set: a thread
+        # reading a field meanwhile decodes it again (to the same values)
+        # instead of getting the default, and a failed decode is retried
+        # (and fails again) on the next access
+        packet_data = self._pending_data
+        self._decode_fields(packet_data, self.layer_offset)
+        self._pending_data = None
+
+    def _set_layer_bounds(self, packet_data, offset, payload_offset, end):
+        self.layer_offset = offset
+        self.payload_offset = payload_offset
+        self.layer_end = end
+        self._pending_data = packet_data
+        return payload_offset
+
 
 class PCAPEthernet(PCAPEncapsulatedLayer):
 
+    __slots__ = ('type', 'dest_mac', 'source_mac')
+
+    lazy_fields = {'dest_mac': '', 'source_mac': ''}
+
     @staticmethod
     def layer_name():
         """
@@ -257,10 +536,6 @@ class PCAPEthernet(PCAPEncapsulatedLayer):
 
     def __init__(self):
         super(PCAPEthernet, self).__init__()
-        self.dest_mac = ''
-        """ :type: str """
-        self.source_mac = ''
-        """ :type: str """
         self.type = 0
         """ :type: int """
 
@@ -269,10 +544,12 @@ class PCAPEthernet(PCAPEncapsulatedLayer):
                self.dest_mac + '] ' + \
                'type[0x' + '{0:04x}'.format(self.type) + ']'
 
-    def parse_layer(self, packet_data):
+    def locate_layer(self, packet_data, offset, end):
         """
-        :type packet_data: list[int]
-        :return: list[int]
+        :type packet_data: list[int] | bytearray | bytes | memoryview
+        :type offset: int
+        :type end: int
+        :return: int
 
         Ethernet_II frame structure:
         6 bytes - dest_mac
@@ -281,15 +558,15 @@ class PCAPEthernet(PCAPEncapsulatedLayer):
         """
         # First, check length of packet to make sure it is at least long
         # enough for the header
-        if len(packet_data) < 14:
+        if end - offset < 14:
             raise exceptions.PacketParsingException(
                 'Ethernet layer data must at least be 14 bytes, '
                 'but packet size is [' +
-                str(len(packet_data)) + ']', fatal=True)
+                str(end - offset) + ']', fatal=True)
 
-        self.dest_mac = PCAPPacket.char8_to_mac_address(*packet_data[0:6])
-        self.source_mac = PCAPPacket.char8_to_mac_address(*packet_data[6:12])
-        self.type = PCAPPacket.char8_to_int16(*packet_data[12:14])
+        self._set_layer_bounds(packet_data, offset,
+                               offset + ETHERNET_HEADER.size, end)
+        self.type = unpack_header(ETHERNET_TYPE, packet_data, offset)[0]
 
         # Otherwise, judge based on the type from our built-ins
         if self.type == 0x0800:
@@ -301,11 +578,20 @@ class PCAPEthernet(PCAPEncapsulatedLayer):
                 "No known handler for Ethernet type: " +
                 str(self.type), fatal=False)
 
-        return packet_data[14:]
+        return self.payload_offset
+
+    def _decode_fields(self, packet_data, offset):
+        header = unpack_header(ETHERNET_HEADER, packet_data, offset)
+        self.dest_mac = PCAPPacket.char8_to_mac_address(*header[0:6])
+        self.source_mac = PCAPPacket.char8_to_mac_address(*header[6:12])
 
 
 class PCAPSLL(PCAPEncapsulatedLayer):
 
+    __slots__ = ('type', 'dest_mac', 'source_mac')
+
+    lazy_fields = {'dest_mac': '', 'source_mac': ''}
+
     @staticmethod
     def layer_name():
         """
@@ -315,10 +601,6 @@ class PCAPSLL(PCAPEncapsulatedLayer):
 
     def __init__(self):
         super(PCAPSLL, self).__init__()
-        self.dest_mac = ''
-        """ :type: str """
-        self.source_mac = ''
-        """ :type: str """
         self.type = 0
         """ :type: int """
 
@@ -327,10 +609,12 @@ class PCAPSLL(PCAPEncapsulatedLayer):
                self.dest_mac + '] ' + \
                'type[0x' + '{0:04x}'.format(self.type) + ']'
 
-    def parse_layer(self, packet_data):
+    def locate_layer(self, packet_data, offset, end):
         """
-        :type packet_data: list[int]
-        :return: list[int]
+        :type packet_data: list[int] | bytearray | bytes | memoryview
+        :type offset: int
+        :type end: int
+        :return: int
 
         If Linux-Cooked (SLL) link-layer (i.e. the 'any' interface was used):
         6 bytes - Linux Cooked Protocol info
@@ -340,15 +624,15 @@ class PCAPSLL(PCAPEncapsulatedLayer):
         """
         # First, check length of packet to make sure it is at least long
         # enough for the header
-        if len(packet_data) < 16:
+        if end - offset < 16:
             raise exceptions.PacketParsingException(
                 "'Linux-cooked' layer data must at least be 16 bytes, "
                 "but packet size is [" +
-                str(len(packet_data)) + ']', fatal=True)
+                str(end - offset) + ']', fatal=True)
 
-        self.dest_mac = PCAPPacket.char8_to_mac_address(*([0] * 6))
-        self.source_mac = PCAPPacket.char8_to_mac_address(*packet_data[6:12])
-        self.type = PCAPPacket.char8_to_int16(packet_data[14], packet_data[15])
+        self._set_layer_bounds(packet_data, offset,
+                               offset + SLL_HEADER.size, end)
+        self.type = unpack_header(SLL_TYPE, packet_data, offset)[0]
 
         # Otherwise, judge based on the type from our built-ins
         if self.type == 0x0800:
@@ -360,11 +644,23 @@ class PCAPSLL(PCAPEncapsulatedLayer):
                 "Encapsulated type [" +
                 str(self.type) + "] unknown", fatal=False)
 
-        return packet_data[16:]
+        return self.payload_offset
+
+    def _decode_fields(self, packet_data, offset):
+        header = unpack_header(SLL_HEADER, packet_data, offset)
+        self.dest_mac = PCAPPacket.char8_to_mac_address(*([0] * 6))
+        self.source_mac = PCAPPacket.char8_to_mac_address(*header[0:6])
 
 
 class PCAPIP4(PCAPEncapsulatedLayer):
 
+    __slots__ = ('version', 'header_length', 'protocol', 'flags',
+                 'fragment_offset', 'total_length', 'id', 'ttl',
+                 'source_ip', 'dest_ip')
+
+    lazy_fields = {'total_length': 0, 'id': 0, 'ttl': 0, 'source_ip': '',
+                   'dest_ip': ''}
+
     @staticmethod
     def layer_name():
         """
@@ -380,10 +676,20 @@ class PCAPIP4(PCAPEncapsulatedLayer):
         """ :type: int """
         self.protocol = 0
         """ :type: int """
-        self.source_ip = ''
-        """ :type: str """
-        self.dest_ip = ''
-        """ :type: str """
+        self.flags = 0
+        """ :type: int """
+        self.fragment_offset = 0
+        """ :type: int In 8-byte units"""
+
+    def is_flag_set(self, flag):
+        return self.flags & flag != 0
+
+    def is_fragment(self):
+        """
+        :return: bool Whether the layer carries part of a datagram
+        """
+        return self.is_flag_set(IP4_FLAG_MORE_FRAGMENTS) or \
+            self.fragment_offset != 0
 
     def to_str(self):
         return 'ver[' + str(self.version) + '] ' + 'h_len[' + \
@@ -392,10 +698,12 @@ class PCAPIP4(PCAPEncapsulatedLayer):
                self.source_ip + '] ' + \
                'd_ip[' + self.dest_ip + ']'
 
-    def parse_layer(self, packet_data):
+    def locate_layer(self, packet_data, offset, end):
         """
-        :type packet_data: list[int]
-        :return: list[int]
+        :type packet_data: list[int] | bytearray | bytes | memoryview
+        :type offset: int
+        :type end: int
+        :return: int
 
         If IP, the packet will look like this with word, word offset, and
         total offset followed by size of field):
@@ -415,13 +723,17 @@ class PCAPIP4(PCAPEncapsulatedLayer):
         """
         # First, check length of packet to make sure it is at least long
         # enough for the header
-        if len(packet_data) < 20:
+        if end - offset < 20:
             raise exceptions.PacketParsingException(
                 'IP layer data must at least be 20 bytes, '
                 'but packet size is [' +
-                str(len(packet_data)) + ']', fatal=True)
+                str(end - offset) + ']', fatal=True)
 
-        self.version = (packet_data[0] & 0xf0) >> 4
+        version_length, flags_fragment, self.protocol = unpack_header(
+            IP4_DISPATCH, packet_data, offset)
+        self.version = (version_length & 0xf0) >> 4
+        self.flags = flags_fragment >> 13
+        self.fragment_offset = flags_fragment & 0x1fff
 
         # Version must be either 4 or 6, no exceptions
         if self.version != 4 and self.version != 6:
@@ -429,7 +741,7 @@ class PCAPIP4(PCAPEncapsulatedLayer):
                 'IP version must be either 4 or 6, but it was [' +
                 str(self.version) + ']', fatal=True)
 
-        self.header_length = packet_data[0] & 0x0f
+        self.header_length = version_length & 0x0f
 
         # Do a sanity check on header length vs. packet size
         if self.header_length < 5:
@@ -437,13 +749,23 @@ class PCAPIP4(PCAPEncapsulatedLayer):
                 'IP header length field must be at least 5, but it was [' +
                 str(self.header_length), fatal=True)
 
-        if (self.header_length * 4) > len(packet_data):
+        if (self.header_length * 4) > end - offset:
             raise exceptions.PacketParsingException(
                 'IP header length field specifies length [' +
                 str(self.header_length) + '] longer than the packet size [' +
-                str(len(packet_data)) + ']!', fatal=True)
+                str(end - offset) + ']!', fatal=True)
 
-        self.protocol = packet_data[9]
+        # Remember, header length is in 4-octet words, so multiply by 4 to
+        # get the data's starting byte
+        self._set_layer_bounds(packet_data, offset,
+                               offset + (self.header_length * 4), end)
+
+        # Only the first fragment of a datagram starts with the next
+        # layer's header (see ip_reassembly for putting datagrams back
+        # together)
+        if self.fragment_offset != 0:
+            self.next_parse_recommendation = None
+            return self.payload_offset
 
         # Otherwise, judge based on the type from our built-ins
         if self.protocol == IP4_PROTOCOL_TCP:
@@ -457,22 +779,34 @@ class PCAPIP4(PCAPEncapsulatedLayer):
                 "IP protocol [" +
                 str(self.protocol) + "] unknown", fatal=False)
 
-        self.source_ip = PCAPPacket.char8_to_ip4(packet_data[12],
-                                                 packet_data[13],
-                                                 packet_data[14],
-                                                 packet_data[15])
-        self.dest_ip = PCAPPacket.char8_to_ip4(packet_data[16],
-                                               packet_data[17],
-                                               packet_data[18],
-                                               packet_data[19])
+        return self.payload_offset
 
-        # Remember, header length is in 4-octet words, so multiply by 4 to
-        # get the data's starting byte
-        return packet_data[(self.header_length * 4):]
+    def _decode_fields(self, packet_data, offset):
+        header = unpack_header(IP4_HEADER, packet_data, offset)
+        self.total_length, self.id = header[2:4]
+        self.ttl = header[5]
+        self.source_ip = PCAPPacket.char8_to_ip4(*header[8:12])
+        self.dest_ip = PCAPPacket.char8_to_ip4(*header[12:16])
 
 
 class PCAPARP(PCAPEncapsulatedLayer):
 
+    __slots__ = ('hw_type', 'proto_type', 'hw_addr_length',
+                 'proto_addr_length', 'operation', 'sender_hw_addr_raw',
+                 'sender_hw_addr_ether', 'sender_proto_addr_raw',
+                 'sender_ip_addr', 'target_hw_addr_raw',
+                 'target_hw_addr_ether', 'target_proto_addr_raw',
+                 'target_ip_addr')
+
+    lazy_fields = {'sender_hw_addr_raw': '',
+                   'sender_hw_addr_ether': '',
+                   'sender_proto_addr_raw': '',
+                   'sender_ip_addr': '',
+                   'target_hw_addr_raw': '',
+                   'target_hw_addr_ether': '',
+                   'target_proto_addr_raw': '',
+                   'target_ip_addr': ''}
+
     @staticmethod
     def layer_name():
         """
@@ -492,22 +826,6 @@ class PCAPARP(PCAPEncapsulatedLayer):
         """ :type: int """
         self.operation = 0
         """ :type: int """
-        self.sender_hw_addr_raw = ''
-        """ :type: list[int] """
-        self.sender_hw_addr_ether = ''
-        """ :type: str """
-        self.sender_proto_addr_raw = ''
-        """ :type: list[int] """
-        self.sender_ip_addr = ''
-        """ :type: str """
-        self.target_hw_addr_raw = ''
-        """ :type: list[int] """
-        self.target_hw_addr_ether = ''
-        """ :type: str """
-        self.target_proto_addr_raw = ''
-        """ :type: list[int] """
-        self.target_ip_addr = ''
-        """ :type: str """
 
     def to_str(self):
         return 'hw_type[' + str(self.hw_type) + '] ' + 'p_type[' + \
@@ -518,10 +836,12 @@ class PCAPARP(PCAPEncapsulatedLayer):
                self.sender_ip_addr + '] ' + \
                'd_ip[' + self.target_ip_addr + ']'
 
-    def parse_layer(self, packet_data):
+    def locate_layer(self, packet_data, offset, end):
         """
-        :type packet_data: list[int]
-        :return: list[int]
+        :type packet_data: list[int] | bytearray | bytes | memoryview
+        :type offset: int
+        :type end: int
+        :return: int
 
         If IP, the packet will look like this with word, word offset, and
         total offset followed by size of field):
@@ -539,33 +859,46 @@ class PCAPARP(PCAPEncapsulatedLayer):
         """
         # First, check length of packet to make sure it is at least long
         # enough for the header
-        if len(packet_data) < 12:
+        if end - offset < 12:
             raise exceptions.PacketParsingException(
                 'ARP layer data must at least be 12 bytes, '
                 'but packet size is [' +
-                str(len(packet_data)) + ']', fatal=True)
+                str(end - offset) + ']', fatal=True)
 
-        self.hw_type = PCAPPacket.char8_to_int16(packet_data[0],
-                                                 packet_data[1])
-        self.proto_type = PCAPPacket.char8_to_int16(packet_data[2],
-                                                    packet_data[3])
-        self.hw_addr_length = packet_data[4]
-        self.proto_addr_length = packet_data[5]
-        self.operation = PCAPPacket.char8_to_int16(packet_data[6],
-                                                   packet_data[7])
+        (self.hw_type, self.proto_type, self.hw_addr_length,
+         self.proto_addr_length, self.operation) = unpack_header(
+            ARP_HEADER, packet_data, offset)
 
         # Sanity check on packet length now that we know the sizes of the
         # HW and Protocol addresses
         expected_size = (8 + (2 * self.hw_addr_length) +
                          (2 * self.proto_addr_length))
-        if len(packet_data) < expected_size:
+        if end - offset < expected_size:
             raise exceptions.PacketParsingException(
                 'ARP packet size is expected to be [' + str(expected_size) +
                 '] based on set HW and Proto address lengths, '
                 'but the real packet size is [' +
-                str(len(packet_data)) + ']', fatal=True)
+                str(end - offset) + ']', fatal=True)
+
+        target_proto_addr_finish = offset + expected_size
 
-        sender_hw_addr_base = 8
+        self.next_parse_recommendation = None
+        self._set_layer_bounds(packet_data, offset,
+                               target_proto_addr_finish, end)
+
+        if end > target_proto_addr_finish:
+            raise exceptions.PacketParsingException(
+                'ARP packet has junk data at end of packet [' +
+                ', '.join(['0x{0:02x}'.format(i)
+                           for i in bytearray(
+                               packet_data[target_proto_addr_finish:end])]),
+                fatal=False)
+
+        # Payload should be empty, but just in case...
+        return self.payload_offset
+
+    def _decode_fields(self, packet_data, offset):
+        sender_hw_addr_base = offset + 8
         sender_proto_addr_base = sender_hw_addr_base + self.hw_addr_length
         target_hw_addr_base = sender_proto_addr_base + self.proto_addr_length
         target_proto_addr_base = target_hw_addr_base + self.hw_addr_length
@@ -581,32 +914,32 @@ class PCAPARP(PCAPEncapsulatedLayer):
         self.target_proto_addr_raw = \
             packet_data[target_proto_addr_base:target_proto_addr_finish]
 
+        # The raw addresses are slices of the packet data, so make sure
+        # they are formatted from their octet values
         if self.hw_type == ARP_PROTOCOL_HW_TYPE_EHTERNET:
-            self.sender_hw_addr_ether = \
-                PCAPPacket.char8_to_mac_address(*self.sender_hw_addr_raw)
-            self.target_hw_addr_ether = \
-                PCAPPacket.char8_to_mac_address(*self.target_hw_addr_raw)
+            self.sender_hw_addr_ether = PCAPPacket.char8_to_mac_address(
+                *bytearray(self.sender_hw_addr_raw))
+            self.target_hw_addr_ether = PCAPPacket.char8_to_mac_address(
+                *bytearray(self.target_hw_addr_raw))
 
         if self.proto_type == ETHERNET_PROTOCOL_TYPE_IP4:
-            self.sender_ip_addr = \
-                PCAPPacket.char8_to_ip4(*self.sender_proto_addr_raw)
-            self.target_ip_addr = \
-                PCAPPacket.char8_to_ip4(*self.target_proto_addr_raw)
+            self.sender_ip_addr = PCAPPacket.char8_to_ip4(
+                *bytearray(self.sender_proto_addr_raw))
+            self.target_ip_addr = PCAPPacket.char8_to_ip4(
+                *bytearray(self.target_proto_addr_raw))
 
-        self.next_parse_recommendation = None
-
-        if len(packet_data) > target_proto_addr_finish:
-            raise exceptions.PacketParsingException(
-                'ARP packet has junk data at end of packet [' +
-                ', '.join(['0x{0:02x}'.format(i)
-                           for i in packet_data[target_proto_addr_finish:]]),
-                fatal=False)
 
-        # Should be empty, but just in case...
-        return []
+class PCAPTCP(PCAPEncapsulatedLayer):
 
+    __slots__ = ('data_offset', 'source_port', 'dest_port', 'seq', 'ack',
+                 'flags', 'window_size')
 
-class PCAPTCP(PCAPEncapsulatedLayer):
+    lazy_fields = {'source_port': 0,
+                   'dest_port': 0,
+                   'seq': 0,
+                   'ack': 0,
+                   'flags': 0,
+                   'window_size': 0}
 
     def is_flag_set(self, flag):
         return self.flags & flag != 0
@@ -620,20 +953,8 @@ class PCAPTCP(PCAPEncapsulatedLayer):
 
     def __init__(self):
         super(PCAPTCP, self).__init__()
-        self.source_port = 0
-        """ :type: int """
-        self.dest_port = 0
-        """ :type: int """
-        self.seq = 0
-        """ :type: int """
-        self.ack = 0
-        """ :type: int """
         self.data_offset = 0
         """ :type: int """
-        self.flags = 0
-        """ :type: int """
-        self.window_size = 0
-        """ :type: int """
 
     def to_str(self):
         return 's_port[' + str(self.source_port) + '] ' + 'd_port[' + \
@@ -644,10 +965,12 @@ class PCAPTCP(PCAPEncapsulatedLayer):
                'flags[0x' + '{0:02x}'.format(self.flags) + '] ' + \
                'w_size[' + str(self.window_size) + ']'
 
-    def parse_layer(self, packet_data):
+    def locate_layer(self, packet_data, offset, end):
         """
-        :type packet_data: list[int]
-        :return: list[int]
+        :type packet_data: list[int] | bytearray | bytes | memoryview
+        :type offset: int
+        :type end: int
+        :return: int
 
         If TCP, the packet will look like this:
         word 1, 0: total 0:  2 bytes - Source port
@@ -665,25 +988,14 @@ class PCAPTCP(PCAPEncapsulatedLayer):
         """
         # First, check length of packet to make sure it is at least
         # long enough for the header
-        if len(packet_data) < 20:
+        if end - offset < 20:
             raise exceptions.PacketParsingException(
                 'TCP layer data must at least be 20 bytes, '
                 'but packet size is [' +
-                str(len(packet_data)) + ']', fatal=True)
-
-        self.source_port = PCAPPacket.char8_to_int16(packet_data[0],
-                                                     packet_data[1])
-        self.dest_port = PCAPPacket.char8_to_int16(packet_data[2],
-                                                   packet_data[3])
-        self.seq = PCAPPacket.char8_to_int32(packet_data[4],
-                                             packet_data[5],
-                                             packet_data[6],
-                                             packet_data[7])
-        self.ack = PCAPPacket.char8_to_int32(packet_data[8],
-                                             packet_data[9],
-                                             packet_data[10],
-                                             packet_data[11])
-        self.data_offset = (packet_data[12] & 0xF0) >> 4
+                str(end - offset) + ']', fatal=True)
+
+        self.data_offset = (unpack_header(TCP_DATA_OFFSET, packet_data,
+                                          offset)[0] & 0xF0) >> 4
 
         # Sanity check on data offset
         if self.data_offset < 5:
@@ -691,15 +1003,11 @@ class PCAPTCP(PCAPEncapsulatedLayer):
                 'TCP data offset field must be at least 5, but it was [' +
                 str(self.data_offset), fatal=True)
 
-        if self.data_offset > len(packet_data):
+        if self.data_offset > end - offset:
             raise exceptions.PacketParsingException(
                 'TCP data offset field specifies length [' +
                 str(self.data_offset) + '] longer than the packet size [' +
-                str(len(packet_data)) + ']!', fatal=True)
-
-        self.flags = ((packet_data[12] & 0x1) * 0xFF) + packet_data[13]
-        self.window_size = PCAPPacket.char8_to_int16(packet_data[14],
-                                                     packet_data[15])
+                str(end - offset) + ']!', fatal=True)
 
         # TCP is the last parsed packet in our stack.
         # Can add Layer 5-7 here (HTTP, SOAP, etc.)
@@ -707,11 +1015,22 @@ class PCAPTCP(PCAPEncapsulatedLayer):
 
         # Remember, header length is in 4-octet words, so multiply
         # by 4 to get the data's starting byte
-        return packet_data[(self.data_offset * 4):]
+        return self._set_layer_bounds(packet_data, offset,
+                                      offset + (self.data_offset * 4), end)
+
+    def _decode_fields(self, packet_data, offset):
+        (self.source_port, self.dest_port, self.seq, self.ack,
+         offset_ns, flags, self.window_size, _, _) = unpack_header(
+            TCP_HEADER, packet_data, offset)
+        self.flags = ((offset_ns & 0x1) << 8) | flags
 
 
 class PCAPUDP(PCAPEncapsulatedLayer):
 
+    __slots__ = ('source_port', 'dest_port', 'length')
+
+    lazy_fields = {'source_port': 0, 'dest_port': 0, 'length': 0}
+
     @staticmethod
     def layer_name():
         """
@@ -719,24 +1038,17 @@ class PCAPUDP(PCAPEncapsulatedLayer):
         """
         return 'udp'
 
-    def __init__(self):
-        super(PCAPUDP, self).__init__()
-        self.source_port = 0
-        """ :type: int """
-        self.dest_port = 0
-        """ :type: int """
-        self.length = 0
-        """ :type: int """
-
     def to_str(self):
         return 's_port[' + str(self.source_port) + '] ' + 'd_port[' + \
                str(self.dest_port) + '] ' + \
                'len[' + str(self.length) + ']'
 
-    def parse_layer(self, packet_data):
+    def locate_layer(self, packet_data, offset, end):
         """
-        :type packet_data: list[int]
-        :return: list[int]
+        :type packet_data: list[int] | bytearray | bytes | memoryview
+        :type offset: int
+        :type end: int
+        :return: int
 
         If UDP, the packet will look like this:
         word 1, 0: total 0:  2 bytes - Source port
@@ -747,29 +1059,30 @@ class PCAPUDP(PCAPEncapsulatedLayer):
         """
         # First, check length of packet to make sure it is at least long
         # enough for the header
-        if len(packet_data) < 8:
+        if end - offset < 8:
             raise exceptions.PacketParsingException(
                 'UDP layer data must at least be 8 bytes, '
                 'but packet size is [' +
-                str(len(packet_data)) + ']', fatal=True)
-
-        self.source_port = PCAPPacket.char8_to_int16(packet_data[0],
-                                                     packet_data[1])
-        self.dest_port = PCAPPacket.char8_to_int16(packet_data[2],
-                                                   packet_data[3])
-        self.length = PCAPPacket.char8_to_int16(packet_data[4],
-                                                packet_data[5])
+                str(end - offset) + ']', fatal=True)
 
         # UDP is the last parsing step in the standard TCP/IP stack
         self.next_parse_recommendation = None
 
-        # Remember, header length is in 4-octet words, so multiply by
-        # 4 to get the data's starting byte
-        return packet_data[8:]
+        # UDP header is always 8 bytes long
+        return self._set_layer_bounds(packet_data, offset,
+                                      offset + UDP_HEADER.size, end)
+
+    def _decode_fields(self, packet_data, offset):
+        (self.source_port, self.dest_port, self.length, _) = unpack_header(
+            UDP_HEADER, packet_data, offset)
 
 
 class PCAPICMP(PCAPEncapsulatedLayer):
 
+    __slots__ = ('type', 'code', 'header_data')
+
+    lazy_fields = {'type': 0, 'code': 0, 'header_data': []}
+
     @staticmethod
     def layer_name():
         """
@@ -777,24 +1090,17 @@ class PCAPICMP(PCAPEncapsulatedLayer):
         """
         return 'icmp'
 
-    def __init__(self):
-        super(PCAPICMP, self).__init__()
-        self.type = 0
-        """ :type: int """
-        self.code = 0
-        """ :type: int """
-        self.header_data = []
-        """ :type: list[int] """
-
     def to_str(self):
         return 'type[' + str(self.type) + '] ' + 'code[' + \
                str(self.code) + '] ' + \
                'h_data[' + str(self.header_data) + ']'
 
-    def parse_layer(self, packet_data):
+    def locate_layer(self, packet_data, offset, end):
         """
-        :type packet_data: list[int]
-        :return: list[int]
+        :type packet_data: list[int] | bytearray | bytes | memoryview
+        :type offset: int
+        :type end: int
+        :return: int
 
         If UDP, the packet will look like this:
         word 1, 0: total 0: 1 byte  - Type
@@ -805,19 +1111,19 @@ class PCAPICMP(PCAPEncapsulatedLayer):
         """
         # First, check length of packet to make sure it is at least
         # long enough for the header
-        if len(packet_data) < 8:
+        if end - offset < 8:
             raise exceptions.PacketParsingException(
                 'ICMP layer data must at least be 8 bytes, '
                 'but packet size is [' +
-                str(len(packet_data)) + ']', fatal=True)
-
-        self.type = packet_data[0]
-        self.code = packet_data[1]
-        self.header_data = packet_data[4:8]
+                str(end - offset) + ']', fatal=True)
 
         # ICMP is the last parsing step in the standard TCP/IP stack
         self.next_parse_recommendation = None
 
-        # Remember, header length is in 4-octet words, so multiply by
-        # 4 to get the data's starting byte
-        return packet_data[8:]
+        # ICMP header is always 8 bytes long
+        return self._set_layer_bounds(packet_data, offset, offset + 8, end)
+
+    def _decode_fields(self, packet_data, offset):
+        (self.type, self.code, _) = unpack_header(
+            ICMP_HEADER, packet_data, offset)
+        self.header_data = packet_data[offset + 4:offset + 8]
@@ -0,0 +1,287 @@
+import collections
+import copy
+import multiprocessing
+
+from python_utils.common import exceptions
+from python_utils.net import pcap_file
+from python_utils.net import pcap_packet
+
+# Bytes of a pcap file given to a worker at once
+DEFAULT_SHARD_BYTES = 16 * 1024 * 1024
+# Frames copied into a shard at once when they don't come from a file
+DEFAULT_BATCH_SIZE = 10000
+
+FileShard = collections.namedtuple(
+    'FileShard', ['filename', 'start', 'end'])
+""" Byte range of whole records in a libpcap file, which the worker reads
+through its own mapping of the file (so no frame data is pickled). """
+
+BufferShard = collections.namedtuple(
+    'BufferShard', ['linktype', 'data', 'offsets', 'timestamps'])
+""" Frames copied back to back into 'data', frame 'i' spanning
+data[offsets[i]:offsets[i + 1]], all of the 'linktype' link type. """
+
+
+def _frame_bytes(frame_data):
+    """
+    :type frame_data: bytes | bytearray | memoryview | list[int]
+    :return: bytes
+    """
+    if isinstance(frame_data, memoryview):
+        return frame_data.tobytes()
+    if isinstance(frame_data, list):
+        return bytes(bytearray(frame_data))
+    return bytes(frame_data)
+
+
+def _batched_shards(frames, batch_size):
+    """
+    Copies (link type, frame data, timestamp) tuples into BufferShards of
+    up to batch_size frames.  A new shard is started whenever the link
+    type changes.
+    :type frames: collections.Iterable[(int, bytes | memoryview, float)]
+    :type batch_size: int
+    :return: collections.Iterable[BufferShard]
+    """
+    linktype = None
+    data = []
+    offsets = [0]
+    timestamps = []
+    for frame_linktype, frame_data, timestamp in frames:
+        if len(timestamps) > 0 and (len(timestamps) == batch_size or
+                                    frame_linktype != linktype):
+            yield BufferShard(linktype, b''.join(data), offsets, timestamps)
+            data, offsets, timestamps = [], [0], []
+        linktype = frame_linktype
+        data.append(_frame_bytes(frame_data))
+        offsets.append(offsets[-1] + len(data[-1]))
+        timestamps.append(timestamp)
+    if len(timestamps) > 0:
+        yield BufferShard(linktype, b''.join(data), offsets, timestamps)
+
+
+def file_shards(filename, shard_bytes=DEFAULT_SHARD_BYTES,
+                batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Shards a savefile by byte range.  Only the record headers are walked
+    here, each worker maps the file and decodes its own range.  pcapng
+    blocks can't be decoded without the interface blocks before them, so
+    their frames are copied into BufferShards instead.
+    :type filename: str
+    :type shard_bytes: int
+    :type batch_size: int
+    :return: collections.Iterable[FileShard | BufferShard]
+    """
+    with pcap_file.PCAPFileReader(filename) as reader:
+        if not reader.is_pcapng:
+            for start, end in reader.record_ranges(shard_bytes):
+                yield FileShard(filename, start, end)
+            return
+        frames = ((record.linktype, record.data, record.timestamp)
+                  for record in reader.read_records())
+        for shard in _batched_shards(frames, batch_size):
+            yield shard
+
+
+def buffer_shards(buffer_data, offsets, lengths, timestamps=None,
+                  linktype=pcap_file.LINKTYPE_ETHERNET,
+                  batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Shards frames held in one buffer, each given by its offset and length
+    in the buffer (as for pcap_batch.decode_buffer_columns).
+    :type buffer_data: bytes | bytearray | memoryview
+    :type offsets: list[int]
+    :type lengths: list[int]
+    :param timestamps: list[float] Per frame (0.0 for every frame if not
+    given)
+    :type linktype: int
+    :type batch_size: int
+    :return: collections.Iterable[BufferShard]
+    """
+    view = memoryview(buffer_data)
+    if timestamps is None:
+        timestamps = [0.0] * len(offsets)
+    frames = ((linktype, view[offset:offset + length], timestamp)
+              for offset, length, timestamp in zip(offsets, lengths,
+                                                    timestamps))
+    return _batched_shards(frames, batch_size)
+
+
+def packet_shards(packets, linktype=pcap_file.LINKTYPE_ETHERNET,
+                  batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Shards captured packets, such as those from TCPDump.iter_packets.
+    Only the raw frames are sent to the workers, which parse them again.
+    :type packets: collections.Iterable[pcap_packet.PCAPPacket]
+    :type linktype: int
+    :type batch_size: int
+    :return: collections.Iterable[BufferShard]
+    """
+    frames = ((linktype, packet.packet_data, packet.timestamp)
+              for packet in packets)
+    return _batched_shards(frames, batch_size)
+
+
+def shard_packets(shard, parse=True, lazy=False):
+    """
+    Decodes the packets of a shard.
+    :type shard: FileShard | BufferShard
+    :param parse: bool Parse each packet, starting with the layer for
+    the shard's link type
+    :param lazy: bool Parse the packets lazily (see PCAPPacket.parse)
+    :return: list[pcap_packet.PCAPPacket]
+    """
+    if isinstance(shard, FileShard):
+        reader = pcap_file.PCAPFileReader(shard.filename, parse=parse,
+                                          lazy=lazy)
+        try:
+            return list(reader.read_packets(shard.start, shard.end))
+        finally:
+            reader.close()
+
+    link_class = pcap_file.LINK_LAYER_CLASSES.get(shard.linktype)
+    if parse and link_class is None:
+        raise exceptions.PacketParsingException(
+            'No known layer for link type [' + str(shard.linktype) + ']',
+            fatal=True)
+    packets = []
+    for i, timestamp in enumerate(shard.timestamps):
+        packet = pcap_packet.PCAPPacket(
+            shard.data[shard.offsets[i]:shard.offsets[i + 1]], timestamp)
+        if parse:
+            packet.parse_layers([link_class], lazy=lazy)
+        packets.append(packet)
+    return packets
+
+
+def packet_layers(packet):
+    """
+    Summary of a decoded packet, for DecodePool.map.
+    :type packet: pcap_packet.PCAPPacket
+    :return: (float, int, list[str]) Timestamp, frame length and the names
+    of the layers parsed (sorted)
+    """
+    return packet.timestamp, len(packet.packet_data), sorted(packet)
+
+
+def count_layers(packets):
+    """
+    Counts the packets carrying each layer, for DecodePool.aggregate
+    (along with merge_counts).
+    :type packets: list[pcap_packet.PCAPPacket]
+    :return: dict[str, int]
+    """
+    counts = {}
+    for packet in packets:
+        for layer_name in packet:
+            counts[layer_name] = counts.get(layer_name, 0) + 1
+    return counts
+
+
+def merge_counts(counts, other):
+    """
+    :type counts: dict[T, int]
+    :type other: dict[T, int]
+    :return: dict[T, int] counts, with other's counts added
+    """
+    for key, count in other.items():
+        counts[key] = counts.get(key, 0) + count
+    return counts
+
+
+def _map_shard(task):
+    shard, func, parse, lazy = task
+    return [func(packet) for packet in shard_packets(shard, parse, lazy)]
+
+
+def _aggregate_shard(task):
+    shard, func, parse, lazy = task
+    return func(shard_packets(shard, parse, lazy))
+
+
+class DecodePool(object):
+    """
+    Decodes packets across a pool of worker processes.  Inputs are given
+    as shards (see file_shards, buffer_shards and packet_shards), each
+    decoded whole by one worker, and only what the given functions return
+    is sent back.  The functions are pickled, so must be defined at
+    module level.  The worker processes are only started on first use.
+    The pool's threads import modules as they unpickle results, so a
+    pool with workers can't be used while a module is being imported:
+    give processes=0 to decode in the calling process instead.
+    """
+
+    def __init__(self, processes=None, parse=True, lazy=False):
+        """
+        :param processes: int Number of workers (default is one per CPU,
+        0 decodes the shards in the calling process)
+        :param parse: bool Parse the packets before handing them over
+        :param lazy: bool Parse the packets lazily (see PCAPPacket.parse)
+        """
+        self.parse = parse
+        self.lazy = lazy
+        self.processes = processes
+        self.pool = None
+        """ :type: multiprocessing.pool.Pool"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def _tasks(self, shards, func):
+        for shard in shards:
+            yield shard, func, self.parse, self.lazy
+
+    def _imap(self, shard_func, shards, func):
+        tasks = self._tasks(shards, func)
+        if self.processes == 0:
+            return (shard_func(task) for task in tasks)
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+        return self.pool.imap(shard_func, tasks)
+
+    def map(self, shards, func):
+        """
+        Yields func(packet) for every packet, in capture order.  Shards
+        are decoded in parallel, and each shard's results are yielded as
+        soon as it and every shard before it are done.
+        :type shards: collections.Iterable[FileShard | BufferShard]
+        :type func: (pcap_packet.PCAPPacket) -> T
+        :return: collections.Iterable[T]
+        """
+        for results in self._imap(_map_shard, shards, func):
+            for result in results:
+                yield result
+
+    def aggregate(self, shards, func, merge, initial=None):
+        """
+        Reduces every shard's packets with func, then merges the partial
+        results in capture order with merge.
+        :type shards: collections.Iterable[FileShard | BufferShard]
+        :type func: (list[pcap_packet.PCAPPacket]) -> T
+        :type merge: (T, T) -> T
+        :param initial: T Merged with the first partial result (if given),
+        a shallow copy is merged so the caller's object is left untouched
+        :return: T
+        """
+        result = None if initial is None else copy.copy(initial)
+        for partial in self._imap(_aggregate_shard, shards, func):
+            result = partial if result is None else merge(result, partial)
+        return result
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
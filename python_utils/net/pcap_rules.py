@@ -1,4 +1,106 @@
+import operator
+import re
+import socket
+import struct
+
 from python_utils.common.exceptions import *
+from python_utils.net import pcap_packet
+
+# Values for the named protocols tcpdump accepts in filters
+IP_PROTOCOLS = {'icmp': pcap_packet.IP4_PROTOCOL_ICMP,
+                'tcp': pcap_packet.IP4_PROTOCOL_TCP,
+                'udp': pcap_packet.IP4_PROTOCOL_UDP}
+ETHER_PROTOCOLS = {'ip': pcap_packet.ETHERNET_PROTOCOL_TYPE_IP4,
+                   'arp': pcap_packet.ETHERNET_PROTOCOL_TYPE_ARP,
+                   'rarp': pcap_packet.ETHERNET_PROTOCOL_TYPE_RARP,
+                   'ip6': pcap_packet.ETHERNET_PROTOCOL_TYPE_IP6}
+
+# Layer (by layer name) each protocol's byte accessor ('ip[2:2]') indexes
+ACCESSOR_LAYERS = {'ether': 'ethernet', 'arp': 'arp', 'ip': 'ip',
+                   'tcp': 'tcp', 'udp': 'udp', 'icmp': 'icmp'}
+# Named offsets and values tcpdump accepts in comparison expressions
+EXPRESSION_CONSTANTS = {'tcpflags': 13, 'icmptype': 0, 'icmpcode': 1,
+                        'tcp-fin': 0x01, 'tcp-syn': 0x02, 'tcp-rst': 0x04,
+                        'tcp-push': 0x08, 'tcp-ack': 0x10, 'tcp-urg': 0x20,
+                        'icmp-echoreply': 0, 'icmp-unreach': 3,
+                        'icmp-echo': 8}
+
+COMPARISON_OPERATORS = {'>=': operator.ge, '>': operator.gt,
+                        '=': operator.eq, '==': operator.eq,
+                        '!=': operator.ne, '<': operator.lt,
+                        '<=': operator.le}
+# Binary operators by precedence (lowest first), as in tcpdump
+EXPRESSION_OPERATORS = [{'|': operator.or_},
+                        {'&': operator.and_},
+                        {'<<': operator.lshift, '>>': operator.rshift},
+                        {'+': operator.add, '-': operator.sub},
+                        {'*': operator.mul, '/': operator.floordiv,
+                         '%': operator.mod}]
+
+# Relative cost of checking each kind of rule, so normalize can order the
+# cheap checks (protocols) before the expensive ones (expressions)
+RULE_COST_PROTO = 0
+RULE_COST_ADDRESS = 1
+RULE_COST_PORT = 2
+RULE_COST_EXPRESSION = 3
+
+EXPRESSION_TOKEN = re.compile(
+    r'\s*(0x[0-9a-fA-F]+|\d+|<<|>>|[-+*/%&|()\[\]:]|[a-zA-Z][\w-]*)')
+
+
+class _NoMatch(Exception):
+    """
+    Raised when a comparison expression reads a layer or bytes the packet
+    doesn't have, which makes the comparison false (as in tcpdump).
+    """
+    pass
+
+
+def ip_to_int(ip):
+    """
+    :type ip: str
+    :return: int
+    """
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def resolve_host(host):
+    """
+    Returns the dotted-quad IPv4 address for a host name or address.
+    :type host: str
+    :return: str
+    """
+    try:
+        socket.inet_aton(host)
+        if host.count('.') == 3:
+            return host
+    except socket.error:
+        pass
+    try:
+        return socket.gethostbyname(host)
+    except socket.error:
+        raise ArgMismatchException('Cannot resolve host: ' + host)
+
+
+def prepare_packet(packet, link_layer=None):
+    """
+    Returns a packet compiled rules can be matched against: a raw frame
+    is wrapped in a PCAPPacket, and an unparsed packet is parsed (lazily)
+    starting with the given link layer class (Ethernet by default).
+    :type packet: PCAPPacket | bytes | bytearray | memoryview | list[int]
+    :type link_layer: class
+    :return: PCAPPacket
+    """
+    if not isinstance(packet, pcap_packet.PCAPPacket):
+        packet = pcap_packet.PCAPPacket(packet, None)
+    if next(iter(packet), None) is None:
+        try:
+            packet.parse_layers(
+                [link_layer] if link_layer is not None else None, lazy=True)
+        except PacketParsingException:
+            # Match against whatever layers could be parsed
+            pass
+    return packet
 
 
 class Rule(object):
@@ -9,6 +111,86 @@ class Rule(object):
         raise ArgMismatchException(
             'All Rules should override the "to_str" method!')
 
+    def key(self):
+        """
+        Structural identity of the rule: its type and parameters, with
+        member rules replaced by their own keys.  Rules are equal (and hash
+        the same) when their keys are, so they can key dicts and caches.
+        Rules should not be modified once used as a key.
+        :return: tuple
+        """
+        params = []
+        for name, value in sorted(vars(self).items()):
+            if isinstance(value, Rule):
+                value = value.key()
+            elif isinstance(value, (list, tuple)):
+                value = tuple(v.key() if isinstance(v, Rule) else v
+                              for v in value)
+            params.append((name, value))
+        return (type(self).__name__,) + tuple(params)
+
+    def __eq__(self, other):
+        return isinstance(other, Rule) and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def compile(self):
+        """
+        Compile the rule into a predicate which takes a parsed PCAPPacket
+        (see prepare_packet) and returns whether the rule matches it, for
+        filtering packets in-process rather than in tcpdump.
+        :return: callable
+        """
+        raise ArgMismatchException(
+            'Rule type ' + type(self).__name__ + ' cannot be compiled')
+
+    def normalize(self):
+        """
+        Return an equivalent, canonical rule: nested Ands and Ors are
+        flattened, duplicate and Null members dropped, double negations
+        removed and single-member Ands and Ors replaced by their member.
+        Members are ordered cheapest check first (then by their filter
+        string), so equivalent trees built in different orders normalize
+        to the same filter string.
+        :return: Rule
+        """
+        return self
+
+    def cost(self):
+        """
+        Relative cost of checking the rule, see normalize.
+        :return: int
+        """
+        return RULE_COST_EXPRESSION
+
+    def matches(self, packet, link_layer=None):
+        """
+        Whether the rule matches a packet or raw frame.  This compiles the
+        rule on every call, so use compile (or filter) for many packets.
+        :type packet: PCAPPacket | bytes | bytearray | memoryview | list[int]
+        :type link_layer: class
+        :return: bool
+        """
+        return self.compile()(prepare_packet(packet, link_layer))
+
+    def filter(self, packets, link_layer=None):
+        """
+        Yields the packets (or raw frames, as parsed PCAPPackets) the rule
+        matches.
+        :type packets: collections.Iterable[PCAPPacket | bytes]
+        :type link_layer: class
+        :return: collections.Iterable[PCAPPacket]
+        """
+        predicate = self.compile()
+        for packet in packets:
+            packet = prepare_packet(packet, link_layer)
+            if predicate(packet):
+                yield packet
+
 
 class Simple(Rule):
     def __init__(self, val):
@@ -26,6 +208,12 @@ class Null(Simple):
     def __init__(self):
         super(Null, self).__init__(val='')
 
+    def compile(self):
+        return lambda packet: True
+
+    def cost(self):
+        return RULE_COST_PROTO
+
 
 class _PrimitiveBinaryBoolean(Rule):
     def __init__(self, operation, rule_set):
@@ -43,6 +231,44 @@ class _PrimitiveBinaryBoolean(Rule):
         return (' ' + self.operation + ' ').join(['( ' + i.to_str() + ' )'
                                                   for i in self.rule_set])
 
+    def compile(self):
+        predicates = [r.compile() for r in self.rule_set]
+        if len(predicates) == 0:
+            # An empty rule set renders as an empty (match-all) filter
+            return lambda packet: True
+        if len(predicates) == 1:
+            return predicates[0]
+        if self.operation == 'and':
+            return lambda packet: all(p(packet) for p in predicates)
+        return lambda packet: any(p(packet) for p in predicates)
+
+    def normalize(self):
+        rule_set = []
+        rule_strs = set()
+        for rule in self.rule_set:
+            rule = rule.normalize()
+            # Normalized members are already flat, so one level is enough
+            members = rule.rule_set if isinstance(rule, type(self)) \
+                else [rule]
+            for member in members:
+                if isinstance(member, Null):
+                    if self.operation == 'or':
+                        return Null()
+                    continue
+                member_str = member.to_str()
+                if member_str not in rule_strs:
+                    rule_strs.add(member_str)
+                    rule_set.append(member)
+        if len(rule_set) == 0:
+            return Null()
+        if len(rule_set) == 1:
+            return rule_set[0]
+        rule_set.sort(key=lambda r: (r.cost(), r.to_str()))
+        return type(self)(rule_set)
+
+    def cost(self):
+        return max([r.cost() for r in self.rule_set] + [RULE_COST_PROTO])
+
 
 class And(_PrimitiveBinaryBoolean):
     def __init__(self, rule_set):
@@ -71,6 +297,19 @@ class Not(Rule):
     def to_str(self):
         return 'not ( ' + self.rule.to_str() + r' )'
 
+    def compile(self):
+        predicate = self.rule.compile()
+        return lambda packet: not predicate(packet)
+
+    def normalize(self):
+        rule = self.rule.normalize()
+        if isinstance(rule, Not):
+            return rule.rule
+        return Not(rule)
+
+    def cost(self):
+        return self.rule.cost()
+
 
 class _PrimitiveComparison(Rule):
     def __init__(self, operation, lhs, rhs):
@@ -87,6 +326,18 @@ class _PrimitiveComparison(Rule):
     def to_str(self):
         return str(self.lhs) + ' ' + str(self.operation) + ' ' + str(self.rhs)
 
+    def compile(self):
+        compare = COMPARISON_OPERATORS[self.operation]
+        lhs = _compile_expression(str(self.lhs))
+        rhs = _compile_expression(str(self.rhs))
+
+        def predicate(packet):
+            try:
+                return compare(lhs(packet), rhs(packet))
+            except (_NoMatch, ZeroDivisionError):
+                return False
+        return predicate
+
 
 class GreaterThanEqual(_PrimitiveComparison):
     def __init__(self, lhs, rhs):
@@ -167,6 +418,70 @@ class _PrimitiveTypeRule(Rule):
             cmd += 'src and dst '
         return cmd + self.param
 
+    def _endpoint_fields(self):
+        """
+        The (layer name, source attribute, dest attribute) triples the
+        rule's value is checked against for its proto, in order of
+        preference.
+        :return: list[(str, str, str)]
+        """
+        raise ArgMismatchException(
+            'Rule type ' + type(self).__name__ + ' cannot be compiled')
+
+    def cost(self):
+        return RULE_COST_ADDRESS
+
+    def _value_test(self):
+        """
+        :return: callable Tests a single source or dest field value
+        """
+        raise ArgMismatchException(
+            'Rule type ' + type(self).__name__ + ' cannot be compiled')
+
+    def compile(self):
+        fields = self._endpoint_fields()
+        test = self._value_test()
+        source, dest = self.source, self.dest
+
+        def predicate(packet):
+            for layer_name, source_attr, dest_attr in fields:
+                layer = packet.get_layer(layer_name)
+                if layer is not None:
+                    break
+            else:
+                return False
+            if source and dest:
+                return (test(getattr(layer, source_attr)) and
+                        test(getattr(layer, dest_attr)))
+            if source:
+                return test(getattr(layer, source_attr))
+            if dest:
+                return test(getattr(layer, dest_attr))
+            return (test(getattr(layer, source_attr)) or
+                    test(getattr(layer, dest_attr)))
+        return predicate
+
+    def _ip_fields(self):
+        if self.proto in ('', 'ip'):
+            fields = [('ip', 'source_ip', 'dest_ip')]
+            if self.proto == '':
+                fields.append(('arp', 'sender_ip_addr', 'target_ip_addr'))
+            return fields
+        if self.proto in ('arp', 'rarp'):
+            return [('arp', 'sender_ip_addr', 'target_ip_addr')]
+        raise ArgMismatchException(
+            'Cannot compile ' + type(self).__name__ + ' rule for proto [' +
+            self.proto + ']')
+
+    def _port_fields(self):
+        if self.proto in ('', 'tcp', 'udp'):
+            return [(l, 'source_port', 'dest_port')
+                    for l in (['tcp', 'udp'] if self.proto == ''
+                              else [self.proto])]
+        raise ArgMismatchException(
+            'Cannot compile ' + type(self).__name__ + ' rule for proto [' +
+            self.proto + ']')
+
 
 class Host(_PrimitiveTypeRule):
     def __init__(self, host, proto='', source=False, dest=False):
@@ -177,6 +492,19 @@ class Host(_PrimitiveTypeRule):
         :param dest: bool
         """
         super(Host, self).__init__('host ' + host, proto, source, dest)
+        self.host = host
+
+    def _endpoint_fields(self):
+        if self.proto == 'ether':
+            return [('ethernet', 'source_mac', 'dest_mac')]
+        return self._ip_fields()
+
+    def _value_test(self):
+        if self.proto == 'ether':
+            mac = self.host.lower()
+            return lambda value: value == mac
+        ip = resolve_host(self.host)
+        return lambda value: value == ip
 
 
 class PortRange(_PrimitiveTypeRule):
@@ -192,6 +520,18 @@ class PortRange(_PrimitiveTypeRule):
         super(PortRange, self).__init__('portrange ' + str(start_port) +
                                         '-' + str(end_port),
                                         proto, source, dest)
+        self.start_port = start_port
+        self.end_port = end_port
+
+    def cost(self):
+        return RULE_COST_PORT
+
+    def _endpoint_fields(self):
+        return self._port_fields()
+
+    def _value_test(self):
+        start_port, end_port = int(self.start_port), int(self.end_port)
+        return lambda value: start_port <= value <= end_port
 
 
 class Port(_PrimitiveTypeRule):
@@ -204,6 +544,17 @@ class Port(_PrimitiveTypeRule):
         """
         super(Port, self).__init__('port ' + str(port), proto,
                                    source, dest)
+        self.port = port
+
+    def cost(self):
+        return RULE_COST_PORT
+
+    def _endpoint_fields(self):
+        return self._port_fields()
+
+    def _value_test(self):
+        port = int(self.port)
+        return lambda value: value == port
 
 
 class Net(_PrimitiveTypeRule):
@@ -217,6 +568,36 @@ class Net(_PrimitiveTypeRule):
         super(Net, self).__init__(
             'net ' + net + (' mask ' + mask if mask != '' else ''),
             proto, source, dest)
+        self.net = net
+        self.mask = mask
+
+    def network(self):
+        """
+        The network address and mask, as ints.  Like tcpdump, a net with
+        fewer than 4 octets (and no mask) is masked to the octets given.
+        :return: (int, int)
+        """
+        net = self.net
+        if '/' in net:
+            net, prefix_len = net.split('/', 1)
+            prefix_len = int(prefix_len)
+        else:
+            prefix_len = 8 * (net.count('.') + 1)
+        octets = net.split('.')
+        net_int = ip_to_int('.'.join(octets + ['0'] * (4 - len(octets))))
+        if self.mask != '':
+            mask_int = ip_to_int(self.mask)
+        else:
+            mask_int = (0xffffffff << (32 - prefix_len)) & 0xffffffff
+        return net_int & mask_int, mask_int
+
+    def _endpoint_fields(self):
+        return self._ip_fields()
+
+    def _value_test(self):
+        net_int, mask_int = self.network()
+        return lambda value: (value != '' and
+                              ip_to_int(value) & mask_int == net_int)
 
 
 class _PrimitiveProtoRule(Rule):
@@ -233,6 +614,37 @@ class _PrimitiveProtoRule(Rule):
     def to_str(self):
         return self.base_proto + ' proto ' + self.filter_proto
 
+    def cost(self):
+        return RULE_COST_PROTO
+
+    def protocol_number(self):
+        """
+        The IP protocol or ether type number the rule filters on.
+        :return: int
+        """
+        name = self.filter_proto.lstrip('\\')
+        names = IP_PROTOCOLS if self.base_proto == 'ip' else ETHER_PROTOCOLS
+        if name in names:
+            return names[name]
+        try:
+            return int(name, 0)
+        except ValueError:
+            raise ArgMismatchException(
+                'Cannot compile ' + self.base_proto + ' proto rule for [' +
+                name + ']')
+
+    def compile(self):
+        number = self.protocol_number()
+        if self.base_proto == 'ip':
+            def predicate(packet):
+                layer = packet.get_layer('ip')
+                return layer is not None and layer.protocol == number
+        else:
+            def predicate(packet):
+                layer = packet.get_layer('ethernet')
+                return layer is not None and layer.type == number
+        return predicate
+
 
 class IPProto(_PrimitiveProtoRule):
     def __init__(self, proto):
@@ -261,6 +673,13 @@ class _PrimitiveSimpleProto(Rule):
     def to_str(self):
         return self.proto
 
+    def compile(self):
+        proto = self.proto
+        return lambda packet: proto in packet
+
+    def cost(self):
+        return RULE_COST_PROTO
+
 
 class ICMPProto(_PrimitiveSimpleProto):
     def __init__(self):
@@ -296,6 +715,37 @@ class _PrimitiveCast(Rule):
     def to_str(self):
         return self.proto + ' ' + self.type
 
+    def cost(self):
+        return RULE_COST_ADDRESS
+
+    def compile(self):
+        # With no netmask known, 'ip broadcast' only matches the
+        # all-ones address.  Linux cooked frames have no destination
+        # MAC, so never match the 'ether' casts.
+        if self.proto == 'ether':
+            layer_name, field = 'ethernet', 'dest_mac'
+            if self.type == 'broadcast':
+                test = lambda value: value == 'ff:ff:ff:ff:ff:ff'
+            else:
+                test = lambda value: int(value[0:2], 16) & 1 == 1
+        elif self.proto == 'ip':
+            layer_name, field = 'ip', 'dest_ip'
+            if self.type == 'broadcast':
+                test = lambda value: value == '255.255.255.255'
+            else:
+                test = lambda value: 224 <= int(value.split('.')[0]) <= 239
+        else:
+            raise ArgMismatchException(
+                'Cannot compile ' + self.type + ' rule for proto [' +
+                self.proto + ']')
+
+        def predicate(packet):
+            layer = packet.get_layer(layer_name)
+            if layer is None or not hasattr(layer, field):
+                return False
+            return test(getattr(layer, field))
+        return predicate
+
 
 class Multicast(_PrimitiveCast):
     def __init__(self, proto='ether'):
@@ -311,3 +761,120 @@ class Broadcast(_PrimitiveCast):
         :param proto: str Either 'ip' or 'ether' (default)
         """
         super(Broadcast, self).__init__('broadcast', proto)
+
+
+def parse_expression(expression):
+    """
+    Parse a tcpdump arithmetic expression (as used on either side of a
+    comparison) into a tree of tuples: ('value', int), ('len',),
+    ('load', layer name, offset tree, size) for protocol byte accessors
+    ('ip[0]', 'tcp[2:2]', 'tcp[tcpflags]'), and ('op', operator, lhs
+    tree, rhs tree) for the binary operators, with tcpdump's precedence.
+    :type expression: str
+    :return: tuple
+    """
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = EXPRESSION_TOKEN.match(expression, position)
+        if match is None:
+            raise ArgMismatchException(
+                'Cannot compile expression: ' + expression)
+        tokens.append(match.group(1))
+        position = match.end()
+    tokens.append(None)
+    index = [0]
+
+    def peek():
+        return tokens[index[0]]
+
+    def take(expected=None):
+        token = tokens[index[0]]
+        if token is None or (expected is not None and token != expected):
+            raise ArgMismatchException(
+                'Cannot compile expression: ' + expression)
+        index[0] += 1
+        return token
+
+    def parse_binary(level):
+        if level == len(EXPRESSION_OPERATORS):
+            return parse_term()
+        lhs = parse_binary(level + 1)
+        while peek() in EXPRESSION_OPERATORS[level]:
+            symbol = take()
+            lhs = ('op', symbol, lhs, parse_binary(level + 1))
+        return lhs
+
+    def parse_term():
+        token = take()
+        if token == '(':
+            term = parse_binary(0)
+            take(')')
+            return term
+        if token[0].isdigit():
+            return 'value', int(token, 0)
+        if token == 'len':
+            return 'len',
+        if token in EXPRESSION_CONSTANTS:
+            return 'value', EXPRESSION_CONSTANTS[token]
+        if token in ACCESSOR_LAYERS and peek() == '[':
+            take('[')
+            offset = parse_binary(0)
+            size = 1
+            if peek() == ':':
+                take(':')
+                size = int(take())
+                if size not in (1, 2, 4):
+                    raise ArgMismatchException(
+                        'Byte accessor size must be 1, 2 or 4: ' +
+                        expression)
+            take(']')
+            return 'load', ACCESSOR_LAYERS[token], offset, size
+        raise ArgMismatchException('Cannot compile expression: ' + expression)
+
+    tree = parse_binary(0)
+    if peek() is not None:
+        raise ArgMismatchException('Cannot compile expression: ' + expression)
+    return tree
+
+
+def _compile_expression(expression):
+    """
+    Compile a tcpdump arithmetic expression into a function of a parsed
+    packet.
+    :type expression: str
+    :return: callable
+    """
+    operators = {}
+    for level in EXPRESSION_OPERATORS:
+        operators.update(level)
+
+    def compile_tree(tree):
+        if tree[0] == 'value':
+            value = tree[1]
+            return lambda packet: value
+        if tree[0] == 'len':
+            return lambda packet: len(packet.packet_data)
+        if tree[0] == 'load':
+            return _byte_accessor(tree[1], compile_tree(tree[2]), tree[3])
+        op, lhs, rhs = operators[tree[1]], compile_tree(tree[2]), \
+            compile_tree(tree[3])
+        return lambda packet: op(lhs(packet), rhs(packet))
+
+    return compile_tree(parse_expression(expression))
+
+
+def _byte_accessor(layer_name, offset, size):
+    def accessor(packet):
+        layer = packet.get_layer(layer_name)
+        if layer is None:
+            raise _NoMatch()
+        start = layer.layer_offset + offset(packet)
+        if start + size > len(packet.packet_data):
+            raise _NoMatch()
+        value = 0
+        for byte in bytearray(packet.packet_data[start:start + size]):
+            value = (value << 8) | byte
+        return value
+    return accessor
@@ -1,6 +1,9 @@
 import Queue
+import collections
+import datetime
 import multiprocessing
 import os
+import select
 import threading
 import time
 from fcntl import F_GETFL
@@ -8,10 +11,18 @@ from fcntl import F_SETFL
 from fcntl import fcntl
 
 from python_utils.common import exceptions
+from python_utils.net import packet_ring
+from python_utils.net import pcap_file
+from python_utils.net import pcap_filter_cache
 from python_utils.net import pcap_packet
 from python_utils.shell.cli import LinuxCLI
 
 TCPDUMP_LISTEN_START_TIMEOUT = 10
+# How often blocked reads wake up to check for a stop request
+TCPDUMP_STOP_POLL_INTERVAL = 0.1
+TCPDUMP_STREAM_READ_SIZE = 65536
+# Most packets sent across the capture process' queue in one item
+TCPDUMP_QUEUE_BATCH_SIZE = 256
 
 
 def sig_handler():
@@ -33,6 +44,31 @@ def parse_line_to_byte_array(line):
     return byte_data
 
 
+def tcpdump_timestamp_to_epoch(timestamp, now=None):
+    """
+    Converts a tcpdump 'hh:mm:ss.frac' (local time of day) timestamp to
+    seconds since the epoch, taking the most recent such time of day.
+    :type timestamp: str
+    :type now: float
+    :return: float
+    """
+    now = time.time() if now is None else now
+    try:
+        hms, _, frac = timestamp.partition('.')
+        hours, minutes, seconds = [int(v) for v in hms.split(':')]
+        frac_seconds = float('0.' + frac) if frac != '' else 0.0
+    except ValueError:
+        return now
+    midnight = datetime.datetime.fromtimestamp(now).replace(
+        hour=0, minute=0, second=0, microsecond=0)
+    epoch = (time.mktime(midnight.timetuple()) + hours * 3600 +
+             minutes * 60 + seconds + frac_seconds)
+    # Packets from just before midnight are read just after it
+    if epoch > now + 60:
+        epoch -= 86400
+    return epoch
+
+
 def tcpdump_start(kwarg_map):
     try:
         return TCPDump.read_packet(**kwarg_map)
@@ -56,11 +92,23 @@ class TCPDump(object):
         self.tcpdump_stop = None
         self.tcpdump_finished = None
 
+        self.packet_buffer = collections.deque()
+        """ :type: collections.deque[PCAPPacket]"""
+        self.packet_ring = None
+        """ :type: packet_ring.PacketRing"""
+
+        self.startup_latency = None
+        """ :type: float"""
+        self.startup_latencies = []
+        """ :type: list[float]"""
+
     def start_capture(self, cli=LinuxCLI(), interface='any',
                       count=0, packet_type='', pcap_filter=None,
                       max_size=0, timeout=None, callback=None,
                       callback_args=None, blocking=False,
-                      save_dump_file=False, save_dump_filename=None):
+                      save_dump_file=False, save_dump_filename=None,
+                      save_dump_max_size=0, save_dump_max_files=0,
+                      binary_capture=False, packet_ring_size=0):
         """
         Capture <count> packets using tcpdump and add them to a Queue
         of PCAPPackets. Use wait_for_packets to retrieve the packets
@@ -74,8 +122,22 @@ class TCPDump(object):
         will limit the blocking call to timeout seconds.  This time
         limit only applies to the execution of tcpdump if blocking is
         set to True.  The optional save_dump_file parameter can be set
-        to true to save the temporary packet capture file to the given
-        save file name (use tcp.out.<timestamp> if name not provided)
+        to true to save the captured packets as a binary pcap file with
+        the given save file name (use tcp.out.<timestamp>.pcap if name
+        not provided).  Packets are appended as they arrive, and the file
+        is rotated every save_dump_max_size bytes if that is set, keeping
+        at most save_dump_max_files rotated files (see PCAPFileWriter).
+        This call returns as soon as tcpdump reports it is listening, and
+        the time that took is recorded in startup_latency (and appended
+        to startup_latencies).  Setting binary_capture has tcpdump write
+        the raw pcap stream to a pipe ('-w -') which is decoded directly
+        into the packets, rather than formatting and re-parsing hex text.
+        Packets captured this way carry epoch (float) timestamps.  If
+        packet_ring_size is set, packets are handed over through a shared
+        memory PacketRing of that many bytes instead of a queue (see
+        packet_ring), and also carry epoch timestamps.  Packets which
+        arrive while the ring is full are dropped and counted in the
+        ring.
 
         :type cli: LinuxCLI
         :type interface: str
@@ -89,6 +151,10 @@ class TCPDump(object):
         :type blocking: bool
         :type save_dump_file: bool
         :type save_dump_filename: str
+        :type save_dump_max_size: int
+        :type save_dump_max_files: int
+        :type binary_capture: bool
+        :type packet_ring_size: int
         :return:
         """
         # Don't run twice in a row
@@ -110,6 +176,9 @@ class TCPDump(object):
         self.tcpdump_stop.clear()
         self.tcpdump_finished.clear()
         self.tcpdump_pid = None
+        self.packet_buffer = collections.deque()
+        self.packet_ring = packet_ring.PacketRing(packet_ring_size) \
+            if packet_ring_size > 0 else None
 
         kwarg_map = {'cli': cli,
                      'interface': interface,
@@ -124,13 +193,19 @@ class TCPDump(object):
                      'callback': callback,
                      'callback_args': callback_args,
                      'save_dump_file': save_dump_file,
-                     'save_dump_filename': save_dump_filename
+                     'save_dump_filename': save_dump_filename,
+                     'save_dump_max_size': save_dump_max_size,
+                     'save_dump_max_files': save_dump_max_files,
+                     'binary_capture': binary_capture,
+                     'batch_size': TCPDUMP_QUEUE_BATCH_SIZE,
+                     'packet_ring': self.packet_ring
                      }
         self.process = multiprocessing.Process(target=tcpdump_start,
                                                args=(kwarg_map,))
+        start_time = time.time()
         self.process.start()
-        deadline_time = time.time() + TCPDUMP_LISTEN_START_TIMEOUT
-        while not self.tcpdump_ready.is_set():
+        deadline_time = start_time + TCPDUMP_LISTEN_START_TIMEOUT
+        while not self.tcpdump_ready.wait(TCPDUMP_STOP_POLL_INTERVAL):
             if time.time() > deadline_time:
                 self.process.terminate()
                 raise exceptions.SubprocessFailedException(
@@ -146,7 +221,9 @@ class TCPDump(object):
                         'stderr [' + error_info['stderr'] + '] }')
                 raise exceptions.SubprocessFailedException(
                     'tcpdump error UNKNOWN')
-            time.sleep(0)
+
+        self.startup_latency = time.time() - start_time
+        self.startup_latencies.append(self.startup_latency)
 
         if blocking is True:
             self.process.join(timeout)
@@ -154,36 +231,102 @@ class TCPDump(object):
                 raise exceptions.SubprocessTimeoutException(
                     'tcpdump failed to receive packets within timeout')
 
-    def wait_for_packets(self, count=1, timeout=None):
-        ret = []
-        start_time = time.time()
+    def _buffer_batch(self, batch):
+        """
+        Parse a batch of raw frames from the capture process into
+        PCAPPackets, adding them to the packet buffer.
+        :type batch: list[(bytes, str | float)]
+        """
+        self.packet_buffer.extend(
+            pcap_packet.PCAPPacket(packet_data, timestamp)
+            for packet_data, timestamp in batch)
 
-        if count == 0:
-            # 0 count means just return waiting buffer, or empty list
-            # if nothing is present
+    def _receive_packets(self, timeout=None):
+        """
+        Block for up to timeout seconds (forever if None) until more
+        packets arrive, then move every packet which has arrived into the
+        packet buffer in one go.  Returns whether any packets arrived.
+        :type timeout: float
+        :return: bool
+        """
+        buffered = len(self.packet_buffer)
+        if self.packet_ring is not None:
+            self.packet_buffer.extend(
+                self.packet_ring.read_packets(timeout=timeout))
+        else:
             try:
+                self._buffer_batch(self.data_queue.get(
+                    block=timeout is None or timeout > 0, timeout=timeout))
                 while True:
-                    item = self.data_queue.get_nowait()
-                    ret.append(item)
+                    self._buffer_batch(self.data_queue.get_nowait())
             except Queue.Empty:
                 pass
-            return ret
+        return len(self.packet_buffer) > buffered
 
-        while len(ret) < count:
-            try:
-                item = self.data_queue.get_nowait()
-            except Queue.Empty:
-                if timeout is not None:
-                    if time.time() > start_time + timeout:
-                        raise exceptions.SubprocessTimeoutException(
-                            (('Only ' + str(len(ret)) + '/')
-                             if len(ret) != 0 else '0/') +
-                            str(count) + ' packets received within timeout')
-                time.sleep(0)
-            else:
-                ret.append(item)
+    def wait_for_packets(self, count=1, timeout=None):
+        """
+        Return a list of <count> captured packets, blocking until they
+        arrive.  If they don't all arrive within timeout seconds (if
+        given), a SubprocessTimeoutException is raised, and the packets
+        which did arrive stay buffered for the next call.  A count of 0
+        returns whatever packets have already arrived.
+        :type count: int
+        :type timeout: float
+        :return: list[PCAPPacket]
+        """
+        if count == 0:
+            # 0 count means just return waiting buffer, or empty list
+            # if nothing is present
+            self._receive_packets(timeout=0)
+            count = len(self.packet_buffer)
+
+        deadline_time = time.time() + timeout if timeout is not None \
+            else None
+        while len(self.packet_buffer) < count:
+            remaining = deadline_time - time.time() \
+                if deadline_time is not None else None
+            if remaining is not None and remaining <= 0:
+                received = len(self.packet_buffer)
+                raise exceptions.SubprocessTimeoutException(
+                    (('Only ' + str(received) + '/')
+                     if received != 0 else '0/') +
+                    str(count) + ' packets received within timeout')
+            self._receive_packets(timeout=remaining)
 
-        return ret
+        return [self.packet_buffer.popleft() for _ in range(count)]
+
+    def iter_packets(self, timeout=None):
+        """
+        Yield captured packets as they arrive, blocking (without
+        spinning) in between.  Iteration stops once no packet has arrived
+        for timeout seconds (if given), or once the capture has finished
+        and every packet it captured has been yielded.
+        :type timeout: float
+        :return: collections.Iterable[PCAPPacket]
+        """
+        deadline_time = None
+        while True:
+            if len(self.packet_buffer) > 0:
+                yield self.packet_buffer.popleft()
+                deadline_time = None
+                continue
+
+            now = time.time()
+            if timeout is not None and deadline_time is None:
+                deadline_time = now + timeout
+            remaining = deadline_time - now \
+                if deadline_time is not None else None
+            if remaining is not None and remaining <= 0:
+                return
+
+            # Wake up periodically to notice the capture finishing
+            finished = self.tcpdump_finished is not None and \
+                self.tcpdump_finished.is_set()
+            if not self._receive_packets(
+                    timeout=TCPDUMP_STOP_POLL_INTERVAL if remaining is None
+                    else min(remaining, TCPDUMP_STOP_POLL_INTERVAL)) \
+                    and finished:
+                return
 
     def stop_capture(self):
         """
@@ -207,10 +350,21 @@ class TCPDump(object):
     def read_packet(cli=LinuxCLI(), flag_set=None, interface='any',
                     count=1, packet_type='', pcap_filter=None, max_size=0,
                     packet_queues=None, callback=None, callback_args=None,
-                    save_dump_file=False, save_dump_filename=None):
-
-        tmp_dump_filename = './.tcpdump.out.' + str(time.time())
+                    save_dump_file=False, save_dump_filename=None,
+                    save_dump_max_size=0, save_dump_max_files=0,
+                    binary_capture=False, batch_size=0, packet_ring=None):
+        """
+        Run tcpdump, putting captured packets on the packet queue.  If
+        batch_size is set, the queue instead gets lists of up to that
+        many (raw frame, timestamp) tuples, sent as soon as the batch
+        fills or no more captured data is waiting, to be parsed into
+        PCAPPackets by the consumer (see wait_for_packets).  If a
+        packet_ring is given, the raw frames and their epoch timestamps
+        are written to it instead.
+        """
         tcp_processes = []
+        dump_writers = []
+        """ :type: list[pcap_file.PCAPFileWriter] """
         try:
             # If flag set provided, use them instead, for synch with
             # external functions
@@ -230,7 +384,52 @@ class TCPDump(object):
             status_queue = Queue.Queue() \
                 if packet_queues is None else packet_queues[1]
 
-            cmd1 = ['tcpdump', '-n', '-xx', '-l']
+            packet_batch = []
+
+            def flush_packets():
+                if len(packet_batch) > 0:
+                    packet_queue.put(list(packet_batch))
+                    del packet_batch[:]
+
+            def open_dump_file(linktype, snaplen):
+                dump_writers.append(pcap_file.PCAPFileWriter(
+                    save_dump_filename if save_dump_filename is not None
+                    else 'tcp.out.' + str(time.time()) + '.pcap',
+                    linktype=linktype, snaplen=snaplen,
+                    max_size=save_dump_max_size,
+                    max_files=save_dump_max_files))
+
+            def deliver_packet(packet_data, timestamp, epoch,
+                               orig_len=None):
+                # Push the packet (or its raw frame, if batching) onto
+                # the return queue, save it if requested, and call the
+                # callback function if one is set.
+                for dump_writer in dump_writers:
+                    dump_writer.write(packet_data, epoch, orig_len)
+                packet = None
+                if packet_ring is not None:
+                    packet_ring.write(packet_data, epoch)
+                elif batch_size > 0:
+                    packet_batch.append((packet_data, timestamp))
+                    if len(packet_batch) >= batch_size:
+                        flush_packets()
+                else:
+                    packet = pcap_packet.PCAPPacket(packet_data, timestamp)
+                    packet_queue.put(packet)
+                if callback is not None:
+                    if packet is None:
+                        packet = pcap_packet.PCAPPacket(packet_data,
+                                                        timestamp)
+                    callback(packet,
+                             *(callback_args
+                               if callback_args is not None
+                               else ()))
+
+            if binary_capture is True:
+                # Have tcpdump write the pcap stream, flushed per packet
+                cmd1 = ['tcpdump', '-n', '-U', '-w', '-']
+            else:
+                cmd1 = ['tcpdump', '-n', '-xx', '-l']
             cmd1 += ['-c', str(count)] \
                 if count > 0 else []
             cmd1 += ['-i', interface]
@@ -238,44 +437,46 @@ class TCPDump(object):
                 if max_size != 0 else []
             cmd1 += ['-T', packet_type] \
                 if packet_type != '' else []
-            cmd1 += [pcap_filter.to_str()] \
+            cmd1 += [pcap_filter_cache.filter_string(pcap_filter)] \
                 if pcap_filter is not None else []
 
-            cmd2 = ['tee', '-a', tmp_dump_filename]
+            if save_dump_file is True and binary_capture is not True:
+                # tcpdump's text output doesn't give the link type, so
+                # guess it: the 'any' pseudo-interface captures Linux
+                # cooked frames.  Binary captures take it from the pcap
+                # stream's header instead.
+                open_dump_file(pcap_file.LINKTYPE_LINUX_SLL
+                               if interface == 'any'
+                               else pcap_file.LINKTYPE_ETHERNET,
+                               max_size if max_size != 0 else 262144)
 
             # FLAG STATE: ready[clear], stop[clear], finished[clear]
-            with open(name=tmp_dump_filename, mode='w') as f:
-                f.write("--START--\n")
-
-            tcp_processes = cli.cmd(cmd_list=[cmd1, cmd2],
+            # tcpdump's output is read straight from its stdout pipe
+            tcp_processes = cli.cmd(cmd_list=[cmd1],
                                     blocking=False)
             tcp_piped_process = tcp_processes.process
             tcp_actual_process = tcp_processes.process_array[0]
 
             # set current p.stderr flags to NONBLOCK
-            # Note that as stderr is NOT redirected through pipes, we
-            # must listen on the actual tcpdump process's stderr
-            # (not the tee process!)
             flags_se = fcntl(tcp_actual_process.stderr, F_GETFL)
             fcntl(tcp_actual_process.stderr, F_SETFL, flags_se | os.O_NONBLOCK)
 
             err_out = ''
             while not tcp_ready.is_set():
                 try:
+                    # Sleep until tcpdump reports something on stderr
+                    select.select([tcp_actual_process.stderr], [], [],
+                                  TCPDUMP_STOP_POLL_INTERVAL)
                     line = os.read(tcp_actual_process.stderr.fileno(), 256)
-                    if line.find('listening on') != -1:
-                        # TODO(micucci): Replace sleep after TCPDump s
-                        # starts with a real check # This is dangerous,
-                        # and might not actually be enough to signal the
-                        # tcpdump is actually running.  Instead, let's
-                        # create a Cython module that passes calls through
-                        # to libpcap (there are 0 good libpcap implementations
-                        # for Python that are maintained, documented,
-                        # and simple).
-                        time.sleep(1)
+                    err_out += line
+                    if err_out.find('listening on') != -1:
+                        # tcpdump only reports this once the pcap handle is
+                        # activated and its filter attached, from which
+                        # point the kernel queues every matching packet
+                        # for it, so the capture is live without waiting
+                        # any longer.
                         tcp_ready.set()
                     else:
-                        err_out += line
                         if tcp_piped_process.poll() is not None:
                             out, err = tcp_piped_process.communicate()
                             status_queue.put(
@@ -291,105 +492,26 @@ class TCPDump(object):
                                 ', out: ' + out +
                                 ', err: ' + err +
                                 ', err_out: ' + err_out)
-                        time.sleep(0)
 
                 except OSError:
                     pass
 
             # FLAG STATE: ready[set], stop[clear], finished[clear]
-            # tcpdump return output format:
-            # hh:mm:ss.tick L3Proto <Proto-specific fields>\n
-            # \t0x<addr>:  FFFF FFFF FFFF FFFF FFFF FFFF FFFF FFFF\n
-            # \t0x<addr>:  FFFF FFFF FFFF FFFF FFFF FFFF FFFF FFFF\n
-            # (eight quads of hexadecimal numbers representing 16
-            # bytes or 4 32-bit words)
-            #
-            # hh:mm:ss.tick L3Proto <Proto-specific fields>\n
-            # \t0x<addr>:  FFFF FFFF FFFF FFFF FFFF FFFF FFFF FFFF\n
-            # \t0x<addr>:  FFFF FFFF FFFF FFFF FFFF FFFF FFFF FFFF\n
-            # (Next packet)
-
-            packet_data = []
-            timestamp = ''
-            with open(tmp_dump_filename, 'r+') as f:
-                # Prepare for the first packet by reading the file
-                # until the first packet's lines arrive (or until
-                # stopped by a stop_capture call)
-                if f.readline().rstrip() != '--START--':
-                    status_queue.put(
-                        {'error': 'Expected --START-- tag at '
-                                  'beginning of dumpfile',
-                         'returncode': tcp_piped_process.returncode,
-                         'stdout': '',
-                         'stderr': ''})
-                    tcp_error.set()
-                    raise exceptions.ArgMismatchException(
-                        'Expected --START-- tag at beginning of dumpfile')
-
-                while True:
-                    # Read the lines and either append data,
-                    # start a new packet, or finish
-                    line = f.readline()
-                    if line == '':
-                        # EOF
-
-                        # Is the tcpdump process finished or
-                        # signaled to finish?
-                        if tcp_piped_process.poll() is not None \
-                                or tcp_stop.is_set():
-                            # If we finished with packet data buffered up,
-                            # append that packet to the queue
-                            if len(packet_data) > 0:
-                                # Create and parse the packet and push it
-                                # onto the return list, calling
-                                # the callback function if one is set.
-                                packet = pcap_packet.PCAPPacket(
-                                    packet_data, timestamp)
-                                packet_queue.put(packet)
-                                if callback is not None:
-                                    callback(packet,
-                                             *(callback_args
-                                               if callback_args is not None
-                                               else ()))
-
-                            # Stop packet collection and exit
-                            break
-
-                        # Otherwise, we need to wait for data
-                        time.sleep(0)
-
-                    elif line.startswith('\t'):
-                        # Normal packet data: buffer into current packet
-                        packet_data += parse_line_to_byte_array(line)
-                    else:
-                        # We hit the end of the packet and will start
-                        # a new packet Only run if we had packet data
-                        # buffered
-                        if len(packet_data) > 0:
-                            # Create and parse the packet and push it onto
-                            # the return list, calling the callback function
-                            # if one is set.
-                            packet = pcap_packet.PCAPPacket(
-                                packet_data, timestamp)
-                            packet_queue.put(packet)
-                            if callback is not None:
-                                callback(packet,
-                                         *(callback_args
-                                           if callback_args is not None
-                                           else []))
-                            packet_data = []
-
-                        # Start the new packet by reading the timestamp
-                        timestamp = line.split(' ', 2)[0]
+            if binary_capture is True:
+                TCPDump.read_pcap_stream(
+                    tcp_actual_process.stdout, tcp_stop, deliver_packet,
+                    flush_packets,
+                    header_callback=(
+                        (lambda decoder: open_dump_file(decoder.linktype,
+                                                        decoder.snaplen))
+                        if save_dump_file is True else None))
+            else:
+                TCPDump.read_hex_stream(tcp_actual_process.stdout, tcp_stop,
+                                        deliver_packet, flush_packets)
         finally:
-            # Save the tcpdump output (if requested), and delete the
-            # temporary file
-            if save_dump_file is True:
-                LinuxCLI().copy_file(
-                    tmp_dump_filename,
-                    save_dump_filename if save_dump_filename is not None
-                    else 'tcp.out.' + str(time.time()))
-            LinuxCLI().rm(tmp_dump_filename)
+            # Finish the pcap save file (if requested)
+            for dump_writer in dump_writers:
+                dump_writer.close()
             tcp_processes.terminate()
 
         status_queue.put({'success': '',
@@ -402,3 +524,136 @@ class TCPDump(object):
 
         # FLAG STATE: ready[set], stop[set], finished[set]
         return packet_queue
+
+    @staticmethod
+    def read_hex_stream(stream, tcp_stop, deliver_packet,
+                        flush_packets=None):
+        """
+        Parse the hex text output of 'tcpdump -xx -l' into raw frames as
+        it arrives on the stream, calling deliver_packet with each frame,
+        its tcpdump timestamp and its epoch timestamp.  Reads block (in
+        select) until data is available, so an idle capture uses no CPU.
+        flush_packets (if given) is called whenever no more data is
+        waiting.  Reading stops at the end of the stream, or as soon as
+        tcp_stop is set (whether or not more data is waiting).
+        :type stream: file
+        :type tcp_stop: threading.Event | multiprocessing.Event
+        :type deliver_packet: callable
+        :type flush_packets: callable
+        """
+        # tcpdump return output format:
+        # hh:mm:ss.tick L3Proto <Proto-specific fields>\n
+        # \t0x<addr>:  FFFF FFFF FFFF FFFF FFFF FFFF FFFF FFFF\n
+        # \t0x<addr>:  FFFF FFFF FFFF FFFF FFFF FFFF FFFF FFFF\n
+        # (eight quads of hexadecimal numbers representing 16
+        # bytes or 4 32-bit words)
+        #
+        # hh:mm:ss.tick L3Proto <Proto-specific fields>\n
+        # \t0x<addr>:  FFFF FFFF FFFF FFFF FFFF FFFF FFFF FFFF\n
+        # \t0x<addr>:  FFFF FFFF FFFF FFFF FFFF FFFF FFFF FFFF\n
+        # (Next packet)
+
+        packet_data = []
+        timestamp = ''
+        partial_line = ''
+        fd = stream.fileno()
+        while True:
+            # Checked before every read, as a busy capture never leaves
+            # the stream idle
+            if tcp_stop.is_set():
+                break
+            readable, _, _ = select.select([fd], [], [], 0)
+            if len(readable) == 0:
+                if flush_packets is not None:
+                    flush_packets()
+                readable, _, _ = select.select(
+                    [fd], [], [], TCPDUMP_STOP_POLL_INTERVAL)
+            if len(readable) == 0:
+                continue
+
+            data = os.read(fd, TCPDUMP_STREAM_READ_SIZE)
+            if len(data) == 0:
+                # EOF, tcpdump has exited
+                break
+
+            lines = (partial_line + data).split('\n')
+            partial_line = lines.pop()
+            for line in lines:
+                if line.startswith('\t'):
+                    # Normal packet data: buffer into current packet
+                    packet_data += parse_line_to_byte_array(line)
+                else:
+                    # We hit the end of the packet and will start
+                    # a new packet Only run if we had packet data
+                    # buffered
+                    if len(packet_data) > 0:
+                        deliver_packet(
+                            bytearray(packet_data), timestamp,
+                            tcpdump_timestamp_to_epoch(timestamp))
+                        packet_data = []
+
+                    # Start the new packet by reading the timestamp
+                    timestamp = line.split(' ', 2)[0]
+
+        # If we finished with packet data buffered up, deliver that
+        # packet as well
+        if partial_line.startswith('\t'):
+            packet_data += parse_line_to_byte_array(partial_line)
+        if len(packet_data) > 0:
+            deliver_packet(bytearray(packet_data), timestamp,
+                           tcpdump_timestamp_to_epoch(timestamp))
+        if flush_packets is not None:
+            flush_packets()
+
+    @staticmethod
+    def read_pcap_stream(stream, tcp_stop, deliver_packet,
+                         flush_packets=None, header_callback=None):
+        """
+        Decode a binary pcap stream (as written by 'tcpdump -w -') into
+        raw frames as the data arrives, calling deliver_packet with each
+        frame, its timestamp (twice, as tcpdump and epoch timestamps are
+        the same here) and its original length.  flush_packets (if given)
+        is called whenever no more data is waiting, and header_callback
+        (if given) is called with the decoder as soon as the stream's
+        global header (and so its link type) is decoded.  Reading stops at
+        the end of the stream, or as soon as tcp_stop is set (whether or
+        not more data is waiting).
+        :type stream: file
+        :type tcp_stop: threading.Event | multiprocessing.Event
+        :type deliver_packet: callable
+        :type flush_packets: callable
+        :type header_callback: (pcap_file.PCAPStreamDecoder) -> None
+        :return: pcap_file.PCAPStreamDecoder
+        """
+        decoder = pcap_file.PCAPStreamDecoder()
+        header_seen = False
+        fd = stream.fileno()
+        while True:
+            # Checked before every read, as a busy capture never leaves
+            # the stream idle
+            if tcp_stop.is_set():
+                break
+            readable, _, _ = select.select([fd], [], [], 0)
+            if len(readable) == 0:
+                if flush_packets is not None:
+                    flush_packets()
+                readable, _, _ = select.select(
+                    [fd], [], [], TCPDUMP_STOP_POLL_INTERVAL)
+            if len(readable) == 0:
+                continue
+
+            data = os.read(fd, TCPDUMP_STREAM_READ_SIZE)
+            if len(data) == 0:
+                # EOF, tcpdump has exited
+                break
+            records = decoder.feed(data)
+            if not header_seen and decoder.linktype is not None:
+                header_seen = True
+                if header_callback is not None:
+                    header_callback(decoder)
+            for record in records:
+                deliver_packet(record.data, record.timestamp,
+                               record.timestamp, record.orig_len)
+        if flush_packets is not None:
+            flush_packets()
+        return decoder
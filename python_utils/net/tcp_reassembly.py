@@ -0,0 +1,289 @@
+import collections
+
+from python_utils.net import flow_table
+from python_utils.net import pcap_packet
+
+# Most out-of-order bytes buffered per stream before giving up on a hole
+DEFAULT_MAX_BUFFER = 1024 * 1024
+DEFAULT_MAX_STREAMS = 65536
+
+SEQ_MASK = 0xffffffff
+
+
+def seq_diff(seq, base):
+    """
+    Distance from base to seq in TCP sequence space, which wraps at 2^32.
+    :type seq: int
+    :type base: int
+    :return: int Negative if seq is before base
+    """
+    diff = (seq - base) & SEQ_MASK
+    return diff - 0x100000000 if diff >= 0x80000000 else diff
+
+
+def tcp_payload(packet):
+    """
+    The data carried by a parsed packet's TCP segment.  The IP total
+    length bounds the segment, so link layer padding isn't taken as data.
+    :type packet: pcap_packet.PCAPPacket
+    :return: bytes
+    """
+    ip = packet.get_layer('ip')
+    tcp = packet.get_layer('tcp')
+    end = min(tcp.layer_end, ip.layer_offset + ip.total_length)
+    data = packet.packet_data[tcp.payload_offset:end]
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(bytearray(data)) if isinstance(data, list) else bytes(data)
+
+
+class TCPStream(object):
+    """
+    Reassembles one direction of a TCP connection into an ordered byte
+    stream.  Data already delivered (retransmissions, and the overlapping
+    parts of segments) is trimmed, and segments arriving ahead of a hole
+    are buffered until it is filled.  If buffering a segment would take
+    the stream past max_buffer bytes, the hole is given up on: the stream
+    skips ahead to the earliest buffered data, and the gap is counted.
+    """
+
+    __slots__ = ('key', 'max_buffer', 'next_seq', 'fin_seq', 'segments',
+                 'buffered', 'delivered_bytes', 'retransmitted_bytes',
+                 'skipped_bytes', 'gaps', 'finished', 'reset')
+
+    def __init__(self, key, max_buffer=DEFAULT_MAX_BUFFER):
+        """
+        :param key: flow_table.FlowKey Oriented in the stream's direction
+        :type max_buffer: int
+        """
+        self.key = key
+        self.max_buffer = max_buffer
+        self._start(None)
+
+    def _start(self, next_seq):
+        self.next_seq = next_seq
+        """ :type: int Sequence number of the next byte to deliver"""
+        self.fin_seq = None
+        """ :type: int """
+        self.segments = {}
+        """ :type: dict[int, bytes] Buffered data by sequence number"""
+        self.buffered = 0
+        self.delivered_bytes = 0
+        self.retransmitted_bytes = 0
+        self.skipped_bytes = 0
+        self.gaps = 0
+        self.finished = False
+        """ :type: bool Set once the FIN is reached, or on a RST"""
+        self.reset = False
+
+    def add_segment(self, seq, flags, data):
+        """
+        Adds a segment, returning the data it makes deliverable in order.
+        :type seq: int
+        :type flags: int
+        :type data: bytes
+        :return: list[bytes]
+        """
+        if flags & pcap_packet.TCP_PROTOCOL_FLAG_RESET:
+            self.finished = self.reset = True
+            self.segments.clear()
+            self.buffered = 0
+            return []
+        if flags & pcap_packet.TCP_PROTOCOL_FLAG_SYN:
+            if self.next_seq is not None and not self.finished:
+                # Retransmitted SYN
+                return []
+            # The SYN takes up a sequence number ahead of the data.  A
+            # SYN on a finished stream starts a new connection.
+            seq = (seq + 1) & SEQ_MASK
+            self._start(seq)
+        elif self.next_seq is None:
+            # Capture started mid-connection
+            self.next_seq = seq
+        if self.finished:
+            return []
+
+        if flags & pcap_packet.TCP_PROTOCOL_FLAG_FINAL:
+            self.fin_seq = (seq + len(data)) & SEQ_MASK
+
+        chunks = []
+        if len(data) > 0:
+            while seq_diff(seq, self.next_seq) > 0 and \
+                    self.buffered + len(data) > self.max_buffer:
+                self._skip_hole(seq)
+                chunks += self._drain()
+            self._store(seq, data)
+            chunks += self._drain()
+
+        if self.next_seq == self.fin_seq:
+            self.finished = True
+            self.next_seq = (self.next_seq + 1) & SEQ_MASK
+            self.segments.clear()
+            self.buffered = 0
+        return chunks
+
+    def flush(self):
+        """
+        Delivers all the buffered data, skipping any holes (such as at the
+        end of a capture).
+        :return: list[bytes]
+        """
+        chunks = []
+        while len(self.segments) > 0:
+            self._skip_hole(None)
+            chunks += self._drain()
+        return chunks
+
+    def _skip_hole(self, seq):
+        # Skip to the earliest of the buffered data and seq
+        candidates = list(self.segments)
+        if seq is not None:
+            candidates.append(seq)
+        target = min(candidates, key=lambda s: seq_diff(s, self.next_seq))
+        skipped = seq_diff(target, self.next_seq)
+        if skipped > 0:
+            self.skipped_bytes += skipped
+            self.gaps += 1
+            self.next_seq = target
+
+    def _store(self, seq, data):
+        offset = seq_diff(seq, self.next_seq)
+        if offset + len(data) <= 0:
+            self.retransmitted_bytes += len(data)
+            return
+        if offset < 0:
+            self.retransmitted_bytes += -offset
+            data = data[-offset:]
+            seq = self.next_seq
+        existing = self.segments.get(seq)
+        if existing is not None:
+            if len(existing) >= len(data):
+                self.retransmitted_bytes += len(data)
+                return
+            self.retransmitted_bytes += len(existing)
+            self.buffered -= len(existing)
+        self.segments[seq] = data
+        self.buffered += len(data)
+
+    def _drain(self):
+        chunks = []
+        while len(self.segments) > 0:
+            data = self.segments.pop(self.next_seq, None)
+            if data is not None:
+                self.buffered -= len(data)
+            else:
+                data = self._pop_overlapping()
+                if data is None:
+                    break
+            chunks.append(data)
+            self.delivered_bytes += len(data)
+            self.next_seq = (self.next_seq + len(data)) & SEQ_MASK
+        return chunks
+
+    def _pop_overlapping(self):
+        # Buffered segments which start before the next byte to deliver
+        # were overlapped by data delivered since they arrived
+        for seq in list(self.segments):
+            offset = seq_diff(seq, self.next_seq)
+            if offset >= 0:
+                continue
+            data = self.segments.pop(seq)
+            self.buffered -= len(data)
+            if offset + len(data) > 0:
+                self.retransmitted_bytes += -offset
+                return data[-offset:]
+            self.retransmitted_bytes += len(data)
+        return None
+
+
+class TCPReassembler(object):
+    """
+    Reassembles the TCP streams in a sequence of parsed packets, one
+    TCPStream per direction of each connection.  Data is handed over in
+    order as soon as it can be, either returned from add (or yielded by
+    reassemble), or passed to a callback with the stream's key.  At most
+    max_streams streams are held, the least recently active one being
+    evicted (with any data it still buffers) to make room.
+    """
+
+    def __init__(self, callback=None, max_buffer=DEFAULT_MAX_BUFFER,
+                 max_streams=DEFAULT_MAX_STREAMS):
+        """
+        :param callback: (flow_table.FlowKey, bytes) -> None
+        :param max_buffer: int Most out-of-order bytes buffered per stream
+        :param max_streams: int Most streams held (0 for no limit)
+        """
+        self.callback = callback
+        self.max_buffer = max_buffer
+        self.max_streams = max_streams
+        self.evictions = 0
+        self._streams = collections.OrderedDict()
+        """ :type: dict[flow_table.FlowKey, TCPStream]"""
+
+    def __len__(self):
+        return len(self._streams)
+
+    def __iter__(self):
+        return iter(list(self._streams.values()))
+
+    def get(self, source_ip, source_port, dest_ip, dest_port):
+        """
+        The stream of the data sent from source to dest.
+        :type source_ip: str
+        :type source_port: int
+        :type dest_ip: str
+        :type dest_port: int
+        :return: TCPStream
+        """
+        return self._streams.get(flow_table.FlowKey(
+            pcap_packet.IP4_PROTOCOL_TCP, source_ip, source_port, dest_ip,
+            dest_port))
+
+    def add(self, packet):
+        """
+        Adds a parsed packet's TCP segment (other packets are ignored).
+        :type packet: pcap_packet.PCAPPacket
+        :return: list[(flow_table.FlowKey, bytes)] The data now
+        deliverable in order
+        """
+        ip = packet.get_layer('ip')
+        tcp = packet.get_layer('tcp')
+        if ip is None or tcp is None:
+            return []
+        key = flow_table.FlowKey(ip.protocol, ip.source_ip, tcp.source_port,
+                                 ip.dest_ip, tcp.dest_port)
+        stream = self._streams.pop(key, None)
+        if stream is None:
+            if 0 < self.max_streams <= len(self._streams):
+                self._streams.popitem(last=False)
+                self.evictions += 1
+            stream = TCPStream(key, self.max_buffer)
+        # (Re)inserted at the most recently active end
+        self._streams[key] = stream
+        return self._deliver(key, stream.add_segment(
+            tcp.seq, tcp.flags, tcp_payload(packet)))
+
+    def reassemble(self, packets):
+        """
+        :type packets: collections.Iterable[pcap_packet.PCAPPacket]
+        :return: collections.Iterable[(flow_table.FlowKey, bytes)]
+        """
+        for packet in packets:
+            for item in self.add(packet):
+                yield item
+
+    def flush(self):
+        """
+        Delivers the data still buffered by every stream, skipping holes.
+        :return: list[(flow_table.FlowKey, bytes)]
+        """
+        ret = []
+        for key, stream in list(self._streams.items()):
+            ret += self._deliver(key, stream.flush())
+        return ret
+
+    def _deliver(self, key, chunks):
+        if self.callback is not None:
+            for data in chunks:
+                self.callback(key, data)
+        return [(key, data) for data in chunks]
@@ -0,0 +1,183 @@
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from python_utils.common import exceptions
+from python_utils.net import af_packet
+from python_utils.net import pcap_file
+from python_utils.net import pcap_filter_cache
+from python_utils.net import pcap_packet
+from python_utils.net import pcap_rules
+from python_utils.tests.utils.test_utils import run_unit_test
+
+TEST_PORT = 39999
+
+
+def make_payloads(count):
+    return [('pkt' + str(i)).encode('ascii') for i in range(count)]
+
+
+def send_udp(payloads, port=TEST_PORT):
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for payload in payloads:
+            sender.sendto(payload, ('127.0.0.1', port))
+    finally:
+        sender.close()
+
+
+def udp_to_test_port():
+    return pcap_rules.And([pcap_rules.UDPProto(),
+                           pcap_rules.Port(TEST_PORT, dest=True)])
+
+
+class AFPacketTest(unittest.TestCase):
+
+    def start_capture(self, capture, interface='lo', **kwargs):
+        try:
+            capture.start_capture(interface=interface, **kwargs)
+        except exceptions.SocketException:
+            self.skipTest('AF_PACKET sockets not available')
+
+    def test_filtered_capture(self):
+        capture = af_packet.AFPacketCapture(block_size=65536, block_count=8)
+        received = []
+        self.start_capture(capture, pcap_filter=udp_to_test_port(),
+                           callback=lambda p, l: l.append(p),
+                           callback_args=[received])
+        try:
+            send_udp(make_payloads(5), TEST_PORT - 1)
+            send_udp(make_payloads(200))
+            packets = capture.wait_for_packets(count=200, timeout=5)
+        finally:
+            capture.stop_capture()
+
+        packets[0].parse()
+        self.assertEqual(TEST_PORT, packets[0].get_layer('udp').dest_port)
+        self.assertEqual(b'pkt199', bytes(packets[-1].packet_data)[-6:])
+        self.assertEqual(200, len(received))
+        self.assertTrue(capture.kernel_packets >= 200)
+        self.assertEqual(0, capture.kernel_drops)
+        self.assertTrue(capture.tcpdump_finished.is_set())
+
+    def test_count_and_blocking(self):
+        capture = af_packet.AFPacketCapture()
+        sender = threading.Timer(0.2, send_udp, args=(make_payloads(10),))
+        sender.start()
+        self.start_capture(capture, count=3, pcap_filter=udp_to_test_port(),
+                           blocking=True, timeout=5)
+        capture.stop_capture()
+        sender.join()
+
+        self.assertEqual(3, len(capture.wait_for_packets(count=0)))
+
+    def test_packet_ring_and_dump_file(self):
+        capture = af_packet.AFPacketCapture()
+        dump_file = tempfile.mktemp(suffix='.pcap')
+        self.start_capture(capture, pcap_filter=udp_to_test_port(),
+                           max_size=40, packet_ring_size=65536,
+                           save_dump_file=True, save_dump_filename=dump_file)
+        try:
+            send_udp(make_payloads(10))
+            packets = capture.wait_for_packets(count=10, timeout=5)
+        finally:
+            capture.stop_capture()
+
+        try:
+            self.assertEqual(40, len(packets[0].packet_data))
+            with pcap_file.PCAPFileReader(dump_file) as reader:
+                records = list(reader.read_records())
+            self.assertEqual(10, len(records))
+            self.assertEqual(40, len(records[0].data))
+            self.assertEqual(46, records[0].orig_len)
+        finally:
+            os.remove(dump_file)
+
+    def test_any_captures_cooked_frames(self):
+        capture = af_packet.AFPacketCapture()
+        self.start_capture(capture, interface='any', max_size=60,
+                           pcap_filter=udp_to_test_port())
+        try:
+            send_udp(make_payloads(5))
+            packets = capture.wait_for_packets(count=5, timeout=5)
+        finally:
+            capture.stop_capture()
+
+        sll_class = pcap_file.LINK_LAYER_CLASSES[
+            pcap_file.LINKTYPE_LINUX_SLL]
+        packets[-1].parse([sll_class])
+        self.assertEqual(TEST_PORT, packets[-1].get_layer('udp').dest_port)
+        self.assertEqual(b'pkt4', bytes(packets[-1].packet_data)[-4:])
+        self.assertEqual(16 + 20 + 8 + 4, len(packets[-1].packet_data))
+
+    def test_ring_read_without_copy(self):
+        try:
+            ring = af_packet.AFPacketRing(
+                'lo', pcap_filter_cache.compile_bpf(udp_to_test_port()),
+                block_size=65536, block_count=4, block_timeout_ms=1)
+        except exceptions.SocketException:
+            self.skipTest('AF_PACKET sockets not available')
+        frames = []
+        try:
+            send_udp(make_payloads(3))
+            for _ in range(50):
+                frames += ring.read(timeout=0.1, copy=False)
+                if len(frames) >= 3:
+                    break
+            self.assertEqual(3, len(frames))
+            self.assertTrue(isinstance(frames[0][0], memoryview))
+            self.assertEqual(b'pkt2', frames[2][0].tobytes()[-4:])
+            packet = pcap_packet.PCAPPacket(frames[2][0], frames[2][1])
+            packet.parse()
+            self.assertEqual(TEST_PORT, packet.get_layer('udp').dest_port)
+            self.assertTrue(len(ring._held_blocks) > 0)
+
+            ring.read(timeout=0)
+            self.assertEqual([], ring._held_blocks)
+        finally:
+            del frames[:]
+            ring.close()
+
+    def test_ring_ignores_other_interfaces(self):
+        # Frames bound for another interface, sent while the rings are
+        # being set up, must never reach them
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        stop = threading.Event()
+
+        def send_away():
+            while not stop.is_set():
+                try:
+                    sender.sendto(b'away', ('192.0.2.1', TEST_PORT))
+                except socket.error:
+                    return
+
+        thread = threading.Thread(target=send_away)
+        thread.start()
+        frames = []
+        try:
+            for _ in range(10):
+                try:
+                    ring = af_packet.AFPacketRing(
+                        'lo',
+                        pcap_filter_cache.compile_bpf(udp_to_test_port()),
+                        block_size=65536, block_count=4,
+                        block_timeout_ms=1)
+                except exceptions.SocketException:
+                    self.skipTest('AF_PACKET sockets not available')
+                try:
+                    frames += ring.read(timeout=0.05)
+                    frames += ring.read(timeout=0.05)
+                finally:
+                    ring.close()
+        finally:
+            stop.set()
+            thread.join()
+            sender.close()
+        self.assertEqual([], frames)
+
+    def test_ring_block_size(self):
+        self.assertRaises(exceptions.ArgMismatchException,
+                          af_packet.AFPacketRing, 'lo', None, 1000)
+
+run_unit_test(AFPacketTest)
@@ -0,0 +1,109 @@
+import unittest
+from python_utils.common import exceptions
+from python_utils.net import capture_server
+from python_utils.net import pcap_packet
+from python_utils.net import pcap_rules
+from python_utils.tests.utils.test_utils import run_unit_test
+
+TCP_FRAME = \
+    [0x52, 0x54, 0x00, 0x12, 0x35, 0x02, 0x08, 0x00,
+     0x27, 0xc6, 0x25, 0x01, 0x08, 0x00, 0x45, 0x10,
+     0x00, 0x5c, 0x93, 0x06, 0x40, 0x00, 0x40, 0x06,
+     0x8f, 0x75, 0x0a, 0x00, 0x02, 0x0f, 0x0a, 0x00,
+     0x02, 0x02, 0x00, 0x16, 0xd1, 0xf4, 0x52, 0x1a,
+     0x58, 0x7c, 0x58, 0x25, 0x2e, 0x9b, 0x50, 0x12,
+     0x9f, 0xb0, 0x18, 0x5f, 0x00, 0x00]
+
+UDP_FRAME = \
+    [0x52, 0x54, 0x00, 0x12, 0x35, 0x02, 0x08, 0x00,
+     0x27, 0xc6, 0x25, 0x01, 0x08, 0x00, 0x45, 0x00,
+     0x00, 0x20, 0x00, 0x01, 0x00, 0x00, 0x40, 0x11,
+     0x00, 0x00, 0xc0, 0xa8, 0x01, 0x0a, 0xc0, 0xa8,
+     0x01, 0x01, 0x00, 0x35, 0x04, 0xd2, 0x00, 0x0c,
+     0x00, 0x00, 0xDE, 0xAD, 0xBE, 0xEF]
+
+
+def is_tcp(packet):
+    return 'tcp' in packet
+
+
+def from_ssh_port(packet):
+    return packet.get_layer('tcp').source_port == 22
+
+
+class CaptureServerTest(unittest.TestCase):
+
+    def test_dispatch_to_subscribers(self):
+        server = capture_server.CaptureServer(interface='eth0')
+        tcp_sub = server.subscribe(is_tcp)
+        all_sub = server.subscribe()
+
+        for i in range(3):
+            server.dispatch(pcap_packet.PCAPPacket(TCP_FRAME, i))
+            server.dispatch(pcap_packet.PCAPPacket(UDP_FRAME, i))
+
+        self.assertEqual(6, server.packets_dispatched)
+        self.assertEqual(3, tcp_sub.matched)
+        ret = tcp_sub.wait_for_packets(count=3, timeout=1)
+        self.assertEqual([0, 1, 2], [p.timestamp for p in ret])
+        self.assertEqual(22, ret[0].get_layer('tcp').source_port)
+        self.assertEqual(6, len(all_sub.wait_for_packets(count=0)))
+
+    def test_dispatch_errors(self):
+        server = capture_server.CaptureServer(interface='eth0')
+        failing_sub = server.subscribe(from_ssh_port)
+        all_sub = server.subscribe()
+
+        # Truncated in the IP header, and a UDP packet which makes the
+        # first subscriber's predicate raise
+        server.dispatch(pcap_packet.PCAPPacket(TCP_FRAME[:18], 0))
+        server.dispatch(pcap_packet.PCAPPacket(UDP_FRAME, 1))
+        server.dispatch(pcap_packet.PCAPPacket(TCP_FRAME, 2))
+
+        self.assertEqual(3, server.packets_dispatched)
+        ret = all_sub.wait_for_packets(count=0)
+        self.assertEqual([0, 1, 2], [p.timestamp for p in ret])
+        self.assertEqual(['ethernet'], list(ret[0]))
+        self.assertEqual(2, failing_sub.errors)
+        self.assertTrue(isinstance(failing_sub.last_error, AttributeError))
+        self.assertEqual([2], [p.timestamp for p in
+                               failing_sub.wait_for_packets(count=0)])
+
+    def test_subscribe_with_rule(self):
+        server = capture_server.CaptureServer(interface='eth0')
+        dns_sub = server.subscribe(pcap_rules.And(
+            [pcap_rules.UDPProto(), pcap_rules.Port(53, source=True)]))
+        server.dispatch(pcap_packet.PCAPPacket(TCP_FRAME, 0))
+        server.dispatch(pcap_packet.PCAPPacket(UDP_FRAME, 1))
+
+        self.assertEqual(1, dns_sub.matched)
+        self.assertEqual([1], [p.timestamp for p in
+                               dns_sub.wait_for_packets(count=0)])
+
+    def test_subscribe_unsubscribe_while_running(self):
+        server = capture_server.CaptureServer(interface='eth0')
+        early_sub = server.subscribe()
+        server.dispatch(pcap_packet.PCAPPacket(TCP_FRAME, 0))
+
+        late_sub = server.subscribe()
+        early_sub.close()
+        server.dispatch(pcap_packet.PCAPPacket(UDP_FRAME, 1))
+
+        self.assertEqual([0], [p.timestamp for p in
+                               early_sub.wait_for_packets(count=0)])
+        self.assertEqual([1], [p.timestamp for p in
+                               late_sub.iter_packets(timeout=0.1)])
+
+    def test_queue_limit_and_timeout(self):
+        server = capture_server.CaptureServer(interface='eth0')
+        sub = server.subscribe(max_queue=2)
+        for i in range(3):
+            server.dispatch(pcap_packet.PCAPPacket(UDP_FRAME, i))
+
+        self.assertEqual(3, sub.matched)
+        self.assertEqual(1, sub.dropped)
+        self.assertRaises(exceptions.SubprocessTimeoutException,
+                          sub.wait_for_packets, count=3, timeout=0.2)
+        self.assertEqual(2, len(sub.wait_for_packets(count=2, timeout=0)))
+
+run_unit_test(CaptureServerTest)
@@ -0,0 +1,138 @@
+import unittest
+from python_utils.net import flow_table
+from python_utils.net import pcap_packet
+from python_utils.tests.utils import packet_builder
+from python_utils.tests.utils.test_utils import run_unit_test
+
+SYN = pcap_packet.TCP_PROTOCOL_FLAG_SYN
+ACK = pcap_packet.TCP_PROTOCOL_FLAG_ACK
+FIN = pcap_packet.TCP_PROTOCOL_FLAG_FINAL
+RST = pcap_packet.TCP_PROTOCOL_FLAG_RESET
+
+CLIENT = ('10.0.0.1', 40000)
+SERVER = ('10.0.0.2', 80)
+
+
+def make_packet(source, dest, flags=None, payload=b'', timestamp=0.0):
+    """
+    Builds a parsed Ethernet/IP packet carrying a TCP segment with the
+    given flags, or a UDP datagram if flags is None.
+    """
+    if flags is None:
+        data = packet_builder.udp_datagram(source[1], dest[1], payload)
+        protocol = pcap_packet.IP4_PROTOCOL_UDP
+    else:
+        data = packet_builder.tcp_segment(source[1], dest[1], flags,
+                                          payload=payload)
+        protocol = pcap_packet.IP4_PROTOCOL_TCP
+    return packet_builder.make_packet(
+        packet_builder.ip4_frame(source[0], dest[0], protocol, data),
+        timestamp)
+
+
+class FlowTableTest(unittest.TestCase):
+
+    def test_handshake_and_close(self):
+        table = flow_table.FlowTable()
+        table.add(make_packet(CLIENT, SERVER, SYN, timestamp=1.0))
+        flow = table.get(SERVER[0], SERVER[1], CLIENT[0], CLIENT[1])
+        self.assertEqual(flow_table.FLOW_STATE_SYN_SENT, flow.state)
+        self.assertFalse(flow.handshake_complete)
+
+        table.add(make_packet(SERVER, CLIENT, SYN | ACK, timestamp=1.1))
+        table.add(make_packet(CLIENT, SERVER, ACK, timestamp=1.2))
+        self.assertTrue(flow.handshake_complete)
+        table.add(make_packet(CLIENT, SERVER, ACK, b'GET /', 1.3))
+        table.add(make_packet(CLIENT, SERVER, FIN | ACK, timestamp=1.4))
+        self.assertEqual(flow_table.FLOW_STATE_CLOSING, flow.state)
+        table.add(make_packet(SERVER, CLIENT, FIN | ACK, timestamp=1.5))
+
+        self.assertEqual(1, len(table))
+        self.assertTrue(flow.is_closed)
+        self.assertTrue(flow.handshake_complete)
+        self.assertEqual(flow_table.FlowKey(
+            pcap_packet.IP4_PROTOCOL_TCP, CLIENT[0], CLIENT[1], SERVER[0],
+            SERVER[1]), flow.key)
+        self.assertEqual([4, 2], flow.packets)
+        self.assertEqual(6, flow.packet_count)
+        self.assertEqual(54 * 6 + 5, flow.byte_count)
+        self.assertEqual(SYN | ACK | FIN, flow.tcp_flags[0])
+        self.assertEqual((1, FIN | ACK), flow.flag_history[-1])
+        self.assertAlmostEqual(0.5, flow.duration)
+
+    def test_reset_and_missed_syn(self):
+        table = flow_table.FlowTable()
+        flow = table.add(make_packet(SERVER, CLIENT, SYN | ACK))
+        self.assertEqual(CLIENT[0], flow.key.source_ip)
+        self.assertEqual([0, 1], flow.packets)
+
+        table.add(make_packet(CLIENT, SERVER, ACK))
+        self.assertFalse(flow.handshake_complete)
+        table.add(make_packet(SERVER, CLIENT, RST))
+        table.add(make_packet(SERVER, CLIENT, FIN))
+        self.assertEqual(flow_table.FLOW_STATE_RESET, flow.state)
+        self.assertTrue(flow.is_closed)
+
+    def test_close_without_handshake(self):
+        table = flow_table.FlowTable()
+        flow = table.add(make_packet(CLIENT, SERVER, FIN | ACK))
+        table.add(make_packet(SERVER, CLIENT, FIN | ACK))
+        self.assertTrue(flow.is_closed)
+        self.assertFalse(flow.handshake_complete)
+        self.assertEqual(flow_table.FLOW_STATE_NEW, flow.state)
+
+        flow = table.add(make_packet(CLIENT, ('10.0.0.3', 80), SYN))
+        table.add(make_packet(CLIENT, ('10.0.0.3', 80), FIN))
+        table.add(make_packet(('10.0.0.3', 80), CLIENT, FIN))
+        self.assertTrue(flow.is_closed)
+        self.assertFalse(flow.handshake_complete)
+        self.assertEqual(flow_table.FLOW_STATE_SYN_SENT, flow.state)
+
+    def test_reset_after_handshake(self):
+        table = flow_table.FlowTable()
+        flow = table.add(make_packet(CLIENT, SERVER, SYN))
+        table.add(make_packet(SERVER, CLIENT, SYN | ACK))
+        table.add(make_packet(CLIENT, SERVER, ACK))
+        table.add(make_packet(SERVER, CLIENT, RST))
+        self.assertEqual(flow_table.FLOW_STATE_RESET, flow.state)
+        self.assertTrue(flow.is_closed)
+        self.assertTrue(flow.handshake_complete)
+
+    def test_udp_and_ignored_packets(self):
+        table = flow_table.FlowTable()
+        table.add(make_packet(CLIENT, ('10.0.0.3', 53), payload=b'q'))
+        table.add(make_packet(('10.0.0.3', 53), CLIENT, payload=b'ans'))
+        self.assertEqual(None, table.add(
+            pcap_packet.PCAPPacket(b'\x02' * 12 + b'\x08\x06', 0.0)))
+
+        flow = table.get(CLIENT[0], CLIENT[1], '10.0.0.3', 53,
+                         protocol=pcap_packet.IP4_PROTOCOL_UDP)
+        self.assertEqual([1, 1], flow.packets)
+        self.assertEqual([0, 0], flow.tcp_flags)
+        self.assertEqual(flow_table.FLOW_STATE_NEW, flow.state)
+        self.assertEqual(None, table.get(CLIENT[0], CLIENT[1], '10.0.0.3',
+                                         53))
+
+    def test_idle_expiry_and_eviction(self):
+        expired = []
+        table = flow_table.FlowTable(idle_timeout=10, max_flows=3,
+                                     expired_callback=expired.append)
+        for port in range(5):
+            table.add(make_packet(CLIENT, ('10.0.0.9', port), SYN,
+                                  timestamp=float(port)))
+        self.assertEqual(3, len(table))
+        self.assertEqual(2, table.evictions)
+        self.assertEqual([0, 1], [f.key.dest_port for f in expired])
+
+        # Port 2's flow stays active, so ports 3 and 4 go idle first
+        table.add(make_packet(CLIENT, ('10.0.0.9', 2), ACK, timestamp=9.0))
+        table.add(make_packet(CLIENT, ('10.0.0.9', 5), SYN, timestamp=14.5))
+        self.assertEqual(2, table.expirations)
+        self.assertEqual([2, 5], sorted(f.key.dest_port for f in table))
+        self.assertEqual(2, table.expire(now=100.0))
+        self.assertEqual(0, len(table))
+        self.assertEqual(4, table.expirations)
+        self.assertEqual([0, 1, 3, 4, 2, 5],
+                         [f.key.dest_port for f in expired])
+
+run_unit_test(FlowTableTest)
@@ -0,0 +1,94 @@
+import unittest
+from python_utils.net import ip_reassembly
+from python_utils.net import pcap_packet
+from python_utils.tests.utils import packet_builder
+from python_utils.tests.utils.test_utils import run_unit_test
+
+SOURCE = '10.0.0.1'
+DEST = '10.0.0.2'
+PAYLOAD = bytes(bytearray(i % 251 for i in range(3000)))
+
+
+def make_fragments(ident=7, payload=PAYLOAD, fragment_size=1480,
+                   timestamp=0.0):
+    """
+    Splits a UDP datagram into parsed Ethernet/IP fragment packets.
+    """
+    datagram = packet_builder.udp_datagram(5000, 53, payload)
+    packets = []
+    for offset in range(0, len(datagram), fragment_size):
+        more = offset + fragment_size < len(datagram)
+        packets.append(packet_builder.make_packet(packet_builder.ip4_frame(
+            SOURCE, DEST, pcap_packet.IP4_PROTOCOL_UDP,
+            datagram[offset:offset + fragment_size], ident,
+            ((pcap_packet.IP4_FLAG_MORE_FRAGMENTS << 13) if more else 0) |
+            (offset // 8)), timestamp))
+    return packets
+
+
+class IPReassemblyTest(unittest.TestCase):
+
+    def test_fragment_layers(self):
+        first, middle, last = make_fragments()
+        self.assertTrue(first.get_layer('ip').is_fragment())
+        self.assertTrue('udp' in first)
+        self.assertEqual(185, middle.get_layer('ip').fragment_offset)
+        self.assertFalse('udp' in middle)
+        self.assertEqual(None, last.get_layer('ip').next_parse_recommendation)
+        self.assertFalse(last.get_layer('ip').is_flag_set(
+            pcap_packet.IP4_FLAG_MORE_FRAGMENTS))
+
+    def test_reassemble_out_of_order(self):
+        reassembler = ip_reassembly.IPReassembler()
+        first, middle, last = make_fragments()
+        other = make_fragments(ident=8)[0]
+
+        packets = list(reassembler.reassemble([last, other, first, middle]))
+
+        self.assertEqual(1, len(packets))
+        packet = packets[0]
+        ip = packet.get_layer('ip')
+        self.assertFalse(ip.is_fragment())
+        self.assertEqual(20 + 8 + 3000, ip.total_length)
+        self.assertEqual(0, ip_reassembly.ip_checksum(
+            bytes(packet.packet_data[14:34])))
+        self.assertEqual(53, packet.get_layer('udp').dest_port)
+        self.assertEqual(8 + 3000, packet.get_layer('udp').length)
+        self.assertEqual(PAYLOAD, packet.get_payload('udp').tobytes())
+        self.assertEqual(1, reassembler.reassembled)
+        self.assertEqual(1, len(reassembler))
+        self.assertEqual(1480, reassembler.buffered)
+
+    def test_pass_through_and_duplicates(self):
+        reassembler = ip_reassembly.IPReassembler()
+        first, middle, last = make_fragments(payload=PAYLOAD[:2000],
+                                             fragment_size=800)
+        whole = make_fragments(ident=9, payload=b'x' * 10)[0]
+
+        packets = list(reassembler.reassemble(
+            [first, whole, first, middle, last]))
+
+        self.assertEqual(2, len(packets))
+        self.assertTrue(packets[0] is whole)
+        self.assertEqual(PAYLOAD[:2000],
+                         packets[1].get_payload('udp').tobytes())
+        self.assertEqual(0, reassembler.buffered)
+
+    def test_timeout_and_memory_limit(self):
+        reassembler = ip_reassembly.IPReassembler(timeout=5, max_bytes=4000)
+        self.assertEqual(None, reassembler.add(
+            make_fragments(ident=1, timestamp=1.0)[0]))
+        self.assertEqual(None, reassembler.add(
+            make_fragments(ident=2, timestamp=2.0)[0]))
+        # Holding ident 3 takes it past 4000 bytes, dropping ident 1
+        reassembler.add(make_fragments(ident=3, timestamp=3.0)[0])
+        self.assertEqual(1, reassembler.dropped)
+        self.assertEqual(2, len(reassembler))
+
+        reassembler.add(make_fragments(ident=4, timestamp=7.5)[1])
+        self.assertEqual(1, reassembler.expired)
+        self.assertEqual(2, len(reassembler))
+        self.assertEqual(2, reassembler.expire(now=100.0))
+        self.assertEqual(0, reassembler.buffered)
+
+run_unit_test(IPReassemblyTest)
@@ -0,0 +1,97 @@
+import multiprocessing
+import time
+import unittest
+from python_utils.common import exceptions
+from python_utils.net import packet_ring
+from python_utils.tests.utils.test_utils import run_unit_test
+
+
+def produce_packets(ring, count):
+    """
+    :type ring: packet_ring.PacketRing
+    :type count: int
+    """
+    time.sleep(0.2)
+    for i in range(count):
+        while not ring.write(bytearray([i % 256] * (i % 100 + 1)), i):
+            time.sleep(0.001)
+
+
+class PacketRingTest(unittest.TestCase):
+
+    def test_write_read(self):
+        ring = packet_ring.PacketRing(size=1024)
+        self.assertTrue(ring.write(bytearray([1, 2, 3]), 1.5))
+        self.assertTrue(ring.write([4, 5], 2.5))
+        self.assertTrue(ring.write(memoryview(b'\x06'), 3.5))
+
+        self.assertEqual([(b'\x01\x02\x03', 1.5), (b'\x04\x05', 2.5)],
+                         ring.read(max_packets=2))
+        packets = ring.read_packets()
+        self.assertEqual(1, len(packets))
+        self.assertEqual(b'\x06', packets[0].packet_data)
+        self.assertEqual(3.5, packets[0].timestamp)
+
+        self.assertEqual(3, ring.packets_written)
+        self.assertEqual(3, ring.packets_read)
+        self.assertEqual(0, ring.used_bytes)
+        ring.close()
+
+    def test_wrap_around(self):
+        ring = packet_ring.PacketRing(size=256)
+        read = []
+        for i in range(50):
+            self.assertTrue(ring.write(bytearray([i] * 40), i))
+            if i % 3 == 2:
+                read += ring.read()
+        read += ring.read()
+
+        self.assertEqual(list(range(50)), [ts for _, ts in read])
+        self.assertEqual([bytes(bytearray([i] * 40)) for i in range(50)],
+                         [data for data, _ in read])
+        self.assertEqual(0, ring.packets_dropped)
+        ring.close()
+
+    def test_overflow_counters(self):
+        ring = packet_ring.PacketRing(size=128)
+        self.assertTrue(ring.write(bytearray(48), 0))
+        self.assertTrue(ring.write(bytearray(48), 1))
+        self.assertFalse(ring.write(bytearray(48), 2))
+        self.assertFalse(ring.write(bytearray(500), 3))
+
+        self.assertEqual(2, ring.packets_written)
+        self.assertEqual(2, ring.packets_dropped)
+        self.assertEqual(548, ring.bytes_dropped)
+        self.assertEqual(2, len(ring.read()))
+        ring.close()
+
+        self.assertRaises(exceptions.ArgMismatchException,
+                          packet_ring.PacketRing, 100)
+
+    def test_blocking_read_timeout(self):
+        ring = packet_ring.PacketRing(size=1024)
+        start_time = time.time()
+        self.assertEqual([], ring.read(timeout=0.3))
+        self.assertTrue(time.time() - start_time >= 0.3)
+        ring.close()
+
+    def test_cross_process(self):
+        ring = packet_ring.PacketRing(size=4096)
+        count = 2000
+        p = multiprocessing.Process(target=produce_packets,
+                                    args=(ring, count))
+        p.start()
+
+        read = []
+        while len(read) < count:
+            batch = ring.read(timeout=5)
+            self.assertNotEqual(0, len(batch))
+            read += batch
+        p.join()
+
+        self.assertEqual(list(range(count)), [ts for _, ts in read])
+        self.assertEqual(bytes(bytearray([(count - 1) % 256] * 100)),
+                         read[-1][0])
+        ring.close()
+
+run_unit_test(PacketRingTest)
@@ -0,0 +1,139 @@
+import unittest
+from python_utils.common import exceptions
+from python_utils.net import pcap_batch
+from python_utils.net import pcap_packet
+from python_utils.tests.utils import packet_builder
+from python_utils.tests.utils.test_utils import run_unit_test
+
+TCP_FRAME = \
+    [0x52, 0x54, 0x00, 0x12, 0x35, 0x02, 0x08, 0x00,
+     0x27, 0xc6, 0x25, 0x01, 0x08, 0x00, 0x45, 0x10,
+     0x00, 0x5c, 0x93, 0x06, 0x40, 0x00, 0x40, 0x06,
+     0x8f, 0x75, 0x0a, 0x00, 0x02, 0x0f, 0x0a, 0x00,
+     0x02, 0x02, 0x00, 0x16, 0xd1, 0xf4, 0x52, 0x1a,
+     0x58, 0x7c, 0x58, 0x25, 0x2e, 0x9b, 0x50, 0x12,
+     0x9f, 0xb0, 0x18, 0x5f, 0x00, 0x00]
+
+UDP_FRAME = \
+    [0x52, 0x54, 0x00, 0x12, 0x35, 0x02, 0x08, 0x00,
+     0x27, 0xc6, 0x25, 0x01, 0x08, 0x00, 0x45, 0x00,
+     0x00, 0x20, 0x00, 0x01, 0x00, 0x00, 0x40, 0x11,
+     0x00, 0x00, 0xc0, 0xa8, 0x01, 0x0a, 0xc0, 0xa8,
+     0x01, 0x01, 0x00, 0x35, 0x04, 0xd2, 0x00, 0x0c,
+     0x00, 0x00, 0xDE, 0xAD, 0xBE, 0xEF]
+
+ARP_FRAME = \
+    [0x52, 0x54, 0x00, 0x12, 0x35, 0x02, 0x08, 0x00,
+     0x27, 0xc6, 0x25, 0x01, 0x08, 0x06, 0x00, 0x01,
+     0x08, 0x00, 0x06, 0x04, 0x00, 0x01, 0x08, 0x00,
+     0x27, 0x7a, 0x9d, 0xff, 0xc0, 0xa8, 0x01, 0x0a,
+     0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0xc0, 0xa8,
+     0x01, 0x01]
+
+
+class PCAPBatchTest(unittest.TestCase):
+
+    def test_decode_header_columns(self):
+        frames = [bytes(bytearray(TCP_FRAME)), UDP_FRAME,
+                  bytearray(ARP_FRAME), bytearray(TCP_FRAME[0:30])]
+
+        cols = pcap_batch.decode_header_columns(frames)
+
+        self.assertEqual(
+            [True, True, False, False], list(cols['is_ip']))
+        self.assertEqual(
+            [True, False, False, False], list(cols['is_tcp']))
+        self.assertEqual(
+            [False, True, False, False], list(cols['is_udp']))
+        self.assertEqual(
+            [0x0800, 0x0800, 0x0806, 0x0800], list(cols['ethertype']))
+        self.assertEqual(
+            [54, 46, 42, 30], list(cols['length']))
+        self.assertEqual(
+            [0x0a00020f, 0xc0a8010a, 0, 0], list(cols['ip_source']))
+        self.assertEqual(
+            [0x0a000202, 0xc0a80101, 0, 0], list(cols['ip_dest']))
+        self.assertEqual(
+            [pcap_packet.IP4_PROTOCOL_TCP, pcap_packet.IP4_PROTOCOL_UDP,
+             0, 0],
+            list(cols['protocol']))
+        self.assertEqual(
+            [22, 53, 0, 0], list(cols['source_port']))
+        self.assertEqual(
+            [53748, 1234, 0, 0], list(cols['dest_port']))
+        self.assertEqual(
+            [92, 32, 0, 0], list(cols['ip_length']))
+        self.assertEqual(
+            [1377458300, 0, 0, 0], list(cols['seq']))
+        self.assertEqual(
+            [1478831771, 0, 0, 0], list(cols['ack']))
+        self.assertEqual(
+            [pcap_packet.TCP_PROTOCOL_FLAG_ACK |
+             pcap_packet.TCP_PROTOCOL_FLAG_SYN, 0, 0, 0],
+            list(cols['tcp_flags']))
+
+    def test_decode_matches_packet_parsing(self):
+        packets = [pcap_packet.PCAPPacket(bytes(bytearray(f)), '')
+                   for f in (TCP_FRAME, UDP_FRAME) * 3]
+
+        cols = pcap_batch.decode_header_columns(packets)
+
+        for i, packet in enumerate(packets):
+            pmap = packet.parse()
+            l4 = pmap['tcp'] if 'tcp' in pmap else pmap['udp']
+            ip_source = int(cols['ip_source'][i])
+            self.assertEqual(
+                pmap['ip'].source_ip,
+                pcap_packet.PCAPPacket.char8_to_ip4(
+                    *[(ip_source >> shift) & 0xff
+                      for shift in (24, 16, 8, 0)]))
+            self.assertEqual(
+                l4.source_port, cols['source_port'][i])
+            self.assertEqual(
+                l4.dest_port, cols['dest_port'][i])
+
+    def test_decode_buffer_columns_sll(self):
+        sll_frame = ([0x00, 0x04, 0x00, 0x01, 0x00, 0x06, 0x08, 0x00,
+                      0x27, 0xc6, 0x25, 0x01, 0x00, 0x00] + TCP_FRAME[12:])
+        buf = bytes(bytearray(UDP_FRAME[0:2] + sll_frame))
+
+        cols = pcap_batch.decode_buffer_columns(
+            buf, [2], [len(sll_frame)], link_layer=pcap_packet.PCAPSLL)
+
+        self.assertEqual(
+            [True], list(cols['is_tcp']))
+        self.assertEqual(
+            [53748], list(cols['dest_port']))
+
+    def test_decode_fragments(self):
+        datagram = packet_builder.udp_datagram(5000, 53, b'x' * 40)
+        more = pcap_packet.IP4_FLAG_MORE_FRAGMENTS << 13
+        frames = [packet_builder.ip4_frame(
+                      '10.0.0.1', '10.0.0.2', pcap_packet.IP4_PROTOCOL_UDP,
+                      datagram[:24], flags_fragment=more),
+                  packet_builder.ip4_frame(
+                      '10.0.0.1', '10.0.0.2', pcap_packet.IP4_PROTOCOL_UDP,
+                      datagram[24:], flags_fragment=3)]
+
+        cols = pcap_batch.decode_header_columns(frames)
+
+        self.assertEqual(
+            [True, True], list(cols['is_ip']))
+        self.assertEqual(
+            [True, False], list(cols['is_udp']))
+        self.assertEqual(
+            [False, False], list(cols['is_tcp']))
+        self.assertEqual(
+            [5000, 0], list(cols['source_port']))
+        self.assertEqual(
+            [53, 0], list(cols['dest_port']))
+
+    def test_decode_empty_and_bad_link_layer(self):
+        cols = pcap_batch.decode_header_columns([])
+        self.assertEqual(0, len(cols['dest_port']))
+
+        self.assertRaises(exceptions.ArgMismatchException,
+                          pcap_batch.decode_buffer_columns,
+                          b'', [], [], pcap_packet.PCAPIP4)
+
+run_unit_test(PCAPBatchTest)
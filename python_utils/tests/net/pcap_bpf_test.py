@@ -0,0 +1,194 @@
+import socket
+import threading
+import unittest
+from python_utils.common import exceptions
+from python_utils.net import pcap_bpf
+from python_utils.net import pcap_file
+from python_utils.net import pcap_rules
+from python_utils.tests.utils.test_utils import run_unit_test
+
+# 10.0.2.15:22 -> 10.0.2.2:53748, SYN+ACK
+TCP_FRAME = \
+    [0x52, 0x54, 0x00, 0x12, 0x35, 0x02, 0x08, 0x00,
+     0x27, 0xc6, 0x25, 0x01, 0x08, 0x00, 0x45, 0x10,
+     0x00, 0x5c, 0x93, 0x06, 0x40, 0x00, 0x40, 0x06,
+     0x8f, 0x75, 0x0a, 0x00, 0x02, 0x0f, 0x0a, 0x00,
+     0x02, 0x02, 0x00, 0x16, 0xd1, 0xf4, 0x52, 0x1a,
+     0x58, 0x7c, 0x58, 0x25, 0x2e, 0x9b, 0x50, 0x12,
+     0x9f, 0xb0, 0x18, 0x5f, 0x00, 0x00]
+
+# 192.168.1.10:53 -> 224.0.0.251:1234, to a multicast MAC
+UDP_FRAME = \
+    [0x01, 0x00, 0x5e, 0x00, 0x00, 0xfb, 0x08, 0x00,
+     0x27, 0xc6, 0x25, 0x01, 0x08, 0x00, 0x45, 0x00,
+     0x00, 0x20, 0x00, 0x01, 0x00, 0x00, 0x40, 0x11,
+     0x00, 0x00, 0xc0, 0xa8, 0x01, 0x0a, 0xe0, 0x00,
+     0x00, 0xfb, 0x00, 0x35, 0x04, 0xd2, 0x00, 0x0c,
+     0x00, 0x00, 0xDE, 0xAD, 0xBE, 0xEF]
+
+# ARP request from 10.0.2.15 for 10.0.2.2
+ARP_FRAME = \
+    [0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0x08, 0x00,
+     0x27, 0xc6, 0x25, 0x01, 0x08, 0x06, 0x00, 0x01,
+     0x08, 0x00, 0x06, 0x04, 0x00, 0x01, 0x08, 0x00,
+     0x27, 0xc6, 0x25, 0x01, 0x0a, 0x00, 0x02, 0x0f,
+     0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x0a, 0x00,
+     0x02, 0x02]
+
+FRAMES = [TCP_FRAME, UDP_FRAME, ARP_FRAME]
+
+
+class PCAPBPFTest(unittest.TestCase):
+
+    def assert_compiles_like_evaluator(self, rule, expected):
+        """
+        Check the compiled BPF program and the in-process evaluator both
+        match exactly the expected frames.
+        """
+        program = pcap_bpf.compile_rule(rule)
+        self.assertEqual(expected,
+                         [f for f in FRAMES if program.matches(f)],
+                         'BPF mismatch for: ' + rule.to_str())
+        self.assertEqual(expected,
+                         [f for f in FRAMES if rule.matches(f)],
+                         'Evaluator mismatch for: ' + rule.to_str())
+
+    def test_type_rules(self):
+        self.assert_compiles_like_evaluator(
+            pcap_rules.Host('10.0.2.15'), [TCP_FRAME, ARP_FRAME])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.Host('10.0.2.15', 'ip', source=True), [TCP_FRAME])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.Host('10.0.2.2', 'arp', dest=True), [ARP_FRAME])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.Host('ff:ff:ff:ff:ff:ff', 'ether'), [ARP_FRAME])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.Net('10.0.2.0/24'), [TCP_FRAME, ARP_FRAME])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.Net('192.168', dest=True), [])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.Port(53), [UDP_FRAME])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.Port(22, 'tcp', source=True, dest=True), [])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.PortRange(1000, 60000, dest=True),
+            [TCP_FRAME, UDP_FRAME])
+
+    def test_proto_and_cast_rules(self):
+        self.assert_compiles_like_evaluator(
+            pcap_rules.IPProto('tcp'), [TCP_FRAME])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.EtherProto('arp'), [ARP_FRAME])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.UDPProto(), [UDP_FRAME])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.Broadcast(), [ARP_FRAME])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.Multicast(), [UDP_FRAME, ARP_FRAME])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.Multicast('ip'), [UDP_FRAME])
+
+    def test_comparison_and_boolean_rules(self):
+        self.assert_compiles_like_evaluator(
+            pcap_rules.GreaterThan('len', '50'), [TCP_FRAME])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.NotEqual('tcp[tcpflags] & tcp-syn', '0'),
+            [TCP_FRAME])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.Equal('udp[(ip[0] & 0xf) - 3:2]',
+                             'ip[9] * 72 + 10'),
+            [UDP_FRAME])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.Or([pcap_rules.Port(22),
+                           pcap_rules.Not(pcap_rules.EtherProto('ip'))]),
+            [TCP_FRAME, ARP_FRAME])
+        self.assert_compiles_like_evaluator(
+            pcap_rules.And([pcap_rules.Multicast(),
+                            pcap_rules.Not(pcap_rules.Broadcast())]),
+            [UDP_FRAME])
+        self.assert_compiles_like_evaluator(pcap_rules.Null(), FRAMES)
+
+    def test_program_limits(self):
+        program = pcap_bpf.compile_rule(pcap_rules.Null(), snaplen=96)
+        self.assertEqual(96, program.run(TCP_FRAME))
+        self.assertEqual(8 * len(program), len(program.pack()))
+
+        # Reading past the end of the frame drops it outright
+        program = pcap_bpf.compile_rule(
+            pcap_rules.Not(pcap_rules.Equal('ether[100]', '0')))
+        self.assertEqual(0, program.run(TCP_FRAME))
+
+        self.assertRaises(exceptions.ArgMismatchException,
+                          pcap_bpf.compile_rule, pcap_rules.Simple('foo'))
+        self.assertRaises(exceptions.ArgMismatchException,
+                          pcap_bpf.compile_rule,
+                          pcap_rules.Multicast(),
+                          pcap_file.LINKTYPE_LINUX_SLL)
+
+        # Cooked socket frames start at the network header, with the
+        # ether type loaded from the kernel's ancillary data
+        program = pcap_bpf.compile_rule(pcap_rules.Port(53),
+                                        pcap_bpf.LINKTYPE_COOKED_SOCKET)
+        self.assertEqual(0xfffff000, program.instructions[0].k)
+        self.assertRaises(exceptions.ArgMismatchException,
+                          pcap_bpf.compile_rule,
+                          pcap_rules.Equal('ether[0]', '1'),
+                          pcap_bpf.LINKTYPE_COOKED_SOCKET)
+
+    def test_attach_filter(self):
+        try:
+            sock = pcap_bpf.open_capture_socket(
+                'lo', pcap_rules.And([pcap_rules.UDPProto(),
+                                      pcap_rules.Port(39999, dest=True)]))
+        except socket.error:
+            self.skipTest('Raw sockets not available')
+        sock.settimeout(2)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sender.sendto(b'drop', ('127.0.0.1', 39998))
+            sender.sendto(b'keep', ('127.0.0.1', 39999))
+            self.assertEqual(b'keep', sock.recv(65535)[-4:])
+        finally:
+            sender.close()
+            sock.close()
+
+    def test_capture_socket_ignores_other_interfaces(self):
+        # Frames bound for another interface, sent while the sockets are
+        # being set up, must never be queued on them
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        stop = threading.Event()
+
+        def send_away():
+            while not stop.is_set():
+                try:
+                    sender.sendto(b'away', ('192.0.2.1', 39999))
+                except socket.error:
+                    return
+
+        thread = threading.Thread(target=send_away)
+        thread.start()
+        payloads = []
+        try:
+            for _ in range(20):
+                try:
+                    sock = pcap_bpf.open_capture_socket(
+                        'lo', pcap_rules.And(
+                            [pcap_rules.UDPProto(),
+                             pcap_rules.Port(39999, dest=True)]))
+                except socket.error:
+                    self.skipTest('Raw sockets not available')
+                sock.settimeout(0.05)
+                try:
+                    while True:
+                        payloads.append(sock.recv(65535)[-4:])
+                except socket.timeout:
+                    pass
+                finally:
+                    sock.close()
+        finally:
+            stop.set()
+            thread.join()
+            sender.close()
+        self.assertEqual([], payloads)
+
+run_unit_test(PCAPBPFTest)
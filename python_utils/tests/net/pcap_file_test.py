@@ -0,0 +1,277 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from python_utils.common import exceptions
+from python_utils.net import pcap_file
+from python_utils.net import pcap_packet
+from python_utils.tests.utils.test_utils import run_unit_test
+
+TCP_FRAME = bytes(bytearray(
+    [0x52, 0x54, 0x00, 0x12, 0x35, 0x02, 0x08, 0x00,
+     0x27, 0xc6, 0x25, 0x01, 0x08, 0x00, 0x45, 0x10,
+     0x00, 0x5c, 0x93, 0x06, 0x40, 0x00, 0x40, 0x06,
+     0x8f, 0x75, 0x0a, 0x00, 0x02, 0x0f, 0x0a, 0x00,
+     0x02, 0x02, 0x00, 0x16, 0xd1, 0xf4, 0x52, 0x1a,
+     0x58, 0x7c, 0x58, 0x25, 0x2e, 0x9b, 0x50, 0x12,
+     0x9f, 0xb0, 0x18, 0x5f, 0x00, 0x00]))
+
+UDP_FRAME = bytes(bytearray(
+    [0x52, 0x54, 0x00, 0x12, 0x35, 0x02, 0x08, 0x00,
+     0x27, 0xc6, 0x25, 0x01, 0x08, 0x00, 0x45, 0x00,
+     0x00, 0x20, 0x00, 0x01, 0x00, 0x00, 0x40, 0x11,
+     0x00, 0x00, 0xc0, 0xa8, 0x01, 0x0a, 0xc0, 0xa8,
+     0x01, 0x01, 0x00, 0x35, 0x04, 0xd2, 0x00, 0x0c,
+     0x00, 0x00, 0xDE, 0xAD, 0xBE, 0xEF]))
+
+
+def make_pcap(records, order='<', magic=pcap_file.PCAP_MAGIC_USEC,
+              linktype=pcap_file.LINKTYPE_ETHERNET):
+    data = struct.pack(order + 'IHHiIII', magic, 2, 4, 0, 0, 65535, linktype)
+    for ts_sec, ts_frac, frame in records:
+        data += struct.pack(order + 'IIII', ts_sec, ts_frac, len(frame),
+                            len(frame)) + frame
+    return data
+
+
+def make_pcapng_block(order, block_type, body):
+    body += b'\x00' * (-len(body) % 4)
+    return (struct.pack(order + 'II', block_type, len(body) + 12) + body +
+            struct.pack(order + 'I', len(body) + 12))
+
+
+def make_pcapng(records, order='<', tsresol=None):
+    data = make_pcapng_block(
+        order, pcap_file.PCAPNG_BLOCK_SECTION_HEADER,
+        struct.pack(order + 'IHHq', pcap_file.PCAPNG_BYTE_ORDER_MAGIC,
+                    1, 0, -1))
+    options = b''
+    if tsresol is not None:
+        options = (struct.pack(order + 'HHB3x',
+                               pcap_file.PCAPNG_OPTION_IF_TSRESOL, 1,
+                               tsresol) +
+                   struct.pack(order + 'HH', pcap_file.PCAPNG_OPTION_END, 0))
+    data += make_pcapng_block(
+        order, pcap_file.PCAPNG_BLOCK_INTERFACE_DESCRIPTION,
+        struct.pack(order + 'HHI', pcap_file.LINKTYPE_ETHERNET, 0, 65535) +
+        options)
+    for ts, frame in records:
+        data += make_pcapng_block(
+            order, pcap_file.PCAPNG_BLOCK_ENHANCED_PACKET,
+            struct.pack(order + 'IIIII', 0, ts >> 32, ts & 0xffffffff,
+                        len(frame), len(frame)) + frame)
+    return data
+
+
+class PCAPFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_file(self, data, name='test.pcap'):
+        filename = os.path.join(self.tmp_dir, name)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+
+    def check_packets(self, packets):
+        self.assertEqual(2, len(packets))
+        self.assertEqual(TCP_FRAME, bytes(packets[0].packet_data))
+        self.assertEqual(UDP_FRAME, bytes(packets[1].packet_data))
+        self.assertEqual('10.0.2.15', packets[0].get_layer('ip').source_ip)
+        self.assertEqual(22, packets[0].get_layer('tcp').source_port)
+        self.assertEqual(1234, packets[1].get_layer('udp').dest_port)
+
+    def test_read_pcap_both_byte_orders(self):
+        for order in ('<', '>'):
+            filename = self.write_file(make_pcap(
+                [(1500000000, 250000, TCP_FRAME),
+                 (1500000001, 500000, UDP_FRAME)], order=order))
+
+            with pcap_file.PCAPFileReader(filename, parse=True) as reader:
+                packets = list(reader)
+                self.check_packets(packets)
+                self.assertAlmostEqual(1500000000.25, packets[0].timestamp)
+                self.assertAlmostEqual(1500000001.5, packets[1].timestamp)
+                self.assertFalse(reader.truncated)
+                del packets
+
+    def test_read_pcap_nanosecond_records(self):
+        filename = self.write_file(make_pcap(
+            [(1500000000, 123456789, TCP_FRAME)],
+            magic=pcap_file.PCAP_MAGIC_NSEC))
+
+        with pcap_file.PCAPFileReader(filename) as reader:
+            records = list(reader.read_records())
+            self.assertEqual(1, len(records))
+            self.assertEqual(1500000000123456789, records[0].timestamp_ns)
+            self.assertEqual(pcap_file.LINKTYPE_ETHERNET,
+                             records[0].linktype)
+            self.assertEqual(len(TCP_FRAME), records[0].orig_len)
+            del records
+
+    def test_read_pcap_truncated(self):
+        data = make_pcap([(1, 0, TCP_FRAME), (2, 0, UDP_FRAME)])
+        filename = self.write_file(data[:-10])
+
+        with pcap_file.PCAPFileReader(filename) as reader:
+            self.assertEqual(1, len(list(reader)))
+            self.assertTrue(reader.truncated)
+
+    def test_record_ranges(self):
+        frames = [TCP_FRAME, UDP_FRAME] * 5
+        filename = self.write_file(make_pcap(
+            [(i, 0, frame) for i, frame in enumerate(frames)]))
+
+        with pcap_file.PCAPFileReader(filename) as reader:
+            ranges = list(reader.record_ranges(150))
+            self.assertEqual(4, len(ranges))
+            self.assertEqual(pcap_file.PCAP_GLOBAL_HEADER_SIZE,
+                             ranges[0][0])
+            self.assertEqual(os.path.getsize(filename), ranges[-1][1])
+            timestamps = [[r.timestamp for r in reader.read_records(*rng)]
+                          for rng in ranges]
+            self.assertEqual([0, 1, 2], timestamps[0])
+            self.assertEqual(list(range(10)), sum(timestamps, []))
+
+        filename = self.write_file(make_pcapng([(0, TCP_FRAME)]),
+                                   name='test.pcapng')
+        with pcap_file.PCAPFileReader(filename) as reader:
+            self.assertRaises(exceptions.ArgMismatchException,
+                              list, reader.record_ranges(150))
+            self.assertRaises(exceptions.ArgMismatchException,
+                              reader.read_records, 0, 100)
+
+    def test_read_pcapng(self):
+        for order in ('<', '>'):
+            filename = self.write_file(make_pcapng(
+                [(1500000000250000, TCP_FRAME),
+                 (1500000001500000, UDP_FRAME)], order=order),
+                name='test.pcapng')
+
+            with pcap_file.PCAPFileReader(filename, parse=True,
+                                          lazy=True) as reader:
+                self.assertTrue(reader.is_pcapng)
+                packets = list(reader)
+                self.check_packets(packets)
+                self.assertAlmostEqual(1500000000.25, packets[0].timestamp)
+                del packets
+
+    def test_read_pcapng_timestamp_resolution(self):
+        filename = self.write_file(make_pcapng(
+            [(1500000000123456789, TCP_FRAME)], tsresol=9),
+            name='test.pcapng')
+
+        with pcap_file.PCAPFileReader(filename) as reader:
+            records = list(reader.read_records())
+            self.assertEqual(1500000000123456789, records[0].timestamp_ns)
+            del records
+
+    def test_bad_files(self):
+        self.assertRaises(exceptions.FileNotFoundException,
+                          pcap_file.PCAPFileReader,
+                          os.path.join(self.tmp_dir, 'missing.pcap'))
+        self.assertRaises(exceptions.PacketParsingException,
+                          pcap_file.PCAPFileReader,
+                          self.write_file(b''))
+
+        reader = pcap_file.PCAPFileReader(self.write_file(b'\x00' * 40))
+        self.assertRaises(exceptions.PacketParsingException, list, reader)
+        reader.close()
+
+        filename = self.write_file(make_pcap(
+            [(1, 0, TCP_FRAME)], linktype=228))
+        with pcap_file.PCAPFileReader(filename, parse=True) as reader:
+            self.assertRaises(exceptions.PacketParsingException,
+                              list, reader)
+
+    def test_parse_sll_link_type(self):
+        sll_frame = (bytes(bytearray([0x00, 0x04, 0x00, 0x01, 0x00, 0x06])) +
+                     TCP_FRAME[6:12] + b'\x00\x00' + TCP_FRAME[12:])
+        filename = self.write_file(make_pcap(
+            [(1, 0, sll_frame)], linktype=pcap_file.LINKTYPE_LINUX_SLL))
+
+        with pcap_file.PCAPFileReader(filename, parse=True) as reader:
+            packets = list(reader)
+            self.assertIsInstance(packets[0].get_layer('ethernet'),
+                                  pcap_packet.PCAPSLL)
+            self.assertEqual(53748, packets[0].get_layer('tcp').dest_port)
+            del packets
+
+    def test_write_read_round_trip(self):
+        filename = os.path.join(self.tmp_dir, 'out.pcap')
+        with pcap_file.PCAPFileWriter(filename) as writer:
+            writer.write(TCP_FRAME, 1500000000.25)
+            writer.write_packet(pcap_packet.PCAPPacket(
+                list(bytearray(UDP_FRAME)), 1500000001.5))
+            self.assertEqual(2, writer.packets_written)
+
+        with pcap_file.PCAPFileReader(filename, parse=True) as reader:
+            packets = list(reader)
+            self.check_packets(packets)
+            self.assertAlmostEqual(1500000000.25, packets[0].timestamp)
+            self.assertAlmostEqual(1500000001.5, packets[1].timestamp)
+            del packets
+
+    def test_write_append_and_snaplen(self):
+        filename = self.write_file(make_pcap(
+            [(1500000000, 123456789, TCP_FRAME)], order='>',
+            magic=pcap_file.PCAP_MAGIC_NSEC))
+
+        with pcap_file.PCAPFileWriter(filename, append=True,
+                                      snaplen=20) as writer:
+            self.assertEqual('>', writer.order)
+            self.assertTrue(writer.nanosecond)
+            writer.write(UDP_FRAME, 1500000001.5)
+
+        with pcap_file.PCAPFileReader(filename) as reader:
+            records = list(reader.read_records())
+            self.assertEqual(2, len(records))
+            self.assertEqual(1500000000123456789, records[0].timestamp_ns)
+            self.assertEqual(1500000001500000000, records[1].timestamp_ns)
+            self.assertEqual(UDP_FRAME, bytes(records[1].data))
+            del records
+
+    def test_write_rotation(self):
+        filename = os.path.join(self.tmp_dir, 'rotate.pcap')
+        record_size = pcap_file.PCAP_RECORD_HEADER_SIZE + len(TCP_FRAME)
+        with pcap_file.PCAPFileWriter(
+                filename, max_size=pcap_file.PCAP_GLOBAL_HEADER_SIZE +
+                2 * record_size, max_files=2) as writer:
+            for i in range(7):
+                writer.write(TCP_FRAME, i)
+
+        self.assertEqual([filename + '.1', filename + '.2', filename + '.3'],
+                         writer.rotated_files)
+        self.assertFalse(os.path.exists(filename + '.1'))
+        counts = []
+        for name in (filename + '.2', filename + '.3', filename):
+            with pcap_file.PCAPFileReader(name) as reader:
+                counts.append(len(list(reader.read_records())))
+        self.assertEqual([2, 2, 1], counts)
+
+    def test_stream_decoder(self):
+        for order in ('<', '>'):
+            data = make_pcap([(1500000000, 250000, TCP_FRAME),
+                              (1500000001, 500000, UDP_FRAME)], order=order)
+            decoder = pcap_file.PCAPStreamDecoder()
+            records = []
+            for i in range(0, len(data), 7):
+                records += decoder.feed(data[i:i + 7])
+
+            self.assertEqual(pcap_file.LINKTYPE_ETHERNET, decoder.linktype)
+            self.assertEqual(0, decoder.pending_bytes)
+            self.assertEqual([TCP_FRAME, UDP_FRAME],
+                             [r.data for r in records])
+            self.assertEqual([1500000000250000000, 1500000001500000000],
+                             [r.timestamp_ns for r in records])
+
+        decoder = pcap_file.PCAPStreamDecoder()
+        self.assertRaises(exceptions.PacketParsingException,
+                          decoder.feed, b'\x00' * 40)
+
+run_unit_test(PCAPFileTest)
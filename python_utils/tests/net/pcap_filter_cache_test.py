@@ -0,0 +1,136 @@
+import threading
+import unittest
+from python_utils.common import exceptions
+from python_utils.net import pcap_filter_cache
+from python_utils.net import pcap_rules
+from python_utils.tests.utils.test_utils import run_unit_test
+
+
+def make_rule(port):
+    return pcap_rules.And([pcap_rules.TCPProto(), pcap_rules.Port(port)])
+
+
+class PCAPFilterCacheTest(unittest.TestCase):
+
+    def test_hits_and_misses(self):
+        cache = pcap_filter_cache.FilterCache()
+        compiled = cache.get(make_rule(80))
+        self.assertEqual('( tcp ) and ( port 80 )', compiled.filter_str)
+        self.assertIs(compiled, cache.get(make_rule(80)))
+
+        # Equivalent trees share their compiled filter
+        self.assertIs(compiled, cache.get(pcap_rules.And(
+            [pcap_rules.Port(80), pcap_rules.And([pcap_rules.TCPProto()])])))
+        self.assertIsNot(compiled, cache.get(make_rule(81)))
+
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(2, cache.misses)
+        self.assertEqual(2, len(cache))
+
+    def test_same_rule_skips_normalize(self):
+        normalized = []
+
+        class CountingRule(pcap_rules.Port):
+            def normalize(self):
+                normalized.append(self)
+                return super(CountingRule, self).normalize()
+
+        cache = pcap_filter_cache.FilterCache(max_size=2)
+        rule = CountingRule(80)
+        compiled = cache.get(rule)
+        for _ in range(3):
+            self.assertIs(compiled, cache.get(rule))
+        self.assertEqual(1, len(normalized))
+        self.assertEqual(3, cache.hits)
+
+        # An equal rule object is normalized, and shares the filter
+        self.assertIs(compiled, cache.get(CountingRule(80)))
+        self.assertEqual(2, len(normalized))
+
+        # Only the most recently looked up rule objects are remembered
+        cache.get(make_rule(1))
+        cache.get(make_rule(2))
+        self.assertEqual('port 80', cache.get(rule).filter_str)
+        self.assertEqual(3, len(normalized))
+
+    def test_changed_rule_is_looked_up_again(self):
+        cache = pcap_filter_cache.FilterCache(max_size=2)
+        rule = pcap_rules.And([pcap_rules.TCPProto()])
+        self.assertEqual('tcp', cache.get(rule).filter_str)
+        rule.rule_set.append(pcap_rules.Port(80))
+        self.assertEqual('( tcp ) and ( port 80 )',
+                         cache.get(rule).filter_str)
+        self.assertEqual(2, cache.misses)
+
+        # A rule whose filter was evicted isn't served from the identity
+        # entry either
+        first = make_rule(1)
+        compiled = cache.get(first)
+        cache.get(make_rule(2))
+        cache.get(make_rule(3))
+        self.assertIsNot(compiled, cache.get(first))
+        self.assertEqual(2, len(cache))
+        self.assertEqual(4, cache.evictions)
+
+    def test_lru_eviction(self):
+        cache = pcap_filter_cache.FilterCache(max_size=2)
+        first = cache.get(make_rule(1))
+        cache.get(make_rule(2))
+        cache.get(make_rule(1))
+        cache.get(make_rule(3))
+
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(2, len(cache))
+        self.assertIs(first, cache.get(make_rule(1)))
+        cache.get(make_rule(2))
+        self.assertEqual(2, cache.evictions)
+
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.hits)
+
+    def test_compiled_forms(self):
+        cache = pcap_filter_cache.FilterCache()
+        compiled = cache.get(make_rule(22))
+
+        self.assertIs(compiled.predicate, compiled.predicate)
+        program = compiled.bpf_program()
+        self.assertIs(program, compiled.bpf_program())
+        self.assertIsNot(program, compiled.bpf_program(snaplen=96))
+
+        # Forms a rule can't be compiled to only fail when asked for
+        compiled = cache.get(pcap_rules.Simple('vlan 100'))
+        self.assertEqual('vlan 100', compiled.filter_str)
+        self.assertRaises(exceptions.ArgMismatchException,
+                          compiled.bpf_program)
+
+    def test_shared_between_threads(self):
+        cache = pcap_filter_cache.FilterCache(max_size=8)
+        results = []
+
+        def lookup():
+            for i in range(200):
+                results.append(cache.get(make_rule(i % 4)))
+        threads = [threading.Thread(target=lookup) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(4, cache.misses)
+        self.assertEqual(796, cache.hits)
+        self.assertEqual(4, len(set(id(r) for r in results)))
+
+    def test_process_wide_cache(self):
+        cache = pcap_filter_cache.get_filter_cache()
+        cache.clear()
+        self.assertEqual('port 5000', pcap_filter_cache.filter_string(
+            pcap_rules.Or([pcap_rules.Port(5000)])))
+        self.assertTrue(pcap_filter_cache.compile_predicate(
+            pcap_rules.Null())(None))
+        self.assertTrue(pcap_filter_cache.compile_bpf(
+            pcap_rules.Null()).matches(b''))
+        self.assertEqual(2, cache.misses)
+        self.assertEqual(1, cache.hits)
+
+run_unit_test(PCAPFilterCacheTest)
@@ -1,6 +1,10 @@
+import select
+import socket
+import time
 import unittest
 from python_utils.common import exceptions
 from python_utils.net import pcap_funcs
+from python_utils.net import pcap_rules
 from python_utils.tests.utils.test_utils import run_unit_test
 
 
@@ -10,4 +14,45 @@ class PCAPFuncsTest(unittest.TestCase):
         self.assertRaises(exceptions.SubprocessFailedException,
                           pcap.start_capture)
 
+    def test_capture_batches(self):
+        pcap = pcap_funcs.Pcap('lo', pcap_rules.And(
+            [pcap_rules.UDPProto(), pcap_rules.Port(39999, dest=True)]))
+        pcap.start_capture()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for i in range(20):
+                sender.sendto(b'pkt', ('127.0.0.1', 39999))
+            packets = pcap.get_packets(max_count=5, timeout=2)
+            self.assertEqual(5, len(packets))
+            packets += pcap.get_packets(timeout=2)
+            self.assertEqual(20, len(packets))
+            self.assertEqual(b'pkt', bytes(packets[0].packet_data)[-3:])
+            self.assertTrue(packets[0].timestamp <= packets[-1].timestamp)
+            self.assertEqual(0, pcap.stats()[1])
+        finally:
+            sender.close()
+            pcap.close()
+
+    def test_async_select_loop(self):
+        pcap = pcap_funcs.AsyncPcap('lo', pcap_rules.And(
+            [pcap_rules.UDPProto(), pcap_rules.Port(39999, dest=True)]))
+        pcap.start_capture()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.assertEqual([], pcap.dispatch())
+            for i in range(10):
+                sender.sendto(b'pkt', ('127.0.0.1', 39999))
+            readable, _, _ = select.select([pcap], [], [], 2)
+            self.assertEqual([pcap], readable)
+            packets = pcap.dispatch(max_count=4)
+            self.assertTrue(0 < len(packets) <= 4)
+            deadline = time.time() + 10
+            while len(packets) < 10 and time.time() < deadline:
+                packets += pcap.get_packets(timeout=1)
+            self.assertEqual(10, len(packets))
+            self.assertEqual(b'pkt', bytes(packets[-1].packet_data)[-3:])
+        finally:
+            sender.close()
+            pcap.close()
+
 run_unit_test(PCAPFuncsTest)
@@ -1,3 +1,4 @@
+import threading
 import unittest
 from python_utils.common import exceptions
 from python_utils.net import pcap_packet
@@ -341,6 +342,18 @@ class PCAPPacketTest(unittest.TestCase):
             5, pmap['ip'].header_length)
         self.assertEqual(
             4, pmap['ip'].version)
+        self.assertEqual(
+            92, pmap['ip'].total_length)
+        self.assertEqual(
+            0x9306, pmap['ip'].id)
+        self.assertEqual(
+            pcap_packet.IP4_FLAG_DONT_FRAGMENT, pmap['ip'].flags)
+        self.assertEqual(
+            0, pmap['ip'].fragment_offset)
+        self.assertEqual(
+            64, pmap['ip'].ttl)
+        self.assertFalse(
+            pmap['ip'].is_fragment())
         self.assertEqual(
             pcap_packet.IP4_PROTOCOL_TCP, pmap['ip'].protocol)
         self.assertEqual(
@@ -710,5 +723,217 @@ class PCAPPacketTest(unittest.TestCase):
         self.assertEqual(
             pcap_packet.PCAPIP4, pmap['ethernet'].next_parse_recommendation)
 
+    def test_full_packet_parsing_bytes_buffer(self):
+        full_eii_packet_data = \
+            [0x52, 0x54, 0x00, 0x12, 0x35, 0x02, 0x08, 0x00,
+             0x27, 0xc6, 0x25, 0x01, 0x08, 0x00, 0x45, 0x10,
+             0x00, 0x5c, 0x93, 0x06, 0x40, 0x00, 0x40, 0x06,
+             0x8f, 0x75, 0x0a, 0x00, 0x02, 0x0f, 0x0a, 0x00,
+             0x02, 0x02, 0x00, 0x16, 0xd1, 0xf4, 0x52, 0x1a,
+             0x58, 0x7c, 0x58, 0x25, 0x2e, 0x9b, 0x50, 0x18,
+             0x9f, 0xb0, 0x18, 0x5f, 0x00, 0x00, 0xDE, 0xAD,
+             0xBE, 0xEF]
+
+        packet = pcap_packet.PCAPPacket(
+            bytes(bytearray(full_eii_packet_data)), '13:00')
+        pmap = packet.parse()
+
+        self.assertEqual(
+            '08:00:27:c6:25:01', pmap['ethernet'].source_mac)
+        self.assertEqual(
+            '10.0.2.15', pmap['ip'].source_ip)
+        self.assertEqual(
+            '10.0.2.2', pmap['ip'].dest_ip)
+        self.assertEqual(
+            53748, pmap['tcp'].dest_port)
+        self.assertEqual(
+            1478831771, pmap['tcp'].ack)
+
+        self.assertEqual(
+            (0, 14), (pmap['ethernet'].layer_offset,
+                      pmap['ethernet'].payload_offset))
+        self.assertEqual(
+            (14, 34), (pmap['ip'].layer_offset, pmap['ip'].payload_offset))
+        self.assertEqual(
+            (34, 54), (pmap['tcp'].layer_offset,
+                       pmap['tcp'].payload_offset))
+        self.assertEqual(
+            58, pmap['tcp'].layer_end)
+
+        payload = packet.get_payload('tcp')
+        self.assertTrue(isinstance(payload, memoryview))
+        self.assertEqual(
+            bytearray([0xDE, 0xAD, 0xBE, 0xEF]), bytearray(payload.tobytes()))
+
+        list_packet = pcap_packet.PCAPPacket(full_eii_packet_data, '13:00')
+        list_packet.parse()
+        self.assertEqual(
+            [0xDE, 0xAD, 0xBE, 0xEF], list_packet.get_payload('tcp'))
+
+    def test_layer_decoding_in_place(self):
+        udp_packet_data = bytearray(
+            [0xFF, 0xFF, 0x00, 0x16, 0x00, 0x1c, 0x00, 0x0c, 0x00, 0x00,
+             0xDE, 0xAD, 0xBE, 0xEF])
+
+        packet = pcap_packet.PCAPUDP()
+        payload_offset = packet.decode_layer(udp_packet_data, 2,
+                                             len(udp_packet_data))
+
+        self.assertEqual(
+            10, payload_offset)
+        self.assertEqual(
+            22, packet.source_port)
+        self.assertEqual(
+            28, packet.dest_port)
+        self.assertEqual(
+            12, packet.length)
+
+
+    def test_full_packet_parsing_lazy(self):
+        full_eii_packet_data = bytearray(
+            [0x52, 0x54, 0x00, 0x12, 0x35, 0x02, 0x08, 0x00,
+             0x27, 0xc6, 0x25, 0x01, 0x08, 0x00, 0x45, 0x10,
+             0x00, 0x5c, 0x93, 0x06, 0x40, 0x00, 0x40, 0x06,
+             0x8f, 0x75, 0x0a, 0x00, 0x02, 0x0f, 0x0a, 0x00,
+             0x02, 0x02, 0x00, 0x16, 0xd1, 0xf4, 0x52, 0x1a,
+             0x58, 0x7c, 0x58, 0x25, 0x2e, 0x9b, 0x50, 0x18,
+             0x9f, 0xb0, 0x18, 0x5f, 0x00, 0x00])
+
+        packet = pcap_packet.PCAPPacket(full_eii_packet_data, '13:00')
+        pmap = packet.parse(lazy=True)
+
+        self.assertEqual(
+            pcap_packet.PCAPTCP, type(pmap['tcp']))
+        self.assertEqual(
+            pcap_packet.IP4_PROTOCOL_TCP, pmap['ip'].protocol)
+        self.assertEqual(
+            (34, 54), (pmap['tcp'].layer_offset,
+                       pmap['tcp'].payload_offset))
+
+        # Nothing but the layer bounds and dispatch fields is decoded yet
+        for layer in pmap.values():
+            self.assertTrue(layer._pending_data is not None)
+
+        self.assertEqual(
+            53748, pmap['tcp'].dest_port)
+        self.assertTrue(pmap['tcp']._pending_data is None)
+        self.assertTrue(pmap['ip']._pending_data is not None)
+        self.assertTrue(pmap['ethernet']._pending_data is not None)
+
+        self.assertEqual(
+            True,
+            pmap['tcp'].is_flag_set(pcap_packet.TCP_PROTOCOL_FLAG_PUSH))
+        self.assertEqual(
+            '10.0.2.15', pmap['ip'].source_ip)
+        self.assertEqual(
+            '52:54:00:12:35:02', pmap['ethernet'].dest_mac)
+        self.assertEqual(
+            pcap_packet.PCAPPacket(full_eii_packet_data, '13:00').parse()[
+                'ethernet'].to_str(),
+            pmap['ethernet'].to_str())
+
+    def test_lazy_decode_across_threads(self):
+        ip_packet_data = bytearray(
+            [0x45, 0x10, 0x00, 0x5c, 0x93, 0x06, 0x40, 0x00,
+             0x40, 0x06, 0x8f, 0x75, 0x0a, 0x00, 0x02, 0x0f,
+             0x0a, 0x00, 0x02, 0x02])
+        decoding = threading.Event()
+        release = threading.Event()
+
+        class SlowIP4(pcap_packet.PCAPIP4):
+            __slots__ = ()
+
+            def _decode_fields(self, packet_data, offset):
+                # Only the first decode stalls
+                if not decoding.is_set():
+                    decoding.set()
+                    release.wait(5)
+                super(SlowIP4, self)._decode_fields(packet_data, offset)
+
+        layer = SlowIP4()
+        layer.locate_layer(ip_packet_data, 0, len(ip_packet_data))
+        ttls = []
+        thread = threading.Thread(target=lambda: ttls.append(layer.ttl))
+        thread.start()
+        try:
+            self.assertTrue(decoding.wait(5))
+            # Read while the first thread's decode is still running
+            self.assertEqual('10.0.2.15', layer.source_ip)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual([64], ttls)
+        self.assertTrue(layer._pending_data is None)
+
+    def test_lazy_decode_failure(self):
+        class BadIP4(pcap_packet.PCAPIP4):
+            __slots__ = ()
+
+            def _decode_fields(self, packet_data, offset):
+                raise ValueError('truncated')
+
+        layer = BadIP4()
+        layer._set_layer_bounds(bytearray(20), 0, 20, 20)
+        self.assertRaises(ValueError, getattr, layer, 'source_ip')
+        # Still undecoded, so the next access fails too
+        self.assertRaises(ValueError, getattr, layer, 'dest_ip')
+
+    def test_lazy_field_defaults(self):
+        packet = pcap_packet.PCAPIP4()
+        self.assertEqual('', packet.source_ip)
+        self.assertRaises(AttributeError, getattr, packet, 'no_such_field')
+
+
+    def test_compact_packet(self):
+        full_eii_packet_data = bytearray(
+            [0x52, 0x54, 0x00, 0x12, 0x35, 0x02, 0x08, 0x00,
+             0x27, 0xc6, 0x25, 0x01, 0x08, 0x00, 0x45, 0x10,
+             0x00, 0x5c, 0x93, 0x06, 0x40, 0x00, 0x40, 0x06,
+             0x8f, 0x75, 0x0a, 0x00, 0x02, 0x0f, 0x0a, 0x00,
+             0x02, 0x02, 0x00, 0x16, 0xd1, 0xf4, 0x52, 0x1a,
+             0x58, 0x7c, 0x58, 0x25, 0x2e, 0x9b, 0x50, 0x18,
+             0x9f, 0xb0, 0x18, 0x5f, 0x00, 0x00])
+
+        packet = pcap_packet.PCAPPacket(full_eii_packet_data, '13:00')
+        packet.parse()
+
+        self.assertFalse(hasattr(packet, '__dict__'))
+        for layer in packet.layer_data.values():
+            self.assertFalse(hasattr(layer, '__dict__'))
+
+        # No error information is allocated for a clean parse
+        self.assertTrue(packet._parse_errors is None)
+        self.assertEqual(
+            ['PCAPEthernet', 'PCAPIP4', 'PCAPTCP'],
+            packet.extra_data['parse_classes'])
+        self.assertEqual(
+            [], packet.extra_data['parse_errors.tcp'])
+
+        # Iterating doesn't build (and keep) the layer map
+        packet.parse_layers()
+        self.assertEqual(['ethernet', 'ip', 'tcp'], sorted(packet))
+        self.assertTrue(packet._layer_data is None)
+
+        # parse returns the kept map, so writes through it aren't lost
+        packet.parse()['extra'] = None
+        self.assertTrue('extra' in packet.layer_data)
+
+        # The maps are kept once built, so writes to them aren't lost
+        packet.layer_data['extra'] = None
+        packet.extra_data['note'] = ['x']
+        self.assertTrue('extra' in packet.layer_data)
+        self.assertEqual(['x'], packet.extra_data['note'])
+        self.assertEqual(None, packet.get_layer('extra'))
+        packet.parse()
+        self.assertFalse('extra' in packet.layer_data)
+        self.assertFalse('note' in packet.extra_data)
+
+        self.assertTrue('tcp' in packet)
+        self.assertFalse('udp' in packet)
+        self.assertEqual(
+            53748, packet.get_layer('tcp').dest_port)
+        self.assertEqual(
+            None, packet.get_layer('udp'))
+
 
 run_unit_test(PCAPPacketTest)
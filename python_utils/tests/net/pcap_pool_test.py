@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import unittest
+from python_utils.net import pcap_file
+from python_utils.net import pcap_packet
+from python_utils.net import pcap_pool
+from python_utils.tests.utils.test_utils import run_unit_test
+
+TCP_FRAME = bytes(bytearray(
+    [0x52, 0x54, 0x00, 0x12, 0x35, 0x02, 0x08, 0x00,
+     0x27, 0xc6, 0x25, 0x01, 0x08, 0x00, 0x45, 0x10,
+     0x00, 0x5c, 0x93, 0x06, 0x40, 0x00, 0x40, 0x06,
+     0x8f, 0x75, 0x0a, 0x00, 0x02, 0x0f, 0x0a, 0x00,
+     0x02, 0x02, 0x00, 0x16, 0xd1, 0xf4, 0x52, 0x1a,
+     0x58, 0x7c, 0x58, 0x25, 0x2e, 0x9b, 0x50, 0x12,
+     0x9f, 0xb0, 0x18, 0x5f, 0x00, 0x00]))
+
+UDP_FRAME = bytes(bytearray(
+    [0x52, 0x54, 0x00, 0x12, 0x35, 0x02, 0x08, 0x00,
+     0x27, 0xc6, 0x25, 0x01, 0x08, 0x00, 0x45, 0x00,
+     0x00, 0x20, 0x00, 0x01, 0x00, 0x00, 0x40, 0x11,
+     0x00, 0x00, 0xc0, 0xa8, 0x01, 0x0a, 0xc0, 0xa8,
+     0x01, 0x01, 0x00, 0x35, 0x04, 0xd2, 0x00, 0x0c,
+     0x00, 0x00, 0xDE, 0xAD, 0xBE, 0xEF]))
+
+FRAMES = [TCP_FRAME, UDP_FRAME, UDP_FRAME] * 20
+
+# The workers' results can't be unpickled while this module is being
+# imported (which is when run_unit_test runs the tests on import), so
+# only decode across processes when run directly
+WORKER_PROCESSES = 2 if __name__ == '__main__' else 0
+
+
+class PCAPPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pool = pcap_pool.DecodePool(processes=WORKER_PROCESSES)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def expected_summaries(self):
+        layers = {TCP_FRAME: ['ethernet', 'ip', 'tcp'],
+                  UDP_FRAME: ['ethernet', 'ip', 'udp']}
+        return [(float(i), len(frame), layers[frame])
+                for i, frame in enumerate(FRAMES)]
+
+    def test_map_file_shards_in_order(self):
+        filename = os.path.join(self.tmp_dir, 'test.pcap')
+        with pcap_file.PCAPFileWriter(filename) as writer:
+            for i, frame in enumerate(FRAMES):
+                writer.write(frame, timestamp=i)
+
+        shards = list(pcap_pool.file_shards(filename, shard_bytes=500))
+        self.assertTrue(len(shards) > 5)
+        self.assertTrue(all(isinstance(s, pcap_pool.FileShard)
+                            for s in shards))
+        self.assertEqual(self.expected_summaries(),
+                         list(self.pool.map(shards, pcap_pool.packet_layers)))
+
+    def test_map_buffer_shards(self):
+        buffer_data = b''.join(FRAMES)
+        lengths = [len(frame) for frame in FRAMES]
+        offsets = [sum(lengths[:i]) for i in range(len(lengths))]
+        shards = pcap_pool.buffer_shards(
+            buffer_data, offsets, lengths,
+            timestamps=[float(i) for i in range(len(FRAMES))],
+            batch_size=7)
+
+        self.assertEqual(self.expected_summaries(),
+                         list(self.pool.map(shards, pcap_pool.packet_layers)))
+
+    def test_aggregate_packet_shards(self):
+        packets = [pcap_packet.PCAPPacket(frame, float(i))
+                   for i, frame in enumerate(FRAMES)]
+        shards = list(pcap_pool.packet_shards(packets, batch_size=8))
+        self.assertEqual(8, len(shards))
+
+        self.assertEqual({'ethernet': 60, 'ip': 60, 'tcp': 20, 'udp': 40},
+                         self.pool.aggregate(shards, pcap_pool.count_layers,
+                                             pcap_pool.merge_counts))
+        initial = {'tcp': 1}
+        self.assertEqual(
+            {'ethernet': 60, 'ip': 60, 'tcp': 21, 'udp': 40},
+            self.pool.aggregate(shards, pcap_pool.count_layers,
+                                pcap_pool.merge_counts, initial))
+        self.assertEqual({'tcp': 1}, initial)
+        self.assertEqual(None,
+                         self.pool.aggregate([], pcap_pool.count_layers,
+                                             pcap_pool.merge_counts))
+
+    def test_in_process_pool(self):
+        pool = pcap_pool.DecodePool(processes=0)
+        shards = pcap_pool.buffer_shards(
+            b''.join(FRAMES[:3]), [0, 54, 100], [54, 46, 46])
+        self.assertEqual(
+            [(0.0, 54, ['ethernet', 'ip', 'tcp']),
+             (0.0, 46, ['ethernet', 'ip', 'udp']),
+             (0.0, 46, ['ethernet', 'ip', 'udp'])],
+            list(pool.map(shards, pcap_pool.packet_layers)))
+        self.assertEqual(None, pool.pool)
+        pool.close()
+
+    def test_shard_packets_unparsed(self):
+        shard = next(pcap_pool.buffer_shards(TCP_FRAME, [0], [20]))
+        packets = pcap_pool.shard_packets(shard, parse=False)
+        self.assertEqual(1, len(packets))
+        self.assertEqual(TCP_FRAME[:20], bytes(packets[0].packet_data))
+        self.assertFalse('tcp' in packets[0])
+
+run_unit_test(PCAPPoolTest)
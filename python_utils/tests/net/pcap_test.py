@@ -1,7 +1,28 @@
 import unittest
+from python_utils.common import exceptions
+from python_utils.net import pcap_packet
 from python_utils.net import pcap_rules
 from python_utils.tests.utils.test_utils import run_unit_test
 
+# 10.0.2.15:22 -> 10.0.2.2:53748, SYN+ACK
+TCP_FRAME = \
+    [0x52, 0x54, 0x00, 0x12, 0x35, 0x02, 0x08, 0x00,
+     0x27, 0xc6, 0x25, 0x01, 0x08, 0x00, 0x45, 0x10,
+     0x00, 0x5c, 0x93, 0x06, 0x40, 0x00, 0x40, 0x06,
+     0x8f, 0x75, 0x0a, 0x00, 0x02, 0x0f, 0x0a, 0x00,
+     0x02, 0x02, 0x00, 0x16, 0xd1, 0xf4, 0x52, 0x1a,
+     0x58, 0x7c, 0x58, 0x25, 0x2e, 0x9b, 0x50, 0x12,
+     0x9f, 0xb0, 0x18, 0x5f, 0x00, 0x00]
+
+# 192.168.1.10:53 -> 224.0.0.251:1234, to a multicast MAC
+UDP_FRAME = \
+    [0x01, 0x00, 0x5e, 0x00, 0x00, 0xfb, 0x08, 0x00,
+     0x27, 0xc6, 0x25, 0x01, 0x08, 0x00, 0x45, 0x00,
+     0x00, 0x20, 0x00, 0x01, 0x00, 0x00, 0x40, 0x11,
+     0x00, 0x00, 0xc0, 0xa8, 0x01, 0x0a, 0xe0, 0x00,
+     0x00, 0xfb, 0x00, 0x35, 0x04, 0xd2, 0x00, 0x0c,
+     0x00, 0x00, 0xDE, 0xAD, 0xBE, 0xEF]
+
 
 class PCAPTest(unittest.TestCase):
     def test_host_rules(self):
@@ -191,4 +212,142 @@ class PCAPTest(unittest.TestCase):
 
         self.assertEqual(expected_str, complex_rule.to_str())
 
+    def test_evaluate_type_rules(self):
+        tcp = pcap_packet.PCAPPacket(TCP_FRAME, 0)
+        tcp.parse()
+
+        self.assertTrue(pcap_rules.Host('10.0.2.15').matches(tcp))
+        self.assertTrue(pcap_rules.Host('10.0.2.15',
+                                        source=True).matches(tcp))
+        self.assertFalse(pcap_rules.Host('10.0.2.15',
+                                         dest=True).matches(tcp))
+        self.assertFalse(pcap_rules.Host('10.0.2.15', source=True,
+                                         dest=True).matches(tcp))
+        self.assertTrue(pcap_rules.Host('52:54:00:12:35:02', 'ether',
+                                        dest=True).matches(tcp))
+
+        self.assertTrue(pcap_rules.Port(22).matches(tcp))
+        self.assertTrue(pcap_rules.Port(22, 'tcp').matches(tcp))
+        self.assertFalse(pcap_rules.Port(22, 'udp').matches(tcp))
+        self.assertTrue(pcap_rules.PortRange(53000, 54000,
+                                             dest=True).matches(tcp))
+        self.assertFalse(pcap_rules.PortRange(1, 21).matches(tcp))
+
+        self.assertTrue(pcap_rules.Net('10.0.2.0/24').matches(tcp))
+        self.assertTrue(pcap_rules.Net('10.0').matches(tcp))
+        self.assertTrue(pcap_rules.Net('10.0.0.0',
+                                       mask='255.255.0.0').matches(tcp))
+        self.assertFalse(pcap_rules.Net('10.1.0.0/16').matches(tcp))
+
+        self.assertRaises(exceptions.ArgMismatchException,
+                          pcap_rules.Port(80, proto='ether').compile)
+
+    def test_evaluate_proto_and_cast_rules(self):
+        tcp = pcap_packet.PCAPPacket(TCP_FRAME, 0)
+        tcp.parse()
+        udp = pcap_packet.PCAPPacket(UDP_FRAME, 0)
+        udp.parse()
+
+        self.assertTrue(pcap_rules.IPProto('tcp').matches(tcp))
+        self.assertFalse(pcap_rules.IPProto('udp').matches(tcp))
+        self.assertTrue(pcap_rules.IPProto('17').matches(udp))
+        self.assertTrue(pcap_rules.EtherProto('ip').matches(tcp))
+        self.assertFalse(pcap_rules.EtherProto('arp').matches(tcp))
+        self.assertTrue(pcap_rules.TCPProto().matches(tcp))
+        self.assertFalse(pcap_rules.UDPProto().matches(tcp))
+
+        self.assertTrue(pcap_rules.Multicast().matches(udp))
+        self.assertTrue(pcap_rules.Multicast('ip').matches(udp))
+        self.assertFalse(pcap_rules.Multicast('ip').matches(tcp))
+        self.assertFalse(pcap_rules.Broadcast().matches(udp))
+
+    def test_evaluate_comparison_rules(self):
+        tcp = pcap_packet.PCAPPacket(TCP_FRAME, 0)
+        tcp.parse()
+
+        self.assertTrue(pcap_rules.Equal('len', '54').matches(tcp))
+        self.assertTrue(pcap_rules.LessThan('len', 100).matches(tcp))
+        self.assertTrue(pcap_rules.Equal('ip[0] & 0xf', '5').matches(tcp))
+        self.assertTrue(pcap_rules.Equal('tcp[2:2]', '53748').matches(tcp))
+        self.assertTrue(pcap_rules.NotEqual(
+            'tcp[tcpflags] & (tcp-syn|tcp-ack)', '0').matches(tcp))
+        self.assertTrue(pcap_rules.Equal('ether[0] & 1', '0').matches(tcp))
+        self.assertTrue(pcap_rules.GreaterThan(
+            'ip[2:2] - ((ip[0] & 0xf) << 2)', '20').matches(tcp))
+        # Missing layers and reads past the end never match
+        self.assertFalse(pcap_rules.Equal('udp[0]', '0').matches(tcp))
+        self.assertFalse(pcap_rules.NotEqual('tcp[100:4]',
+                                             '0').matches(tcp))
+
+        self.assertRaises(exceptions.ArgMismatchException,
+                          pcap_rules.Equal('tcp[0:3]', '0').compile)
+        self.assertRaises(exceptions.ArgMismatchException,
+                          pcap_rules.Equal('len +', '0').compile)
+
+    def test_evaluate_boolean_rules(self):
+        frames = [TCP_FRAME, UDP_FRAME, TCP_FRAME]
+        rule = pcap_rules.And([pcap_rules.Net('10.0.0.0/8'),
+                               pcap_rules.Not(pcap_rules.UDPProto())])
+        self.assertEqual(2, len(list(rule.filter(frames))))
+
+        rule = pcap_rules.Or([pcap_rules.Port(53), pcap_rules.Port(22)])
+        self.assertEqual(3, len(list(rule.filter(frames))))
+        self.assertTrue(pcap_rules.Null().matches(bytearray(UDP_FRAME)))
+        self.assertRaises(exceptions.ArgMismatchException,
+                          pcap_rules.Simple('foo').compile)
+
+    def test_normalize_flatten_and_dedupe(self):
+        rule = pcap_rules.And([
+            pcap_rules.And([pcap_rules.Port(22), pcap_rules.Host('foo')]),
+            pcap_rules.Null(),
+            pcap_rules.Or([pcap_rules.Host('foo')]),
+            pcap_rules.Not(pcap_rules.Not(pcap_rules.TCPProto()))])
+
+        self.assertEqual('( tcp ) and ( host foo ) and ( port 22 )',
+                         rule.normalize().to_str())
+        self.assertEqual('port 22', pcap_rules.Or(
+            [pcap_rules.Port(22), pcap_rules.Port(22)]).normalize().to_str())
+        self.assertEqual('not ( tcp )', pcap_rules.Not(pcap_rules.Not(
+            pcap_rules.Not(pcap_rules.TCPProto()))).normalize().to_str())
+
+    def test_normalize_null_folding(self):
+        self.assertIsInstance(pcap_rules.And([]).normalize(), pcap_rules.Null)
+        self.assertIsInstance(
+            pcap_rules.And([pcap_rules.Null(), pcap_rules.Null()]).normalize(),
+            pcap_rules.Null)
+        or_rule = pcap_rules.Or([pcap_rules.Port(80), pcap_rules.Null()])
+        self.assertIsInstance(or_rule.normalize(), pcap_rules.Null)
+
+    def test_normalize_canonical_order(self):
+        rule1 = pcap_rules.And([
+            pcap_rules.GreaterThan('len', '100'),
+            pcap_rules.Or([pcap_rules.Port(80), pcap_rules.Port(443)]),
+            pcap_rules.EtherProto('ip')])
+        rule2 = pcap_rules.And([
+            pcap_rules.EtherProto('ip'),
+            pcap_rules.And([
+                pcap_rules.Or([pcap_rules.Port(443), pcap_rules.Port(80)]),
+                pcap_rules.GreaterThan('len', '100')])])
+
+        self.assertEqual(rule1.normalize().to_str(),
+                         rule2.normalize().to_str())
+        self.assertEqual('( ether proto ip ) and '
+                         '( ( port 443 ) or ( port 80 ) ) and ( len > 100 )',
+                         rule1.normalize().to_str())
+
+    def test_structural_equality(self):
+        rule1 = pcap_rules.And([pcap_rules.Host('foo', source=True),
+                                pcap_rules.Not(pcap_rules.Port(80))])
+        rule2 = pcap_rules.And([pcap_rules.Host('foo', source=True),
+                                pcap_rules.Not(pcap_rules.Port(80))])
+
+        self.assertEqual(rule1, rule2)
+        self.assertEqual(hash(rule1), hash(rule2))
+        self.assertEqual(1, len({rule1, rule2}))
+        self.assertNotEqual(rule1, pcap_rules.Or(rule2.rule_set))
+        self.assertNotEqual(pcap_rules.Host('foo'),
+                            pcap_rules.Host('foo', dest=True))
+        self.assertNotEqual(pcap_rules.TCPProto(), pcap_rules.UDPProto())
+        self.assertNotEqual(pcap_rules.Port(80), 'port 80')
+
 run_unit_test(PCAPTest)
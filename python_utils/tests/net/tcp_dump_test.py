@@ -1,4 +1,9 @@
+import struct
+import sys
+import tempfile
 import unittest
+from python_utils.net import packet_ring
+from python_utils.net import pcap_file
 from python_utils.net import pcap_rules
 from python_utils.net.tcp_dump import *
 from python_utils.net.tcp_sender import TCPSender
@@ -31,6 +36,33 @@ def send_packet():
                     dest_port=6055, source_port=6015)
 
 
+# Stands in for tcpdump: reports it is listening on stderr, split across
+# writes (so across reads) and after a delay, then captures nothing
+STUB_LISTEN_DELAY = 0.5
+STUB_TCPDUMP = (
+    "import sys, time\n"
+    "sys.stderr.write('tcpdump: verbose output suppressed\\nlisten')\n"
+    "sys.stderr.flush()\n"
+    "time.sleep(" + str(STUB_LISTEN_DELAY) + ")\n"
+    "sys.stderr.write('ing on lo, link-type EN10MB\\n')\n"
+    "sys.stderr.flush()\n"
+    "time.sleep(30)\n")
+
+
+class StubTCPDumpCLI(LinuxCLI):
+    """
+    Runs a python script in place of tcpdump (and without sudo).
+    """
+    def __init__(self, script):
+        super(StubTCPDumpCLI, self).__init__(priv=False)
+        self.script = script
+
+    def cmd(self, cmd_list, **kwargs):
+        return super(StubTCPDumpCLI, self).cmd(
+            [[sys.executable, '-c', self.script] if cmd[0] == 'tcpdump'
+             else cmd for cmd in cmd_list], **kwargs)
+
+
 class TCPDumpTest(unittest.TestCase):
     def setUp(self):
         time.sleep(2)
@@ -51,6 +83,9 @@ class TCPDumpTest(unittest.TestCase):
         """ :type: PCAPPacket"""
         self.assertTrue(p3 is not None)
 
+        with pcap_file.PCAPFileReader('tcp.out') as reader:
+            self.assertEqual(3, len(list(reader.read_records())))
+
     def test_read_packet_buffered(self):
         tcpd = TCPDump()
 
@@ -253,6 +288,174 @@ class TCPDumpTest(unittest.TestCase):
         finally:
             tcpd.stop_capture()
 
+    def test_start_capture_waits_for_listening(self):
+        tcpd = TCPDump()
+        tcpd.start_capture(cli=StubTCPDumpCLI(STUB_TCPDUMP), interface='lo')
+        try:
+            # Only returns once the whole line is seen, and without
+            # waiting any longer after it
+            self.assertTrue(tcpd.startup_latency >= STUB_LISTEN_DELAY)
+            self.assertTrue(tcpd.startup_latency < STUB_LISTEN_DELAY + 1.0)
+            self.assertEqual([tcpd.startup_latency], tcpd.startup_latencies)
+            self.assertTrue(tcpd.tcpdump_ready.is_set())
+            self.assertFalse(tcpd.tcpdump_error.is_set())
+        finally:
+            tcpd.stop_capture()
+        self.assertTrue(tcpd.tcpdump_finished.is_set())
+
+    def test_timestamp_to_epoch(self):
+        now = time.mktime((2016, 1, 2, 0, 0, 10, 0, 0, -1))
+        self.assertAlmostEqual(now - 5.5,
+                               tcpdump_timestamp_to_epoch('00:00:04.5', now))
+        self.assertAlmostEqual(now - 10.5,
+                               tcpdump_timestamp_to_epoch('23:59:59.5', now))
+        self.assertEqual(now, tcpdump_timestamp_to_epoch('bad', now))
+
+    def test_read_pcap_stream(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'stream.pcap')
+            with pcap_file.PCAPFileWriter(
+                    filename, linktype=pcap_file.LINKTYPE_LINUX_SLL,
+                    snaplen=1500) as writer:
+                for i in range(3):
+                    writer.write(bytearray([i] * 60), 1500000000 + i)
+            with open(filename, 'rb') as f:
+                data = f.read()
+        finally:
+            LinuxCLI().rm(tmp_dir)
+
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, data[:50])
+        os.write(write_fd, data[50:])
+        os.close(write_fd)
+
+        packets = []
+        headers = []
+        with os.fdopen(read_fd, 'rb') as stream:
+            TCPDump.read_pcap_stream(
+                stream, threading.Event(),
+                lambda data, timestamp, epoch, orig_len: packets.append(
+                    (data, timestamp)),
+                header_callback=lambda decoder: headers.append(
+                    (decoder.linktype, decoder.snaplen, len(packets))))
+        # The header is reported once, before any packet is delivered
+        self.assertEqual([(pcap_file.LINKTYPE_LINUX_SLL, 1500, 0)], headers)
+        self.assertEqual([1500000000, 1500000001, 1500000002],
+                         [p[1] for p in packets])
+        self.assertEqual(bytearray([2] * 60), bytearray(packets[2][0]))
+
+    def test_read_pcap_stream_stop(self):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, struct.pack('=IHHiIII', pcap_file.PCAP_MAGIC_USEC,
+                                       2, 4, 0, 0, 65535,
+                                       pcap_file.LINKTYPE_ETHERNET))
+        tcp_stop = threading.Event()
+        tcp_stop.set()
+
+        # The stream stays readable (and open), but the stop is seen
+        packets = []
+        try:
+            with os.fdopen(read_fd, 'rb') as stream:
+                decoder = TCPDump.read_pcap_stream(
+                    stream, tcp_stop,
+                    lambda data, timestamp, epoch, orig_len: packets.append(
+                        data))
+        finally:
+            os.close(write_fd)
+        self.assertEqual([], packets)
+        self.assertEqual(None, decoder.linktype)
+
+    def test_read_hex_stream(self):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd,
+                 '10:00:00.500000 IP 127.0.0.1 > 127.0.0.1: ICMP\n'
+                 '\t0x0000:  0001 0203 0405 0607 0809 0a0b 0c0d 0e0f\n'
+                 '\t0x0010:  1011\n'
+                 '10:00:01.000000 IP 127.0.0.1 > 127.0.0.1: ICMP\n'
+                 '\t0x0000:  ffee')
+        os.close(write_fd)
+
+        packets = []
+        with os.fdopen(read_fd, 'rb') as stream:
+            TCPDump.read_hex_stream(
+                stream, threading.Event(),
+                lambda data, timestamp, epoch: packets.append(
+                    (data, timestamp)))
+        self.assertEqual(2, len(packets))
+        self.assertEqual(bytearray(range(0, 18)), packets[0][0])
+        self.assertEqual('10:00:00.500000', packets[0][1])
+        self.assertEqual(bytearray([0xff, 0xee]), packets[1][0])
+
+    def test_read_hex_stream_stop(self):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd,
+                 '10:00:00.500000 IP 127.0.0.1 > 127.0.0.1: ICMP\n'
+                 '\t0x0000:  0001 0203\n')
+        tcp_stop = threading.Event()
+        tcp_stop.set()
+
+        # The stream stays readable (and open), but the stop is seen
+        packets = []
+        try:
+            with os.fdopen(read_fd, 'rb') as stream:
+                TCPDump.read_hex_stream(
+                    stream, tcp_stop,
+                    lambda data, timestamp, epoch: packets.append(data))
+        finally:
+            os.close(write_fd)
+        self.assertEqual([], packets)
+
+    def test_wait_for_packets_batches(self):
+        tcpd = TCPDump()
+        tcpd.data_queue = multiprocessing.Queue()
+        tcpd.data_queue.put([(bytearray([i] * 20), i) for i in range(3)])
+        tcpd.data_queue.put([(bytearray([3] * 20), 3)])
+
+        ret = tcpd.wait_for_packets(count=2, timeout=3)
+        self.assertEqual([0, 1], [p.timestamp for p in ret])
+        self.assertRaises(exceptions.SubprocessTimeoutException,
+                          tcpd.wait_for_packets, count=3, timeout=0.5)
+        ret = tcpd.wait_for_packets(count=0)
+        self.assertEqual([2, 3], [p.timestamp for p in ret])
+        self.assertEqual(bytearray([3] * 20), ret[1].packet_data)
+
+    def test_wait_for_packets_ring(self):
+        tcpd = TCPDump()
+        tcpd.data_queue = multiprocessing.Queue()
+        tcpd.packet_ring = packet_ring.PacketRing(4096)
+        for i in range(3):
+            tcpd.packet_ring.write(bytearray([i] * 20), 1500000000 + i)
+
+        ret = tcpd.wait_for_packets(count=2, timeout=3)
+        self.assertEqual([1500000000, 1500000001],
+                         [p.timestamp for p in ret])
+        self.assertRaises(exceptions.SubprocessTimeoutException,
+                          tcpd.wait_for_packets, count=2, timeout=0.5)
+        ret = tcpd.wait_for_packets(count=0)
+        self.assertEqual(1, len(ret))
+        self.assertEqual(bytearray([2] * 20), bytearray(ret[0].packet_data))
+
+    def test_iter_packets(self):
+        tcpd = TCPDump()
+        tcpd.data_queue = multiprocessing.Queue()
+        tcpd.tcpdump_finished = multiprocessing.Event()
+        tcpd.data_queue.put([(bytearray([i] * 20), i) for i in range(2)])
+
+        def send_later():
+            time.sleep(0.3)
+            tcpd.data_queue.put([(bytearray([2] * 20), 2)])
+
+        t = threading.Thread(target=send_later)
+        t.start()
+        self.assertEqual([0, 1, 2],
+                         [p.timestamp for p in tcpd.iter_packets(timeout=1)])
+        t.join()
+
+        tcpd.data_queue.put([(bytearray([3] * 20), 3)])
+        tcpd.tcpdump_finished.set()
+        self.assertEqual([3], [p.timestamp for p in tcpd.iter_packets()])
+
     def tearDown(self):
         time.sleep(2)
         LinuxCLI().rm('tcp.callback.out')
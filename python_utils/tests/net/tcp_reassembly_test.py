@@ -0,0 +1,115 @@
+import unittest
+from python_utils.net import pcap_packet
+from python_utils.net import tcp_reassembly
+from python_utils.tests.utils import packet_builder
+from python_utils.tests.utils.test_utils import run_unit_test
+
+SYN = pcap_packet.TCP_PROTOCOL_FLAG_SYN
+ACK = pcap_packet.TCP_PROTOCOL_FLAG_ACK
+FIN = pcap_packet.TCP_PROTOCOL_FLAG_FINAL
+RST = pcap_packet.TCP_PROTOCOL_FLAG_RESET
+
+CLIENT = ('10.0.0.1', 40000)
+SERVER = ('10.0.0.2', 80)
+ISN = 1000
+
+
+def make_segment(seq, payload=b'', flags=ACK, source=CLIENT, dest=SERVER,
+                 padding=b''):
+    tcp = packet_builder.tcp_segment(source[1], dest[1], flags, seq,
+                                     payload)
+    return packet_builder.make_packet(packet_builder.ip4_frame(
+        source[0], dest[0], pcap_packet.IP4_PROTOCOL_TCP, tcp,
+        padding=padding))
+
+
+def stream_data(items):
+    return b''.join(data for _, data in items)
+
+
+class TCPReassemblyTest(unittest.TestCase):
+
+    def test_in_order_and_out_of_order(self):
+        delivered = []
+        reassembler = tcp_reassembly.TCPReassembler(
+            callback=lambda key, data: delivered.append(data))
+        packets = [make_segment(ISN, flags=SYN),
+                   make_segment(ISN + 1, b'hello '),
+                   make_segment(ISN + 13, b'!!'),
+                   make_segment(ISN + 7, b'world!'),
+                   make_segment(ISN + 15, flags=FIN | ACK),
+                   make_segment(5000, b'reply', source=SERVER,
+                                dest=CLIENT)]
+
+        items = list(reassembler.reassemble(packets))
+
+        self.assertEqual([b'hello ', b'world!', b'!!', b'reply'],
+                         [data for _, data in items])
+        self.assertEqual(delivered, [data for _, data in items])
+        self.assertEqual((CLIENT[0], CLIENT[1]), items[0][0][1:3])
+        stream = reassembler.get(CLIENT[0], CLIENT[1], SERVER[0],
+                                 SERVER[1])
+        self.assertTrue(stream.finished)
+        self.assertEqual(14, stream.delivered_bytes)
+        self.assertEqual(0, stream.buffered)
+        self.assertEqual(2, len(reassembler))
+
+    def test_retransmission_and_overlap(self):
+        reassembler = tcp_reassembly.TCPReassembler()
+        packets = [make_segment(ISN, flags=SYN),
+                   make_segment(ISN + 1, b'abcd'),
+                   make_segment(ISN + 1, b'abcd'),
+                   make_segment(ISN + 9, b'ijkl'),
+                   make_segment(ISN + 7, b'ghij'),
+                   make_segment(ISN + 3, b'cdef')]
+
+        self.assertEqual(b'abcdefghijkl',
+                         stream_data(reassembler.reassemble(packets)))
+        stream = reassembler.get(CLIENT[0], CLIENT[1], SERVER[0],
+                                 SERVER[1])
+        self.assertEqual(4 + 2 + 2, stream.retransmitted_bytes)
+        self.assertEqual(0, stream.gaps)
+
+    def test_bounded_buffer_skips_holes(self):
+        reassembler = tcp_reassembly.TCPReassembler(max_buffer=8)
+        packets = [make_segment(ISN, flags=SYN),
+                   make_segment(ISN + 5, b'fghij'),
+                   make_segment(ISN + 10, b'klmno')]
+
+        self.assertEqual(b'fghijklmno',
+                         stream_data(reassembler.reassemble(packets)))
+        stream = reassembler.get(CLIENT[0], CLIENT[1], SERVER[0],
+                                 SERVER[1])
+        self.assertEqual(1, stream.gaps)
+        self.assertEqual(4, stream.skipped_bytes)
+
+        reassembler.add(make_segment(ISN + 20, b'uv'))
+        self.assertEqual(2, stream.buffered)
+        self.assertEqual(b'uv', stream_data(reassembler.flush()))
+        self.assertEqual(9, stream.skipped_bytes)
+
+    def test_padding_wraparound_and_reset(self):
+        reassembler = tcp_reassembly.TCPReassembler(max_streams=1)
+        start = 0xfffffffe
+        packets = [make_segment(start, b'ab', padding=b'\x00' * 4),
+                   make_segment(0, b'cd')]
+        self.assertEqual(b'abcd',
+                         stream_data(reassembler.reassemble(packets)))
+
+        stream = reassembler.get(CLIENT[0], CLIENT[1], SERVER[0],
+                                 SERVER[1])
+        reassembler.add(make_segment(4, b'x', flags=RST))
+        self.assertTrue(stream.reset)
+        self.assertEqual([], reassembler.add(make_segment(5, b'y')))
+        # A new connection on the same ports
+        reassembler.add(make_segment(ISN, flags=SYN))
+        self.assertFalse(stream.finished)
+        self.assertEqual(b'z', stream_data(reassembler.add(
+            make_segment(ISN + 1, b'z'))))
+
+        reassembler.add(make_segment(7, b'r', source=SERVER, dest=CLIENT))
+        self.assertEqual(1, reassembler.evictions)
+        self.assertEqual(None, reassembler.get(CLIENT[0], CLIENT[1],
+                                               SERVER[0], SERVER[1]))
+
+run_unit_test(TCPReassemblyTest)
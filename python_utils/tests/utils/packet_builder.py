@@ -0,0 +1,60 @@
+import socket
+import struct
+
+from python_utils.net import pcap_packet
+
+ETHERNET_HEADER = b'\x02' * 12 + b'\x08\x00'
+
+
+def tcp_segment(source_port, dest_port, flags, seq=0, payload=b''):
+    """
+    :type source_port: int
+    :type dest_port: int
+    :type flags: int
+    :type seq: int
+    :type payload: bytes
+    :return: bytes TCP header (no options) and payload
+    """
+    return struct.pack('!HHIIBBHHH', source_port, dest_port, seq, 0, 0x50,
+                       flags, 1024, 0, 0) + payload
+
+
+def udp_datagram(source_port, dest_port, payload=b''):
+    """
+    :type source_port: int
+    :type dest_port: int
+    :type payload: bytes
+    :return: bytes UDP header and payload
+    """
+    return struct.pack('!HHHH', source_port, dest_port, 8 + len(payload),
+                       0) + payload
+
+
+def ip4_frame(source_ip, dest_ip, protocol, data, ident=1,
+              flags_fragment=0, padding=b''):
+    """
+    :type source_ip: str
+    :type dest_ip: str
+    :type protocol: int
+    :param data: bytes IP payload (the transport header onward)
+    :type ident: int
+    :param flags_fragment: int Flags (top 3 bits) and fragment offset (in
+    8 byte units) word of the IP header
+    :param padding: bytes Appended to the frame, after the IP datagram
+    :return: bytes Ethernet frame
+    """
+    ip = struct.pack('!BBHHHBBH', 0x45, 0, 20 + len(data), ident,
+                     flags_fragment, 64, protocol, 0) + \
+        socket.inet_aton(source_ip) + socket.inet_aton(dest_ip)
+    return ETHERNET_HEADER + ip + data + padding
+
+
+def make_packet(frame, timestamp=0.0):
+    """
+    :type frame: bytes
+    :type timestamp: float
+    :return: pcap_packet.PCAPPacket The frame, parsed
+    """
+    packet = pcap_packet.PCAPPacket(frame, timestamp)
+    packet.parse()
+    return packet
@@ -3,7 +3,8 @@ from distutils.core import setup, Extension
 module1 = Extension('pytcpcap',
                     sources=['src/pytcpcap/pytcpcapmodule.cpp'],
                     libraries=['pcap'],
-                    extra_compile_args=['-std=c++11'])
+                    extra_compile_args=['-std=c++11', '-pthread'],
+                    extra_link_args=['-pthread'])
 
 setup(name='Python Utils',
       version='1.0',
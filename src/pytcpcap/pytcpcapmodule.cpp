@@ -1,116 +1,208 @@
 #include <Python.h>
 #include <pcap.h>
+#include <chrono>
+#include <condition_variable>
+#include <mutex>
+#include <set>
 #include <string>
 #include <vector>
-#include <map>
 
-typedef std::vector<std::pair<int, std::string> > PacketVectorType;
-typedef std::map<std::string, PacketVectorType> PacketsByCapHandleMap;
-PacketsByCapHandleMap packets;
+// Most packets held for get_packets (by default) before newer packets are
+// dropped and counted
+static const Py_ssize_t DEFAULT_RING_SIZE = 65536;
+static const int DEFAULT_SNAPLEN = 0xFFFF;
+// How long pcap waits to fill a buffer before handing over what it has,
+// which also bounds how long pcap_loop takes to notice pcap_breakloop
+static const int READ_TIMEOUT_MS = 10;
+
+struct PacketRecord {
+  double timestamp;
+  std::string data;
+};
+
+// One capture session.  pcap_loop runs without the GIL, so everything the
+// packet handler shares with the Python calls is guarded by lock.
+struct CaptureHandle {
+  pcap_t* pcap;
+  std::string filter;
+
+  std::mutex lock;
+  std::condition_variable packetsReady;
+  std::condition_variable loopDone;
+  // Ring of packets: count records starting at head.  Records are reused,
+  // so their data buffers are only reallocated for larger packets.
+  std::vector<PacketRecord> ring;
+  size_t head;
+  size_t count;
+  bool looping;
+  bool stopped;
+  unsigned long long received;
+  unsigned long long dropped;
+};
+
+// A batch of packets handed to Python: every packet's data back to back,
+// the offset of each packet in it (plus the end offset), and each
+// packet's timestamp
+struct PacketBatch {
+  std::string data;
+  std::vector<unsigned int> offsets;
+  std::vector<double> timestamps;
+};
+
+// Handles returned by init and not closed yet.  Only used with the GIL
+// held, so needs no lock of its own.
+static std::set<CaptureHandle*> liveHandles;
 
-void
+static void
 setError(std::string baseStr) {
   PyErr_SetString(PyExc_RuntimeError, baseStr.c_str());
 }
 
+// Handles are passed around as plain integers, so check one is still
+// live before using it, rather than touching freed memory
+static CaptureHandle*
+findHandle(unsigned long pcapHandle) {
+  CaptureHandle* handle = (CaptureHandle*)pcapHandle;
+  if (liveHandles.count(handle) == 0) {
+    setError(std::string("Unknown or closed capture handle: ") +
+             std::to_string(pcapHandle));
+    return NULL;
+  }
+  return handle;
+}
+
+static CaptureHandle*
+parseHandle(PyObject* args) {
+  unsigned long pcapHandle;
+  if (!PyArg_ParseTuple(args, "k", &pcapHandle)) {
+    return NULL;
+  }
+  return findHandle(pcapHandle);
+}
+
+static PyObject *
+buildBatch(PacketBatch& batch) {
+  batch.offsets.push_back(batch.data.size());
+  PyObject* data = PyBytes_FromStringAndSize(batch.data.data(),
+                                             batch.data.size());
+  PyObject* offsets = PyBytes_FromStringAndSize(
+    (const char*)batch.offsets.data(),
+    batch.offsets.size() * sizeof(unsigned int));
+  PyObject* timestamps = PyBytes_FromStringAndSize(
+    (const char*)batch.timestamps.data(),
+    batch.timestamps.size() * sizeof(double));
+  PyObject* ret = NULL;
+  if (data != NULL && offsets != NULL && timestamps != NULL) {
+    ret = PyTuple_New(3);
+  }
+  if (ret == NULL) {
+    Py_XDECREF(data);
+    Py_XDECREF(offsets);
+    Py_XDECREF(timestamps);
+    return NULL;
+  }
+  // The tuple takes over the references
+  PyTuple_SET_ITEM(ret, 0, data);
+  PyTuple_SET_ITEM(ret, 1, offsets);
+  PyTuple_SET_ITEM(ret, 2, timestamps);
+  return ret;
+}
+
 static PyObject *
 pytcpcap_init(PyObject *self, PyObject *args) {
   const char* device;
   const char* filterStr = "";
+  int snaplen = DEFAULT_SNAPLEN;
+  Py_ssize_t ringSize = DEFAULT_RING_SIZE;
   char errorBuf[PCAP_ERRBUF_SIZE];
-  pcap_t* pcapObj;
-  struct bpf_program filterPtr;
 
-  if (!PyArg_ParseTuple(args, "s|s", &device, &filterStr)) {
+  if (!PyArg_ParseTuple(args, "s|sin", &device, &filterStr, &snaplen,
+                        &ringSize)) {
+    return NULL;
+  }
+  if (ringSize <= 0) {
+    setError("Ring size must be positive");
     return NULL;
   }
 
-  pcapObj = pcap_create(device, errorBuf);
-
+  pcap_t* pcapObj = pcap_create(device, errorBuf);
   if (pcapObj == 0) {
     setError(std::string("Could not open pcap device: ") + errorBuf);
     return NULL;
   }
 
-  if (strncmp(filterStr, "", 1)) {
-    if (!pcap_compile(pcapObj, &filterPtr, filterStr,
-                      0, PCAP_NETMASK_UNKNOWN)) {
-      setError(std::string("Could not parse PCAP filter") + filterStr);
-      pcap_close(pcapObj);
-      return NULL;
-    }
-    if (!pcap_setfilter(pcapObj, &filterPtr)) {
-      setError(std::string("Could not install PCAP filter") + filterStr);
-      pcap_close(pcapObj);
-      return NULL;
-    }
+  // Capture the whole packet where we can
+  int ret = pcap_set_snaplen(pcapObj, snaplen);
+  if (ret == 0) {
+    ret = pcap_set_timeout(pcapObj, READ_TIMEOUT_MS);
   }
-
-  // Capure the whole packet where we can
-  if (int ret = pcap_set_snaplen(pcapObj, (int)0xFFFF) != 0) {
-    setError(std::string("Could not set snaplen on PCAP: ") +
+  if (ret != 0) {
+    setError(std::string("Could not configure PCAP: ") +
              std::to_string(ret));
     pcap_close(pcapObj);
     return NULL;
   }
 
-  FILE* f = fopen("/tmp/pytcpcap.log", "a");
-  fprintf(f, "Init capture on device: %s with filter [%s]\n",
-          device, filterStr);
-  fclose(f);
-
-  return Py_BuildValue("k", pcapObj);
+  CaptureHandle* handle = new CaptureHandle();
+  handle->pcap = pcapObj;
+  handle->filter = filterStr;
+  handle->ring.resize(ringSize);
+  handle->head = 0;
+  handle->count = 0;
+  handle->looping = false;
+  handle->stopped = false;
+  handle->received = 0;
+  handle->dropped = 0;
+
+  PyObject* handleObj = Py_BuildValue("k", (unsigned long)handle);
+  if (handleObj == NULL) {
+    pcap_close(pcapObj);
+    delete handle;
+    return NULL;
+  }
+  liveHandles.insert(handle);
+  return handleObj;
 }
 
-void
+static void
 packetHandler(unsigned char* user,
               const struct pcap_pkthdr* header,
               const unsigned char* bytes) {
-  std::string handleStr((char*)user);
-
-  FILE* f = fopen("/tmp/pytcpcap.log", "a");
-  fprintf(f, "Got packet on handle: %s\n", handleStr.c_str());
-  fclose(f);
-
-  std::string data((const char*)bytes, header->caplen);
-  packets[handleStr].push_back(std::make_pair(header->caplen, data));
-}
-
-PyObject* makeList(PacketVectorType& packetsForCapHandle) {
-  PyObject *l = PyList_New(packetsForCapHandle.size());
-  FILE* f = fopen("/tmp/pytcpcap.log", "a");
-
-  for (PacketVectorType::const_iterator it = packetsForCapHandle.begin();
-       it != packetsForCapHandle.end();
-       ++it) {
-    PyList_Append(l, Py_BuildValue("s#", it->second.c_str(), it->first));
-    fprintf(f, "Appending packet to list (len: %u)\n", it->first);
+  CaptureHandle* handle = (CaptureHandle*)user;
+  bool wasEmpty;
+  {
+    std::lock_guard<std::mutex> guard(handle->lock);
+    handle->received++;
+    if (handle->count == handle->ring.size()) {
+      handle->dropped++;
+      return;
+    }
+    PacketRecord& record =
+      handle->ring[(handle->head + handle->count) % handle->ring.size()];
+    record.timestamp = header->ts.tv_sec + header->ts.tv_usec / 1e6;
+    record.data.assign((const char*)bytes, header->caplen);
+    wasEmpty = handle->count++ == 0;
+  }
+  // Readers only wait while the ring is empty
+  if (wasEmpty) {
+    handle->packetsReady.notify_all();
   }
-
-  fclose(f);
-
-  packetsForCapHandle.clear();
-  return l;
 }
 
 static PyObject *
 pytcpcap_start(PyObject* self, PyObject *args) {
-  unsigned long pcapHandle;
-  if (!PyArg_ParseTuple(args, "k", &pcapHandle)) {
+  CaptureHandle* handle = parseHandle(args);
+  if (handle == NULL) {
     return NULL;
   }
 
-  std::string handleStr = std::to_string((long)pcapHandle);
-
-  FILE* f = fopen("/tmp/pytcpcap.log", "a");
-  fprintf(f, "Activating for handle: %s\n", handleStr.c_str());
+  std::string handleStr = std::to_string((unsigned long)handle);
 
-  if (int ret = pcap_activate((pcap_t*)pcapHandle) != 0) {
+  int ret = pcap_activate(handle->pcap);
+  // Positive values are warnings, the capture still runs
+  if (ret < 0) {
     std::string errorStr;
     switch (ret) {
-      case PCAP_WARNING_PROMISC_NOTSUP:
-        errorStr = "Promiscuous mode not supported";
-        break;
       case PCAP_ERROR_NO_SUCH_DEVICE:
         errorStr = "No such device";
         break;
@@ -126,43 +218,69 @@ pytcpcap_start(PyObject* self, PyObject *args) {
       case PCAP_ERROR_IFACE_NOT_UP:
         errorStr = "Interface not up";
         break;
-      case PCAP_ERROR:
-      case PCAP_WARNING:
-        errorStr = pcap_geterr((pcap_t*)pcapHandle);
+      default:
+        errorStr = pcap_geterr(handle->pcap);
         break;
     }
 
     setError(std::string("Could not start capture for handle: ") +
              handleStr + " with error: " + errorStr);
-    fclose(f);
     return NULL;
   }
 
-  fprintf(f, "Activated capture for handle: %s\n", handleStr.c_str());
-  fclose(f);
+  // Filters can only be compiled for an activated handle
+  if (!handle->filter.empty()) {
+    struct bpf_program filterProgram;
+    if (pcap_compile(handle->pcap, &filterProgram, handle->filter.c_str(),
+                     1, PCAP_NETMASK_UNKNOWN) == -1) {
+      setError(std::string("Could not parse PCAP filter [") +
+               handle->filter + "]: " + pcap_geterr(handle->pcap));
+      return NULL;
+    }
+    ret = pcap_setfilter(handle->pcap, &filterProgram);
+    pcap_freecode(&filterProgram);
+    if (ret == -1) {
+      setError(std::string("Could not install PCAP filter [") +
+               handle->filter + "]: " + pcap_geterr(handle->pcap));
+      return NULL;
+    }
+  }
+
   Py_RETURN_NONE;
 }
 
 static PyObject *
 pytcpcap_loop(PyObject* self, PyObject *args) {
-  unsigned long pcapHandle;
-  if (!PyArg_ParseTuple(args, "k", &pcapHandle)) {
+  CaptureHandle* handle = parseHandle(args);
+  if (handle == NULL) {
     return NULL;
   }
 
-  std::string handleStr = std::to_string((long)pcapHandle);
-
-  FILE* f = fopen("/tmp/pytcpcap.log", "a");
-  fprintf(f, "Starting loop for handle: %s\n", handleStr.c_str());
-  fclose(f);
-
-  int ret =
-    pcap_loop((pcap_t*)pcapHandle, -1, &packetHandler,
-              (unsigned char*)handleStr.c_str());
+  int ret = 0;
+  // Packets are captured into the ring without the GIL, so Python
+  // threads (including the ones reading the packets) keep running
+  Py_BEGIN_ALLOW_THREADS
+  bool stopped;
+  {
+    std::lock_guard<std::mutex> guard(handle->lock);
+    stopped = handle->stopped;
+    handle->looping = !stopped;
+  }
+  if (!stopped) {
+    ret = pcap_loop(handle->pcap, -1, &packetHandler,
+                    (unsigned char*)handle);
+    {
+      std::lock_guard<std::mutex> guard(handle->lock);
+      handle->looping = false;
+    }
+    handle->loopDone.notify_all();
+  }
+  Py_END_ALLOW_THREADS
 
   if (ret == -1) {
-    setError(std::string("Could not start packets handling loop for handle: ") +
-             handleStr);
+    setError(std::string("Packet handling loop failed for handle: ") +
+             std::to_string((unsigned long)handle) + " with error: " +
+             pcap_geterr(handle->pcap));
     return NULL;
   }
 
@@ -172,51 +290,224 @@ pytcpcap_loop(PyObject* self, PyObject *args) {
 static PyObject *
 pytcpcap_get_packets(PyObject* self, PyObject *args) {
   unsigned long pcapHandle;
-  if (!PyArg_ParseTuple(args, "k", &pcapHandle)) {
+  Py_ssize_t maxCount = 0;
+  double timeout = 0.0;
+  if (!PyArg_ParseTuple(args, "k|nd", &pcapHandle, &maxCount, &timeout)) {
+    return NULL;
+  }
+  CaptureHandle* handle = findHandle(pcapHandle);
+  if (handle == NULL) {
     return NULL;
   }
 
-  std::string handleStr = std::to_string((long)pcapHandle);
+  PacketBatch batch;
+
+  Py_BEGIN_ALLOW_THREADS
+  {
+    std::unique_lock<std::mutex> guard(handle->lock);
+    // Negative timeouts wait until packets arrive (or the capture stops)
+    if (timeout < 0) {
+      handle->packetsReady.wait(guard, [handle] {
+          return handle->count > 0 || handle->stopped;
+        });
+    } else if (timeout > 0) {
+      handle->packetsReady.wait_for(
+        guard, std::chrono::duration<double>(timeout), [handle] {
+          return handle->count > 0 || handle->stopped;
+        });
+    }
 
-  FILE* f = fopen("/tmp/pytcpcap.log", "a");
-  fprintf(f, "Pulling %lu packets from handle: %lu\n",
-          packets[handleStr].size(), pcapHandle);
-  fclose(f);
+    size_t batchCount = handle->count;
+    if (maxCount > 0 && (size_t)maxCount < batchCount) {
+      batchCount = maxCount;
+    }
+    size_t batchSize = 0;
+    for (size_t i = 0; i < batchCount; ++i) {
+      batchSize +=
+        handle->ring[(handle->head + i) % handle->ring.size()].data.size();
+    }
+    batch.data.reserve(batchSize);
+    batch.offsets.reserve(batchCount + 1);
+    batch.timestamps.reserve(batchCount);
+    for (size_t i = 0; i < batchCount; ++i) {
+      PacketRecord& record = handle->ring[handle->head];
+      batch.offsets.push_back(batch.data.size());
+      batch.timestamps.push_back(record.timestamp);
+      batch.data.append(record.data);
+      handle->head = (handle->head + 1) % handle->ring.size();
+    }
+    handle->count -= batchCount;
+  }
+  Py_END_ALLOW_THREADS
+
+  return buildBatch(batch);
+}
 
-  return makeList(packets[handleStr]);
+static void
+batchHandler(unsigned char* user,
+             const struct pcap_pkthdr* header,
+             const unsigned char* bytes) {
+  PacketBatch* batch = (PacketBatch*)user;
+  batch->offsets.push_back(batch->data.size());
+  batch->timestamps.push_back(header->ts.tv_sec + header->ts.tv_usec / 1e6);
+  batch->data.append((const char*)bytes, header->caplen);
 }
 
 static PyObject *
-pytcpcap_stop(PyObject* self, PyObject *args) {
+pytcpcap_selectable_fd(PyObject* self, PyObject *args) {
+  CaptureHandle* handle = parseHandle(args);
+  if (handle == NULL) {
+    return NULL;
+  }
+
+  // Reads on the descriptor must not block an event loop
+  char errorBuf[PCAP_ERRBUF_SIZE];
+  if (pcap_setnonblock(handle->pcap, 1, errorBuf) == -1) {
+    setError(std::string("Could not set PCAP non-blocking: ") + errorBuf);
+    return NULL;
+  }
+  int fd = pcap_get_selectable_fd(handle->pcap);
+  if (fd == -1) {
+    setError("PCAP handle has no selectable file descriptor");
+    return NULL;
+  }
+  return Py_BuildValue("i", fd);
+}
+
+static PyObject *
+pytcpcap_dispatch(PyObject* self, PyObject *args) {
   unsigned long pcapHandle;
-  if (!PyArg_ParseTuple(args, "k", &pcapHandle)) {
+  int maxCount = -1;
+  if (!PyArg_ParseTuple(args, "k|i", &pcapHandle, &maxCount)) {
+    return NULL;
+  }
+  CaptureHandle* handle = findHandle(pcapHandle);
+  if (handle == NULL) {
+    return NULL;
+  }
+
+  // Read whatever packets are waiting straight into a batch, without
+  // going through the ring (or a loop thread)
+  PacketBatch batch;
+  int ret;
+  Py_BEGIN_ALLOW_THREADS
+  ret = pcap_dispatch(handle->pcap, maxCount, &batchHandler,
+                      (unsigned char*)&batch);
+  if (ret > 0) {
+    std::lock_guard<std::mutex> guard(handle->lock);
+    handle->received += ret;
+  }
+  Py_END_ALLOW_THREADS
+
+  if (ret == -1) {
+    setError(std::string("Could not read packets for handle: ") +
+             std::to_string((unsigned long)handle) + " with error: " +
+             pcap_geterr(handle->pcap));
     return NULL;
   }
+  return buildBatch(batch);
+}
 
-  std::string handleStr = std::to_string((long)pcapHandle);
+static PyObject *
+pytcpcap_stats(PyObject* self, PyObject *args) {
+  CaptureHandle* handle = parseHandle(args);
+  if (handle == NULL) {
+    return NULL;
+  }
 
-  pcap_breakloop((pcap_t*)pcapHandle);
-  pcap_close((pcap_t*)pcapHandle);
+  unsigned long long received;
+  unsigned long long dropped;
+  {
+    std::lock_guard<std::mutex> guard(handle->lock);
+    received = handle->received;
+    dropped = handle->dropped;
+  }
+  // The kernel's drop count, if the capture has been started
+  struct pcap_stat stats;
+  long long kernelDropped = -1;
+  if (pcap_stats(handle->pcap, &stats) == 0) {
+    kernelDropped = stats.ps_drop;
+  }
+  return Py_BuildValue("(KKL)", received, dropped, kernelDropped);
+}
 
-  FILE* f = fopen("/tmp/pytcpcap.log", "a");
-  fprintf(f, "Read %lu packets on handle: %s\n",
-          packets[handleStr].size(), handleStr.c_str());
-  fprintf(f, "Stopped capture\n");
-  fclose(f);
+static PyObject *
+pytcpcap_stop(PyObject* self, PyObject *args) {
+  CaptureHandle* handle = parseHandle(args);
+  if (handle == NULL) {
+    return NULL;
+  }
+
+  // Wake any reader, break the loop and wait for it to exit (without the
+  // GIL, as the loop's thread may need it to finish)
+  Py_BEGIN_ALLOW_THREADS
+  {
+    std::unique_lock<std::mutex> guard(handle->lock);
+    handle->stopped = true;
+    pcap_breakloop(handle->pcap);
+    handle->packetsReady.notify_all();
+    handle->loopDone.wait(guard, [handle] { return !handle->looping; });
+  }
+  Py_END_ALLOW_THREADS
+
+  Py_RETURN_NONE;
+}
+
+static PyObject *
+pytcpcap_close(PyObject* self, PyObject *args) {
+  CaptureHandle* handle = parseHandle(args);
+  if (handle == NULL) {
+    return NULL;
+  }
+
+  // Only called once stop has returned and the loop's thread has exited.
+  // The handle is forgotten first, so closing it again raises rather
+  // than closing the freed pcap_t.
+  liveHandles.erase(handle);
+  pcap_close(handle->pcap);
+  handle->pcap = NULL;
+  delete handle;
 
   Py_RETURN_NONE;
 }
 
 static PyMethodDef PytcpcapMethods[] = {
-  {"init",  pytcpcap_init, METH_VARARGS, "Init a capture session"},
+  {"init",  pytcpcap_init, METH_VARARGS,
+   "Init a capture session: init(device, filter='', snaplen=65535, "
+   "ring_size=65536)"},
   {"start",  pytcpcap_start, METH_VARARGS, "Activate packet capture"},
-  {"loop",  pytcpcap_loop, METH_VARARGS, "Start processing packets"},
-  {"get_packets",  pytcpcap_get_packets, METH_VARARGS, "Get packets"},
+  {"loop",  pytcpcap_loop, METH_VARARGS,
+   "Capture packets until stopped (releases the GIL)"},
+  {"get_packets",  pytcpcap_get_packets, METH_VARARGS,
+   "Take a batch of packets: get_packets(handle, max_count=0, timeout=0) "
+   "returns (data, offsets, timestamps) as bytes, with offsets packed as "
+   "native unsigned ints and timestamps as doubles"},
+  {"selectable_fd",  pytcpcap_selectable_fd, METH_VARARGS,
+   "Put an activated capture in non-blocking mode and return a file "
+   "descriptor which selects readable when packets are waiting"},
+  {"dispatch",  pytcpcap_dispatch, METH_VARARGS,
+   "Read the waiting packets without blocking: dispatch(handle, "
+   "max_count=-1) returns a batch as get_packets does"},
+  {"stats",  pytcpcap_stats, METH_VARARGS,
+   "(received, dropped from the ring, dropped by the kernel)"},
   {"stop",  pytcpcap_stop, METH_VARARGS, "Stop capturing packets"},
+  {"close",  pytcpcap_close, METH_VARARGS,
+   "Free a stopped capture session"},
   {NULL, NULL, 0, NULL}
 };
 
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef pytcpcapModule = {
+  PyModuleDef_HEAD_INIT, "pytcpcap", NULL, -1, PytcpcapMethods
+};
+
+PyMODINIT_FUNC
+PyInit_pytcpcap(void) {
+  return PyModule_Create(&pytcpcapModule);
+}
+#else
 PyMODINIT_FUNC
 initpytcpcap(void) {
   (void) Py_InitModule("pytcpcap", PytcpcapMethods);
 }
+#endif